@@ -0,0 +1,149 @@
+# Background writer for the files produced while reading a board
+# (chip PNGs, barcode image, reduced images and results text), so the OCR
+# requests never wait on the disk.
+
+# Every file is written under a temporary name, fsync'ed and then renamed,
+# so a crash never leaves a half-written file behind (e.g. a truncated
+# front_results.txt for produce_json.py to misparse).
+
+import os
+import queue
+import threading
+import atexit
+
+import cv2
+
+
+# Number of queued files written and fsync'ed together
+fsync_batch_size = 32
+
+_artifact_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_write_errors = []
+
+
+############################################################################################
+
+def write_artifact(path, data):
+
+    # data can be bytes, text, or an image array (PNG-encoded by the writer thread)
+    global _writer_thread
+
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name="artifact-writer", daemon=True)
+            _writer_thread.start()
+
+    _artifact_queue.put((path, data))
+
+def write_artifact_now(path, data):
+
+    # Same as write_artifact, but written before returning: for full-resolution
+    # frames, which the queue would otherwise keep in memory until encoded
+    payload = _encode(path, data)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(payload)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        _remove_temp(tmp_path)
+        raise
+
+############################################################################################
+
+def flush_artifacts():
+
+    # Wait until everything queued so far is on disk
+    _artifact_queue.join()
+
+    errors = list(_write_errors)
+    del _write_errors[:]
+    for path, error in errors:
+        print(f"Error writing {path}: {error}")
+
+    return not errors
+
+############################################################################################
+
+def _encode(path, data):
+
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+
+    # Image array: encode with the format given by the file extension
+    ok, buffer = cv2.imencode(os.path.splitext(path)[1] or '.png', data)
+    if not ok:
+        raise ValueError("image encoding failed")
+    return buffer.tobytes()
+
+def _remove_temp(tmp_path):
+
+    # A failed write must not leave its temporary file next to the results (or in the board archive)
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+############################################################################################
+
+def _writer_loop():
+
+    while True:
+        batch = [_artifact_queue.get()]
+        while len(batch) < fsync_batch_size:
+            try:
+                batch.append(_artifact_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Write all temporary files first, then fsync them together
+        pending = []
+        for path, data in batch:
+            tmp_path = f"{path}.tmp{os.getpid()}"
+            try:
+                payload = _encode(path, data)
+                tmp_file = open(tmp_path, 'wb')
+                try:
+                    tmp_file.write(payload)
+                    tmp_file.flush()
+                except Exception:
+                    tmp_file.close()
+                    raise
+                pending.append((tmp_file, tmp_path, path))
+            except Exception as e:
+                _remove_temp(tmp_path)
+                _write_errors.append((path, e))
+
+        directories = set()
+        for tmp_file, tmp_path, path in pending:
+            try:
+                with tmp_file:
+                    os.fsync(tmp_file.fileno())
+                os.replace(tmp_path, path)
+                directories.add(os.path.dirname(os.path.abspath(path)))
+            except Exception as e:
+                _remove_temp(tmp_path)
+                _write_errors.append((path, e))
+
+        # Make the renames durable, once per directory
+        for directory in directories:
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError:
+                pass  # not supported on every platform/filesystem
+
+        for _ in batch:
+            _artifact_queue.task_done()
+
+
+atexit.register(flush_artifacts)
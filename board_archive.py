@@ -0,0 +1,198 @@
+# Packed board directories: one archive per board instead of ~25 loose files.
+
+# results/<FEMB>/ (chip PNGs, DM_code.png, reduced and full images, results
+# text, .JSON) becomes results/<FEMB>.zip: an uncompressed (stored) zip, whose
+# central directory is the offset table, so any chip crop is read directly
+# without extracting the rest, and any zip tool can open it.
+
+# The other scripts go through read_file/write_file/find_boards, which take
+# the usual paths (results/<FEMB>/front_results.txt) and use the archive when
+# the board is packed.
+
+#   python board_archive.py pack results [--remove]     directories -> archives
+#   python board_archive.py unpack results [--remove]   archives -> directories
+#   python board_archive.py list results/<FEMB>.zip
+
+import argparse
+import os
+import shutil
+import warnings
+import zipfile
+
+
+archive_suffix = ".zip"
+state_dirs = ("claims", "workers")  # next to the boards, not boards (distributed_worker.py)
+
+
+############################################################################################
+
+def archive_path(board_dir):
+
+    return os.path.normpath(board_dir) + archive_suffix
+
+
+def split_board_path(path):
+
+    # results/<FEMB>/front_chip_2.png -> (results/<FEMB>, front_chip_2.png)
+    return os.path.dirname(path), os.path.basename(path)
+
+############################################################################################
+
+def find_boards(base_dir):
+
+    # Board directories and archives in base_dir (a directory wins over its archive)
+    boards = {}
+    for name in sorted(os.listdir(base_dir)):
+        path = os.path.join(base_dir, name)
+        if name in state_dirs:
+            continue
+        if os.path.isdir(path):
+            boards[name] = path
+        elif name.endswith(archive_suffix) and not os.path.isdir(path[:-len(archive_suffix)]):
+            boards[name[:-len(archive_suffix)]] = path
+
+    return boards
+
+
+def board_name(board):
+
+    name = os.path.basename(os.path.normpath(board))
+    return name[:-len(archive_suffix)] if name.endswith(archive_suffix) else name
+
+############################################################################################
+
+def list_files(board):
+
+    if os.path.isdir(board):
+        return sorted(os.listdir(board))
+    packed = board if board.endswith(archive_suffix) else archive_path(board)
+    with zipfile.ZipFile(packed) as archive:
+        return sorted(set(archive.namelist()))
+
+
+def file_exists(path):
+
+    if os.path.exists(path):
+        return True
+    board_dir, name = split_board_path(path)
+    packed = archive_path(board_dir)
+    if not os.path.exists(packed):
+        return False
+    with zipfile.ZipFile(packed) as archive:
+        return name in archive.NameToInfo
+
+
+def file_mtime(path):
+
+    # Modification time of a board file (of the archive, for a packed board), None if missing
+    if os.path.exists(path):
+        return os.path.getmtime(path)
+    if file_exists(path):
+        return os.path.getmtime(archive_path(os.path.dirname(path)))
+    return None
+
+
+def read_file(path):
+
+    # Bytes of a board file, from its directory or from the board archive
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    board_dir, name = split_board_path(path)
+    with zipfile.ZipFile(archive_path(board_dir)) as archive:
+        return archive.read(name)  # the last copy when the file was rewritten
+
+
+def read_text(path):
+
+    return read_file(path).decode('utf-8')
+
+
+def write_file(path, data):
+
+    # Into the board directory if there is one, otherwise appended to the
+    # archive (the new copy hides the old one until the archive is repacked)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    board_dir, name = split_board_path(path)
+    packed = archive_path(board_dir)
+    if os.path.isdir(board_dir) or not os.path.exists(packed):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        return
+
+    with zipfile.ZipFile(packed, 'a', compression=zipfile.ZIP_STORED) as archive:
+        if name in archive.NameToInfo and archive.read(name) == data:
+            return
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)  # duplicate name
+            archive.writestr(name, data)
+
+############################################################################################
+
+def pack_board(board_dir, remove_directory=False):
+
+    # Stored, not deflated: the PNGs are already compressed
+    packed = archive_path(board_dir)
+    temp_path = f"{packed}.tmp"
+    with zipfile.ZipFile(temp_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name in sorted(os.listdir(board_dir)):
+            path = os.path.join(board_dir, name)
+            if os.path.isfile(path) and not name.endswith(".tmp"):
+                archive.write(path, name)
+    os.replace(temp_path, packed)
+
+    if remove_directory:
+        shutil.rmtree(board_dir)
+
+    return packed
+
+
+def unpack_board(packed, remove_archive=False):
+
+    board_dir = packed[:-len(archive_suffix)]
+    os.makedirs(board_dir, exist_ok=True)
+    with zipfile.ZipFile(packed) as archive:
+        for name in set(archive.namelist()):
+            with open(os.path.join(board_dir, os.path.basename(name)), 'wb') as f:
+                f.write(archive.read(name))
+
+    if remove_archive:
+        os.remove(packed)
+
+    return board_dir
+
+############################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Pack board directories into single-file archives and back")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack = subparsers.add_parser("pack", help="pack every board directory of BASE_DIR")
+    pack.add_argument("base_dir")
+    pack.add_argument("--remove", action="store_true", help="delete the directories once packed")
+    unpack = subparsers.add_parser("unpack", help="unpack every board archive of BASE_DIR")
+    unpack.add_argument("base_dir")
+    unpack.add_argument("--remove", action="store_true", help="delete the archives once unpacked")
+    list_parser = subparsers.add_parser("list", help="files of a board archive")
+    list_parser.add_argument("archive")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        for name, board in find_boards(args.base_dir).items():
+            if os.path.isdir(board):
+                print(f"{name} -> {pack_board(board, args.remove)}")
+    elif args.command == "unpack":
+        for name, board in find_boards(args.base_dir).items():
+            if not os.path.isdir(board):
+                print(f"{name} -> {unpack_board(board, args.remove)}")
+    elif args.command == "list":
+        with zipfile.ZipFile(args.archive) as archive:
+            for info in archive.infolist():
+                print(f"{info.file_size:10d}  offset {info.header_offset:10d}  {info.filename}")
@@ -0,0 +1,142 @@
+# Consistency checks over every chip read so far (uses the results index).
+
+# validate_ocr_result only checks each chip against its own pattern, so a
+# misread that still looks like a serial number goes through. These checks
+# compare the chips with each other, in one pass with hash tables:
+#
+# - duplicate_serial:  the same chip serial number on more than one board
+#                      (or twice on the same board)
+# - lot_mismatch:      a chip whose lot differs from the other chips of the
+#                      same type on its board
+# - date_out_of_range: a date code that is not a valid year/week, older than
+#                      first_date_code_year, or later than the photo of the board
+#
+# produce_json.py runs them before writing the HWDB records and skips the
+# boards with a blocking issue.
+
+#   python check_consistency.py
+
+import argparse
+import os
+import re
+from collections import Counter, defaultdict
+from datetime import date
+
+import results_index
+
+
+# Configuration:
+first_date_code_year = 2018  # no chip can be older than this
+duplicate_key = ("chip_type", "serial")  # add "lot" if serial numbers restart in every lot
+blocking_issues = ("duplicate_serial", "date_out_of_range")  # lot_mismatch is only reported
+
+
+############################################################################################
+
+def parse_date_code(date_code):
+
+    # "2315" (COLDATA, ColdADC) or "23/15" (LArASIC): year 2023, week 15
+    match = re.fullmatch(r"(\d{2})/?(\d{2})", date_code or "")
+    if not match:
+        return None
+    return 2000 + int(match.group(1)), int(match.group(2))
+
+
+def date_code_issue(date_code, photo_date):
+
+    year_week = parse_date_code(date_code)
+    if year_week is None:
+        return None  # missing or unreadable, validate_ocr_result already reports it
+
+    year, week = year_week
+    if not 1 <= week <= 53:
+        return f"week {week} does not exist"
+    if year < first_date_code_year:
+        return f"year {year} is before {first_date_code_year}"
+    if photo_date:
+        photo_year, photo_week, _ = date.fromisoformat(photo_date).isocalendar()
+        if (year, week) > (photo_year, photo_week):
+            return f"later than the photo ({photo_date})"
+    return None
+
+############################################################################################
+
+def check_chips(chips):
+
+    # chips: rows of the results index. Returns a list of issues
+    # (kind, board_dir, femb_id, side, chip, message).
+    issues = []
+
+    # Duplicate serial numbers: one hash table keyed by the chip identity
+    by_serial = defaultdict(list)
+    for chip in chips:
+        if chip["serial"]:
+            by_serial[tuple(chip[name] for name in duplicate_key)].append(chip)
+
+    for key, same_serial in by_serial.items():
+        if len(same_serial) < 2:
+            continue
+        where = ", ".join(f"{os.path.basename(c['board_dir'])} {c['side']} chip {c['chip']}" for c in same_serial)
+        for chip in same_serial:
+            issues.append(("duplicate_serial", chip["board_dir"], chip["femb_id"], chip["side"], chip["chip"],
+                           f"{chip['chip_type']} SN {chip['serial']} found {len(same_serial)} times: {where}"))
+
+    # Lot codes: compare with the most common lot of the same chip type on the board
+    by_board_type = defaultdict(list)
+    for chip in chips:
+        if chip["lot"]:
+            by_board_type[(chip["board_dir"], chip["chip_type"])].append(chip)
+
+    for siblings in by_board_type.values():
+        lots = Counter(chip["lot"] for chip in siblings)
+        if len(lots) < 2:
+            continue
+        common_lot, count = lots.most_common(1)[0]
+        for chip in siblings:
+            if chip["lot"] != common_lot:
+                issues.append(("lot_mismatch", chip["board_dir"], chip["femb_id"], chip["side"], chip["chip"],
+                               f"{chip['chip_type']} lot {chip['lot']}, {count} of its siblings have {common_lot}"))
+
+    # Date codes
+    for chip in chips:
+        problem = date_code_issue(chip["date_code"], chip["photo_date"])
+        if problem:
+            issues.append(("date_out_of_range", chip["board_dir"], chip["femb_id"], chip["side"], chip["chip"],
+                           f"{chip['chip_type']} date code {chip['date_code']}: {problem}"))
+
+    return issues
+
+############################################################################################
+
+def check_all_boards(base_dir="results", quiet=False):
+
+    # Brings the index up to date, checks every chip and returns the issues
+    conn = results_index.open_index(os.path.join(base_dir, os.path.basename(results_index.index_path)))
+    results_index.update_index(conn, base_dir)
+    chips = conn.execute("SELECT * FROM chips").fetchall()
+    conn.close()
+
+    issues = check_chips(chips)
+
+    if not quiet:
+        for kind, _, femb_id, side, chip_number, message in sorted(issues, key=lambda issue: issue[:5]):
+            flag = "(!)" if kind in blocking_issues else "   "
+            print(f"{flag} {kind}: {femb_id} {side} chip {chip_number}: {message}")
+        print(f"{len(chips)} chips checked, {len(issues)} issues")
+
+    return issues
+
+
+def blocked_boards(issues):
+
+    # Board directories with at least one blocking issue
+    return {issue[1] for issue in issues if issue[0] in blocking_issues}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Consistency checks over all chips read so far")
+    parser.add_argument("--base-dir", default="results")
+    args = parser.parse_args()
+
+    check_all_boards(args.base_dir)
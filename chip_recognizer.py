@@ -0,0 +1,336 @@
+# Small CPU recognizer for the chip markings (CRNN + CTC), trained on our own crops.
+
+# The markings are a few dozen laser-etched characters in a known font and
+# layout, so a small network reads them in milliseconds on the QC-station
+# CPU, instead of seconds of model server (MiniCPM) or API (GPT-4o) time.
+
+# - Training data: the chip crops under results/ (results/<FEMB>/front_chip_2.png,
+#   packed boards too) with the readings that pass validation (results_index.split_fields)
+# - Each chip is binarized and cut into text lines (row projection); the lines
+#   are put side by side in one strip, so the whole marking is one sequence
+#   ("ColdADC N6Y381.00 02454 2315") and CTC learns the alignment
+# - Training with PyTorch on the CPU, export to ONNX, inference with onnxruntime
+#
+#   python chip_recognizer.py train --base-dir results --epochs 60
+#   python chip_recognizer.py eval --base-dir results
+#   python chip_recognizer.py read results/<FEMB>/front_chip_2.png
+#
+# crop_chips_FEMB.py uses it with ocr_engine = 'crnn' (MiniCPM for the chips
+# it is not sure about).
+
+import argparse
+import os
+import random
+import time
+
+import cv2
+import numpy as np
+
+import board_archive
+import results_index
+from chip_specs import chip_marking_prefix, get_chip_type
+
+
+# Configuration:
+model_path = os.path.join("models", "chip_crnn.onnx")
+strip_height = 32     # pixels, height of every text line in the strip
+strip_width = 640     # pixels, strips are padded (or squeezed) to this width
+line_gap = 24         # pixels between two lines in the strip
+border_margin = 0.04  # fraction of the crop ignored along its edges
+min_line_height = 4   # pixels, thinner ink bands are noise
+max_line_split = 3    # pixels, ink bands closer than this are one line
+inference_threads = 1  # per session; the chips of a side already run in parallel
+
+# Characters of the markings; index 0 is the CTC blank
+CHARSET = " -./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BLANK = 0
+
+
+############################################################################################
+# Preprocessing: chip crop -> one strip of text lines
+############################################################################################
+
+def segment_lines(gray):
+
+    # Text made white on black, then the ink rows grouped into lines
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    if np.count_nonzero(binary) > binary.size / 2:
+        binary = 255 - binary
+
+    # Without the package edges caught by the crop, and without isolated specks
+    margin = int(border_margin * min(binary.shape))
+    if margin:
+        binary[:margin] = binary[-margin:] = 0
+        binary[:, :margin] = binary[:, -margin:] = 0
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+
+    row_ink = np.count_nonzero(binary, axis=1)
+    is_text = row_ink > max(2, 0.02 * binary.shape[1])
+
+    bands = []
+    start = None
+    for y, text_row in enumerate(np.append(is_text, False)):
+        if text_row and start is None:
+            start = y
+        elif not text_row and start is not None:
+            # Rows with little ink (the middle of "2314") don't split a line
+            if bands and start - bands[-1][1] <= max_line_split:
+                bands[-1] = (bands[-1][0], y)
+            else:
+                bands.append((start, y))
+            start = None
+
+    lines = [(top, bottom) for top, bottom in bands if bottom - top >= min_line_height]
+    return binary, lines
+
+
+def make_strip(chip_image):
+
+    # Float32 array (1, strip_height, strip_width) in [0, 1]
+    gray = chip_image if chip_image.ndim == 2 else cv2.cvtColor(chip_image, cv2.COLOR_BGR2GRAY)
+    binary, lines = segment_lines(gray)
+    if not lines:
+        lines = [(0, binary.shape[0])]
+
+    pieces = []
+    for top, bottom in lines:
+        line = binary[max(0, top - 1):bottom + 1]
+        columns = np.flatnonzero(np.count_nonzero(line, axis=0))
+        if columns.size:
+            line = line[:, max(0, columns[0] - 2):columns[-1] + 3]
+        width = max(1, int(round(line.shape[1] * strip_height / line.shape[0])))
+        pieces.append(cv2.resize(line, (width, strip_height), interpolation=cv2.INTER_AREA))
+        pieces.append(np.zeros((strip_height, line_gap), dtype=np.uint8))
+
+    strip = np.hstack(pieces[:-1])
+    if strip.shape[1] > strip_width:
+        strip = cv2.resize(strip, (strip_width, strip_height), interpolation=cv2.INTER_AREA)
+    else:
+        strip = np.pad(strip, ((0, 0), (0, strip_width - strip.shape[1])))
+
+    return (strip.astype(np.float32) / 255.0)[None]
+
+############################################################################################
+# Labels and CTC decoding
+############################################################################################
+
+def encode_text(text):
+
+    return [CHARSET.index(c) + 1 for c in text if c in CHARSET]
+
+
+def decode_logits(logits):
+
+    # Greedy CTC decoding of (time, classes) logits -> (text, confidence)
+    probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    best = probabilities.argmax(axis=1)
+
+    chars = []
+    previous = BLANK
+    for index in best:
+        if index != BLANK and index != previous:
+            chars.append(CHARSET[index - 1])
+        previous = index
+
+    confidence = float(probabilities.max(axis=1)[best != BLANK].min()) if np.any(best != BLANK) else 0.0
+    return " ".join("".join(chars).split()), confidence
+
+############################################################################################
+# Training data from the results tree
+############################################################################################
+
+def load_samples(base_dir):
+
+    # (strip, label, board) for every chip whose reading passes validation
+    samples = []
+    for board_name in board_archive.find_boards(base_dir):
+        board_dir = os.path.join(base_dir, board_name)
+        for side in ("front", "back"):
+            result_filename = os.path.join(board_dir, f"{side}_results.txt")
+            if not board_archive.file_exists(result_filename):
+                continue
+            _, _, chips = results_index.parse_results_file(result_filename)
+            for chip_number, ocr_text in chips.items():
+                chip_type = get_chip_type(chip_number, side)
+                values, valid = results_index.split_fields(ocr_text, chip_type)
+                chip_path = os.path.join(board_dir, f"{side}_chip_{chip_number}.png")
+                if not valid or len(ocr_text.split()) == 1 or not board_archive.file_exists(chip_path):
+                    continue
+                # The prefix is not validated ("CoIdADC"), so it is taken from chip_specs
+                label = " ".join([chip_marking_prefix[chip_type]] + list(values.values()))
+                image = cv2.imdecode(np.frombuffer(board_archive.read_file(chip_path), np.uint8), cv2.IMREAD_GRAYSCALE)
+                samples.append((make_strip(image), label, board_name))
+
+    return samples
+
+
+def split_by_board(samples, validation_fraction=0.1, seed=0):
+
+    # Whole boards are held out, so no chip photo is seen in both sets
+    boards = sorted({board for _, _, board in samples})
+    random.Random(seed).shuffle(boards)
+    held_out = set(boards[:max(1, int(len(boards) * validation_fraction))]) if len(boards) > 1 else set()
+    return ([s for s in samples if s[2] not in held_out], [s for s in samples if s[2] in held_out])
+
+############################################################################################
+# Model (PyTorch, only needed to train)
+############################################################################################
+
+def build_model():
+
+    import torch
+    from torch import nn
+
+    class CRNN(nn.Module):
+
+        # 32 x W strip -> W/4 time steps of class scores
+
+        def __init__(self, n_classes):
+            super().__init__()
+
+            def block(n_in, n_out, pool):
+                return [nn.Conv2d(n_in, n_out, 3, padding=1), nn.BatchNorm2d(n_out), nn.ReLU(inplace=True),
+                        nn.MaxPool2d(pool)]
+
+            self.features = nn.Sequential(*block(1, 32, (2, 2)), *block(32, 64, (2, 2)),
+                                          *block(64, 128, (2, 1)), *block(128, 128, (4, 1)))
+            self.rnn = nn.LSTM(128, 96, num_layers=2, bidirectional=True, batch_first=True)
+            self.classifier = nn.Linear(192, n_classes)
+
+        def forward(self, x):
+            features = self.features(x).squeeze(2).permute(0, 2, 1)  # (batch, time, channels)
+            output, _ = self.rnn(features)
+            return self.classifier(output)                           # (batch, time, classes)
+
+    torch.set_num_threads(os.cpu_count() or 1)
+    return CRNN(len(CHARSET) + 1)
+
+
+def augment(strip):
+
+    # Small shifts and contrast changes, like from one photo to the next
+    strip = np.roll(strip, random.randint(-3, 3), axis=2)
+    return np.clip(strip * random.uniform(0.7, 1.0) + np.random.normal(0, 0.05, strip.shape), 0, 1).astype(np.float32)
+
+
+def train(base_dir, epochs, output_path, batch_size=32):
+
+    import torch
+
+    samples = load_samples(base_dir)
+    training, validation = split_by_board(samples)
+    print(f"{len(samples)} verified chips: {len(training)} for training, {len(validation)} held out")
+    if not training:
+        print("Error: no verified chip crops found")
+        return None
+
+    model = build_model()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=3e-3, total_steps=epochs * (-(-len(training) // batch_size)))
+    ctc_loss = torch.nn.CTCLoss(blank=BLANK, zero_infinity=True)
+
+    for epoch in range(epochs):
+        model.train()
+        random.shuffle(training)
+        total_loss = 0.0
+        for start in range(0, len(training), batch_size):
+            batch = training[start:start + batch_size]
+            images = torch.from_numpy(np.stack([augment(strip) for strip, _, _ in batch]))
+            targets = [encode_text(label) for _, label, _ in batch]
+
+            log_probs = model(images).log_softmax(2).permute(1, 0, 2)  # (time, batch, classes) for CTCLoss
+            loss = ctc_loss(log_probs, torch.tensor([c for t in targets for c in t]),
+                            torch.full((len(batch),), log_probs.shape[0], dtype=torch.long),
+                            torch.tensor([len(t) for t in targets]))
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            total_loss += loss.item() * len(batch)
+
+        print(f"Epoch {epoch + 1}/{epochs}: loss {total_loss / len(training):.3f}")
+
+    export_onnx(model, output_path)
+    if validation:
+        evaluate(output_path, validation)
+    return output_path
+
+
+def export_onnx(model, output_path):
+
+    import torch
+
+    model.eval()
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    torch.onnx.export(model, torch.zeros(2, 1, strip_height, strip_width), output_path,  # batch > 1, or it is fixed to 1
+                      input_names=["strip"], output_names=["logits"],
+                      dynamic_axes={"strip": {0: "batch"}, "logits": {0: "batch"}}, opset_version=17)
+    print(f"Model saved to {output_path}")
+
+############################################################################################
+# Inference (onnxruntime, CPU)
+############################################################################################
+
+_sessions = {}
+
+def load_recognizer(path=None):
+
+    path = path or model_path
+    if path not in _sessions:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = inference_threads
+        _sessions[path] = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    return _sessions[path]
+
+
+def recognize(chip_images, session=None):
+
+    # Chip crops (BGR or gray) -> list of (text, confidence), one forward pass for all
+    session = session or load_recognizer()
+    strips = np.stack([make_strip(image) for image in chip_images])
+    logits = session.run(None, {"strip": strips})[0]
+    return [decode_logits(chip_logits) for chip_logits in logits]
+
+
+def evaluate(path, samples):
+
+    session = load_recognizer(path)
+    start_time = time.time()
+    logits = session.run(None, {"strip": np.stack([strip for strip, _, _ in samples])})[0]
+    elapsed = time.time() - start_time
+
+    exact = sum(decode_logits(chip_logits)[0] == label for chip_logits, (_, label, _) in zip(logits, samples))
+    print(f"{exact}/{len(samples)} markings read exactly ({100 * exact / len(samples):.1f} %), "
+          f"{1000 * elapsed / len(samples):.1f} ms per chip")
+    for chip_logits, (_, label, board) in list(zip(logits, samples))[:10]:
+        text, confidence = decode_logits(chip_logits)
+        if text != label:
+            print(f"  {board}: read '{text}' ({confidence:.2f}), expected '{label}'")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="CPU chip marking recognizer (CRNN/CTC, ONNX)")
+    parser.add_argument("--model", default=model_path)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="train on the verified chip crops of BASE_DIR")
+    train_parser.add_argument("--base-dir", default="results")
+    train_parser.add_argument("--epochs", type=int, default=60)
+    eval_parser = subparsers.add_parser("eval", help="accuracy and speed on the verified chip crops of BASE_DIR")
+    eval_parser.add_argument("--base-dir", default="results")
+    read_parser = subparsers.add_parser("read", help="read chip crops")
+    read_parser.add_argument("images", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train(args.base_dir, args.epochs, args.model)
+    elif args.command == "eval":
+        evaluate(args.model, load_samples(args.base_dir))
+    elif args.command == "read":
+        images = [cv2.imread(path) for path in args.images]
+        for path, (text, confidence) in zip(args.images, recognize(images, load_recognizer(args.model))):
+            print(f"{path}: {text} ({confidence:.2f})")
@@ -0,0 +1,205 @@
+# Chip markings of the FEMB: what each chip position holds, which fields its
+# marking has, and how OCR results are corrected and validated.
+
+# Shared by the pipeline scripts; only needs the standard library, so quick
+# tasks (e.g. produce_json.py) do not load OpenCV or the barcode/OCR backends.
+
+import re
+
+
+# Chip type for each position, same order as the chip coordinates in crop_chips_FEMB.py
+chip_types = {
+    "front": ["COLDATA", "COLDATA", "ColdADC", "ColdADC", "ColdADC", "ColdADC",
+              "LArASIC", "LArASIC", "LArASIC", "LArASIC"],
+    "back": ["ColdADC", "ColdADC", "ColdADC", "ColdADC",
+             "LArASIC", "LArASIC", "LArASIC", "LArASIC"],
+}
+
+# Fixed part of each chip marking, not requested from the model in 'json' mode
+chip_marking_prefix = {
+    "COLDATA": "COLDATA",
+    "ColdADC": "ColdADC",
+    "LArASIC": "BNL LArASIC Version",
+}
+
+# Variable fields of each chip marking, in reading order.
+# Patterns follow the groups of the regex in validate_ocr_result.
+chip_fields = {
+    "COLDATA": [("lot", r"^[A-Za-z0-9]+\.[A-Za-z0-9]+$"), ("serial", r"^\d{5}$"), ("date", r"^\d{4}$")],
+    "ColdADC": [("lot", r"^[A-Za-z0-9]+\.[A-Za-z0-9]+$"), ("serial", r"^\d{5}$"), ("date", r"^\d{4}$")],
+    "LArASIC": [("version", r"^[A-Z0-9]+$"), ("date", r"^\d{2}/\d{2}$"), ("serial", r"^\d{3}-\d{5}$")],
+}
+
+# Expected serial-number format of each chip type
+chip_sn_patterns = {
+    "COLDATA": r"^\d{5}$",
+    "ColdADC": r"^\d{5}$",
+    "LArASIC": r"^\d{3}-\d{5}$",
+}
+
+
+############################################################################################
+
+def get_chip_type(chip_number, side):
+
+    types = chip_types.get(side, [])
+    return types[chip_number] if 0 <= chip_number < len(types) else None
+
+############################################################################################
+
+# Function to pick the fields to read from a chip, either the full marking
+# or only the serial number (for the serial-number strip of a chip):
+def get_ocr_fields(chip_type, sn_only=False):
+
+    fields = chip_fields[chip_type]
+    if sn_only:
+        return [(name, pattern) for name, pattern in fields if name == "serial"]
+    return fields
+
+############################################################################################
+
+def sanitize_filename(filename):
+     # Replace slashes with underscores first to avoid directory paths
+    filename = filename.replace('/', '_')
+    # Replace any character that is not alphanumeric, an underscore, or a dot with an underscore
+    invalid_chars = '<>:"/\\|?*'
+    return "".join([c if c.isalnum() or c in ['_', '.'] else '_' for c in filename if c not in invalid_chars])
+
+############################################################################################
+
+def extract_date_from_filename(filename):
+    match = re.search(r'--(\d{2}-\d{2}-\d{4})', filename)
+    return match.group(1) if match else "Unknown date"
+
+############################################################################################
+
+def count_chips(result_filename):
+
+    with open(result_filename, 'r', encoding='utf-8') as file:
+        content = file.read()
+    return content.count('*')
+
+############################################################################################
+
+def correct_ocr(ocr_result, chip_number, side):
+    # Define expected spaces based on side and chip number
+    if side == "front":
+        if chip_number in [0, 1]:       # COLDATA 1 and 2 on the front side
+            max_spaces = 3
+        elif chip_number in [2, 3, 4, 5]:  # ColdADC 1-4 on the front side
+            max_spaces = 3
+        elif chip_number in [6, 7, 8, 9]:  # LArASIC 1-4 on the front side
+            max_spaces = 5
+        else:
+            print(f"Warning: Chip number {chip_number} invalid for front side.")
+            return ocr_result
+    elif side == "back":
+        if chip_number in [0, 1, 2, 3]:    # ColdADC 1-4 on the back side
+            max_spaces = 3
+        elif chip_number in [4, 5, 6, 7]:  # LArASIC 1-4 on the back side
+            max_spaces = 5
+        else:
+            print(f"Warning: Chip number {chip_number} invalid for back side.")
+            return ocr_result
+    else:
+        print("Warning: Invalid side specified.")
+        return ocr_result
+
+    # Count spaces in the OCR result
+    space_count = ocr_result.count(" ")
+
+
+    # Automatically replace specific incorrect variants of "ColdADC" for specified chips
+    if (side == "front" and chip_number in [2, 3, 4, 5]) or (side == "back" and chip_number in [0, 1, 2, 3]):
+        ocr_result = re.sub(r"\b(Col dADC|Co1 dADC|Cold ADC|Co1d ADC|CoI dADC)\b", "ColdADC", ocr_result)
+    #if (side == "front" and chip_number in [6, 7, 8, 9]) or (side == "back" and chip_number in [4, 5, 6, 7]):
+    #    ocr_result = re.sub(r"\b(BNl.)\b", "BNL ", ocr_result)
+
+    # Correcting Serial Number impurities: Remove "-" or "." from serial numbers for specified chips
+    lines = ocr_result.replace(" ", "\n").split("\n")
+
+    if side == "front":
+        # Serial numbers for front chips 0, 1, 2-5, and 6-9
+        if chip_number in [0, 1] or chip_number in [2, 3, 4, 5]:  # line 3
+            serial_number_line_index = 2
+        elif chip_number in [6, 7, 8, 9]:  # line 6
+            serial_number_line_index = 5
+    elif side == "back":
+        if chip_number in [0, 1, 2, 3]:  # line 3
+            serial_number_line_index = 2
+        elif chip_number in [4, 5, 6, 7]:  # line 6
+            serial_number_line_index = 5
+
+    # Apply the correction if we are in the specified range and line exists
+    if serial_number_line_index < len(lines):
+        if side == "front" and chip_number in [0, 1, 2, 3, 4, 5] or side == "back" and chip_number in [0, 1, 2, 3]:
+            # Remove any impurities in the serial number for these specific chips
+            lines[serial_number_line_index] = re.sub(r"[-.']", "", lines[serial_number_line_index])
+
+    #return ocr_result
+    # Reconstruct the corrected OCR result by replacing newlines with spaces
+    corrected_result = " ".join(lines)
+    return corrected_result
+
+############################################################################################
+
+def validate_ocr_result(ocr_result, chip_number, side):
+
+    # Correct OCR result for extra or missing spaces
+    corrected_ocr_result = correct_ocr(ocr_result, chip_number, side)
+
+
+    # Define regex patterns based on the chip number and side
+    patterns = {
+        "front": {
+            "COLDATA": re.compile(r"^(COLDATA|colddata|ColdData|CO1DATA)\s+([A-Za-z0-9]+\.[A-Za-z0-9]+)\s+(\d{5})\s+(\d{4})$"),
+            "ColdADC": re.compile(r"^(ColdADC|coldadc|Coldadc|Co1dADC|ColADC|CoIdADC)\s+([A-Za-z0-9]+\.[A-Za-z0-9]+)\s+(\d{5})\s+(\d{4})$"),
+            "LArASIC": re.compile(r"^BNL\s+LArASIC\s+Version\s+([A-Z0-9]+)\s+(\d{2}/\d{2})\s+(\d{3}-\d{5})$")
+        },
+        "back": {
+            "ColdADC": re.compile(r"^(ColdADC|coldadc|Coldadc|Co1dADC|ColADC|CoIdADC)\s+([A-Za-z0-9]+\.[A-Za-z0-9]+)\s+(\d{5})\s+(\d{4})$"),
+            "LArASIC": re.compile(r"^BNL\s+LArASIC\s+Version\s+([A-Z0-9]+)\s+(\d{2}/\d{2})\s+(\d{3}-\d{5})$")
+        }
+    }
+        # TO DO: Include "BNL.", "Version."
+
+    # Determine chip type based on chip number and side
+    if side == "front":
+        if chip_number in [0, 1]:
+            pattern = patterns["front"]["COLDATA"]
+        elif chip_number in [2, 3, 4, 5]:
+            pattern = patterns["front"]["ColdADC"]
+        elif chip_number in [6, 7, 8, 9]:
+            pattern = patterns["front"]["LArASIC"]
+        else:
+            print("Warning: Invalid chip number for front side")
+            return False
+
+    elif side == "back":
+        if chip_number in [0, 1, 2, 3]:
+            pattern = patterns["back"]["ColdADC"]
+        elif chip_number in [4, 5, 6, 7]:
+            pattern = patterns["back"]["LArASIC"]
+        else:
+            print("Warning: Invalid chip number for back side")
+            return False
+    else:
+        print("Warning: Invalid side specified")
+        return False
+
+    # Validate OCR result
+    match = pattern.match(corrected_ocr_result) #was ocr_result
+    valid = bool(match)
+    if not match:
+        print("(!) WARNING: check OCR result")
+
+    # Validate the serial number format
+    if side == "front" and chip_number in [6, 7, 8, 9] or side == "back" and chip_number in [4, 5, 6, 7]:
+        components = corrected_ocr_result.split()
+        if components:
+            serial_number = components[-1]  # Expected to be the last component for LArASIC
+            if not re.match(r"^\d{3}-\d{5}$", serial_number):
+                print("(!) ERROR: Serial Number needs correction!")
+                valid = False
+
+    return valid
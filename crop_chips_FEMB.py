@@ -10,15 +10,36 @@ import numpy as np
 from PIL import Image
 import re
 import os
+import random
+import time
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 import base64
 import io
 
-from pylibdmtx.pylibdmtx import decode as decode_dm
-from qreader import QReader
+# (the QR/DM decoders are imported in read_barcode, only the chosen one is loaded)
+
+from artifact_writer import write_artifact, write_artifact_now, flush_artifacts
+from chip_specs import (chip_marking_prefix, chip_fields, chip_sn_patterns, get_chip_type,
+                        get_ocr_fields, sanitize_filename, extract_date_from_filename, count_chips,
+                        correct_ocr, validate_ocr_result)
+import job_store
+import ocr_client
+import board_archive
+import generation_limits
+import hwdb_stream
+import results_index
+import review_queue
 
 
-import pandas as pd
 import requests
 import json
 
@@ -50,32 +71,235 @@ def encode_image(image):
 
 
 
+# Function to build the JSON schema sent as the server's "format" option,
+# so the model can only emit the expected fields for this chip type:
+def build_ocr_schema(fields):
+
+    return {
+        "type": "object",
+        "properties": {name: {"type": "string", "pattern": pattern} for name, pattern in fields},
+        "required": [name for name, _ in fields],
+    }
+
+
+
+# Function to turn a structured OCR answer back into a one-line result,
+# the same format the free-text mode produces:
+def join_ocr_fields(ocr_json, chip_type, sn_only=False):
+
+    fields = json.loads(ocr_json)
+    values = [str(fields.get(name, "")).strip() for name, _ in get_ocr_fields(chip_type, sn_only)]
+
+    if sn_only:
+        return " ".join(values)
+    return " ".join([chip_marking_prefix[chip_type]] + values)
+
+
+
+# OCR latency of every request of the current board (see print_ocr_timing_summary)
+ocr_timings = []
+
+# Generation settings and length of the last answer, per OCR thread (for generation_limits.py)
+_last_generation = threading.local()
+
+def record_ocr_timing(chip_type, start_time, first_token_time=None, tokens=0, eval_seconds=None, early_stop=False, limits=None, key=None):
+
+    total = time.time() - start_time
+
+    # Generation time reported by the server; an early-stopped stream has none, and its
+    # wall time includes the network time of the aborted stream, so no tokens/s then
+    generation_time = eval_seconds
+    if generation_time is None and first_token_time and not early_stop:
+        generation_time = time.time() - first_token_time
+
+    ocr_timings.append({
+        "chip_type": chip_type,
+        "total": total,
+        "ttft": first_token_time - start_time if first_token_time else None,
+        "tokens": tokens,
+        "tokens_per_s": tokens / generation_time if tokens and generation_time else None,
+        "early_stop": early_stop,
+        "limits": limits,
+    })
+    _last_generation.info = {"key": key, "tokens": tokens, "limits": limits} if limits else None
+
+
+
+def print_ocr_timing_summary():
+
+    if not ocr_timings:
+        return
+
+    def mean(values):
+        values = [v for v in values if v is not None]
+        return sum(values) / len(values) if values else None
+
+    def fmt(value, unit):
+        return f"{value:.2f} {unit}" if value is not None else "n/a"
+
+    # Cold start (first request, model possibly still loading) against steady state
+    if len(ocr_timings) > 1:
+        print(f"First OCR request {fmt(ocr_timings[0]['total'], 's')}, "
+              f"steady state {fmt(mean(t['total'] for t in ocr_timings[1:]), 's')} per request")
+
+    print(f"OCR requests: {len(ocr_timings)}, "
+          f"mean latency {fmt(mean(t['total'] for t in ocr_timings), 's')}, "
+          f"mean time to first token {fmt(mean(t['ttft'] for t in ocr_timings), 's')}, "
+          f"mean {fmt(mean(t['tokens_per_s'] for t in ocr_timings), 'tokens/s')}, "
+          f"early stops {sum(t['early_stop'] for t in ocr_timings)}")
+
+    # Latency per chip type and generation settings (defaults against the tuned limits)
+    groups = {}
+    for t in ocr_timings:
+        if t.get("limits"):
+            groups.setdefault((t["chip_type"] or "", generation_limits.describe_limits(t["limits"])), []).append(t)
+    for (chip_type, settings), timings in sorted(groups.items()):
+        print(f"  {chip_type}, {settings}: {len(timings)} requests, mean latency {fmt(mean(t['total'] for t in timings), 's')}, "
+              f"mean {fmt(mean(t['tokens'] for t in timings), 'tokens')}")
+
+
+
+# Model warm-up, started once per run in the background (see start_warm_up)
+_warm_up_thread = None
+
+def start_warm_up():
+
+    global _warm_up_thread
+    if _warm_up_thread is not None or not warm_up_model:
+        return
+
+    def warm_up():
+        for url, load_time in ocr_client.warm_up(minicpm_urls, minicpm_model, ocr_keep_alive).items():
+            print(f"Model ready on {url} after {load_time:.1f} s (cold start)")
+
+    _warm_up_thread = threading.Thread(target=warm_up, name="model-warm-up", daemon=True)
+    _warm_up_thread.start()
+
+
+def wait_for_warm_up():
+
+    if _warm_up_thread is not None:
+        _warm_up_thread.join()
+
+
+
+# Function to check whether a partial OCR answer already holds every expected field:
+def is_ocr_complete(text, chip_type, sn_only=False, structured=False):
+
+    if chip_type not in chip_fields:
+        return False
+
+    fields = get_ocr_fields(chip_type, sn_only)
+
+    if structured:
+        try:
+            values = json.loads(text)
+        except json.JSONDecodeError:
+            return False
+        return all(name in values for name, _ in fields)
+
+    # Enough words for the whole marking, and the last field already complete
+    words = text.split()
+    expected_words = len(fields) if sn_only else len(chip_marking_prefix[chip_type].split()) + len(fields)
+    last_pattern = fields[-1][1]
+    return len(words) >= expected_words and re.match(last_pattern, words[-1]) is not None
+
+
+
+# Function to read a streamed answer token by token, stopping (and cancelling
+# the generation) as soon as the expected fields are complete:
+def read_ocr_stream(data, chip_type, sn_only, structured, limits=None, key=None):
+
+    start_time = time.time()
+    response = ocr_client.post_generate(minicpm_urls, data, stream=True)
+    if response is None:
+        return "Error: API request failed"
+
+    if response.status_code != 200:
+        print(f"Error {response.status_code}: {response.text}")
+        return "Error: API request failed"
+
+    text = ""
+    first_token_time = None
+    tokens = 0
+    eval_seconds = None
+    early_stop = False
+    stream_ok = False
+
+    try:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+
+            token = chunk.get("response", "")
+            if token:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                tokens += 1
+                text += token
+
+            if chunk.get("done"):
+                if chunk.get("eval_duration"):
+                    tokens = chunk.get("eval_count", tokens)
+                    eval_seconds = chunk["eval_duration"] / 1e9
+                break
+
+            if is_ocr_complete(text, chip_type, sn_only, structured):
+                early_stop = True
+                break
+        stream_ok = True
+    except (json.JSONDecodeError, requests.RequestException) as e:
+        print(f"Error reading OCR stream: {e}")
+        return "Error: Unable to process OCR"
+    finally:
+        # Closing the connection makes the server stop generating
+        ocr_client.finish_stream(response, stream_ok)
+
+    record_ocr_timing(chip_type, start_time, first_token_time, tokens, eval_seconds, early_stop, limits, key)
+
+    if not text.strip():
+        return "Error: Empty OCR response"
+    if structured:
+        try:
+            return join_ocr_fields(text, chip_type, sn_only)
+        except json.JSONDecodeError as e:
+            print(f"Error parsing JSON: {e}")
+            return "Error: Unable to process OCR"
+    return text.strip()
+
+
+
 # Function to perform OCR using MiniCPM API
-def perform_ocr_minicpm(image_path):
+def perform_ocr_minicpm(image_path, chip_type=None, sn_only=False, tuned=True):
 
-    # Load and encode the image
-    image = Image.open(image_path)
+    # Load and encode the image (a path, or an already cropped PIL image)
+    image = image_path if isinstance(image_path, Image.Image) else Image.open(image_path)
     encoded_image = encode_image(image)
 
-    # API:
-    url = "http://localhost:XXXXX/api/generate"
+    # Structured output only if we know what this chip should say:
+    structured = ocr_output_mode == 'json' and chip_type in chip_fields
 
-    headers = {
-        "Content-Type": "application/json",
-    }
+    # Token cap and decoding learned for this chip type (tuned=False: the defaults)
+    key = generation_limits.generation_key(chip_type, sn_only, structured)
+    if tune_generation and tuned:
+        limits = generation_limits.get_limits(get_limit_stats(), key)
+    else:
+        limits = dict(generation_limits.DEFAULT_LIMITS)
 
     # Set up:
     data = {
-        "model": "aiden_lu/minicpm-v2.6:Q4_K_M",
+        "model": minicpm_model,
+        "keep_alive": ocr_keep_alive,
         "prompt": "Please OCR this image with all output texts in one line with no space",
         "images": [encoded_image],
         "sampling": False,
         "stream": False,
-        "num_beams": 3,
+        "num_beams": limits["num_beams"],
         "repetition_penalty": 1.2,
-        "max_new_tokens": 2048,
+        "max_new_tokens": limits["max_new_tokens"],
         "max_inp_length": 4352,
-        "decode_type": "beam_search",
+        "decode_type": limits["decode_type"],
         "options": {
             "seed": 42,
             "temperature": 0.0,
@@ -83,12 +307,28 @@ def perform_ocr_minicpm(image_path):
             "top_k": 10,
             "repeat_penalty": 1.0,
             "repeat_last_n": 0,
-            "num_predict": 42,
+            "num_predict": limits["num_predict"],
         },
     }
 
-    # Send the request to MiniCPM API
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    if sn_only:
+        data["prompt"] = "Please OCR the serial number in this image in one line with no space"
+
+    if structured:
+        fields = get_ocr_fields(chip_type, sn_only)
+        field_names = ", ".join(name for name, _ in fields)
+        data["prompt"] = f"Please OCR this {chip_type} chip marking and return the fields {field_names} as JSON"
+        data["format"] = build_ocr_schema(fields)
+
+    if ocr_stream:
+        data["stream"] = True
+        return read_ocr_stream(data, chip_type, sn_only, structured, limits, key)
+
+    # Send the request to MiniCPM API (timeouts, retries and fallback endpoints in ocr_client)
+    start_time = time.time()
+    response = ocr_client.post_generate(minicpm_urls, data)
+    if response is None:
+        return "Error: API request failed"
 
     # Process the response
     if response.status_code == 200:
@@ -98,18 +338,62 @@ def perform_ocr_minicpm(image_path):
                 data = json.loads(line)
                 actual_response = data.get("response", "")
                 if actual_response:
+                    eval_seconds = data["eval_duration"] / 1e9 if data.get("eval_duration") else None
+                    record_ocr_timing(chip_type, start_time, tokens=data.get("eval_count", 0), eval_seconds=eval_seconds,
+                                      limits=limits, key=key)
+                    if structured:
+                        return join_ocr_fields(actual_response, chip_type, sn_only)
                     return actual_response.strip()
         except json.JSONDecodeError as e:
             print(f"Error parsing JSON: {e}")
             return "Error: Unable to process OCR"
+        return "Error: Empty OCR response"
     else:
         print(f"Error {response.status_code}: {response.text}")
         return "Error: API request failed"
 
 
+# Configuration variable: MiniCPM API endpoints (several local model servers can be listed)
+minicpm_urls = [
+    "http://localhost:XXXXX/api/generate",
+]
+minicpm_model = "aiden_lu/minicpm-v2.6:Q4_K_M"
+
+# Configuration variable: load the model at startup (while the images are decoded)
+# and keep it resident on the server for this long after the last request
+warm_up_model = True
+ocr_keep_alive = "30m"
+
+# Configuration variable: stream the answer and stop reading as soon as the expected
+# fields of the chip are complete (also records time to first token and tokens/s)
+ocr_stream = False
+
+# Configuration variable: learn the token cap and the decoding (greedy or beam search)
+# of each chip type from the readings that passed validation (generation_limits.py,
+# results/generation_stats.json); readings failing validation are read again with the defaults
+tune_generation = True
+
 # Configuration variable: Choose between 'QR' or 'DM' (Data Matrix)
 barcode_type = 'DM'
 
+# Configuration variable: OCR output mode, 'text' (free text, corrected afterwards)
+# or 'json' (structured output constrained to the expected fields of each chip type)
+ocr_output_mode = 'text'
+
+# Configuration variable: OCR only the serial-number line of these chip types.
+# The full marking is still read when the serial number fails validation, and
+# for a random fraction of the chips (to keep an eye on the strip OCR).
+sn_only_chip_types = []  # e.g. ['LArASIC']
+full_marking_sample_rate = 0.1
+
+# Configuration variable: OCR engine, 'minicpm' (model servers) or 'crnn' (the
+# small CPU recognizer of chip_recognizer.py, trained on our own crops). With
+# 'crnn', the chips it is not sure about (low confidence, or a reading that
+# fails validation) still go to MiniCPM.
+ocr_engine = 'minicpm'
+crnn_model_path = os.path.join("models", "chip_crnn.onnx")
+crnn_min_confidence = 0.9
+
 
 # Define the positions for QR and DM
 qr_position = (1048, 1497, 142, 142)
@@ -141,9 +425,32 @@ chip_coordinates_back = [
     (3063,1788,287,292), #LArASIC 4
 ]
 
+# Serial-number line of each chip type, as (x, y, w, h) fractions of the
+# rotated chip image. Adjust these if the chip coordinates above change.
+chip_sn_roi = {
+    "LArASIC": (0.0, 0.76, 1.0, 0.24),
+}
+
+# Optional perspective correction of each side, as a 3x3 homography from the
+# ideal (square-on) board, where the chip coordinates above are defined, to the photo.
+# e.g. {"front": cv2.getPerspectiveTransform(ideal_corners, photo_corners)}
+chip_perspective = {}
+
 ## ----------------------------------------------------##
 
 
+########################################################################
+
+# QR detector, loaded once and kept for the whole run
+_qreader = None
+
+def get_qreader():
+    global _qreader
+    if _qreader is None:
+        from qreader import QReader  # pulls in torch, only when QR codes are used
+        _qreader = QReader()
+    return _qreader
+
 ########################################################################
 
 def read_barcode(image, position, barcode_type):
@@ -151,7 +458,7 @@ def read_barcode(image, position, barcode_type):
     cropped_image = image[y:y+h, x:x+w]
 
     if barcode_type == 'QR':
-        qreader = QReader()
+        qreader = get_qreader()
         try:
             data = qreader.detect_and_decode(image=cropped_image)
             if data:
@@ -166,6 +473,7 @@ def read_barcode(image, position, barcode_type):
         cv2.imwrite(f'cropped/QR_code.png', cropped_image)
 
     elif barcode_type == 'DM':
+        from pylibdmtx.pylibdmtx import decode as decode_dm
         dm_image = Image.fromarray(cropped_image)  # Convert to PIL Image format
         results = decode_dm(dm_image)
         if results:
@@ -185,32 +493,290 @@ def save_barcode_image(image, position, barcode_type, directory_name):
     x, y, w, h = position
     cropped_image = image[y:y+h, x:x+w]
 
+    # (copy, so the queued crop does not keep the full frame alive)
     if barcode_type == 'QR':
-        cv2.imwrite(f'{directory_name}/QR_code.png', cropped_image)
+        write_artifact(f'{directory_name}/QR_code.png', cropped_image.copy())
     elif barcode_type == 'DM':
-        cv2.imwrite(f'{directory_name}/DM_code.png', cropped_image)
+        write_artifact(f'{directory_name}/DM_code.png', cropped_image.copy())
     else:
         return "Invalid barcode type specified!"
 
 
 ####################################################################
 
-def sanitize_filename(filename):
-     # Replace slashes with underscores first to avoid directory paths
-    filename = filename.replace('/', '_')
-    # Replace any character that is not alphanumeric, an underscore, or a dot with an underscore
-    invalid_chars = '<>:"/\\|?*'
-    return "".join([c if c.isalnum() or c in ['_', '.'] else '_' for c in filename if c not in invalid_chars])
+_crop_plans = {}
+
+def get_crop_plan(image_shape, chip_coordinates, homography=None):
+
+    # Crop plan of one layout, computed once and reused for every board:
+    # chips of the same size are grouped, each group has a preallocated buffer
+    # (chips, w, h, 3) and every chip its source slices. With a homography
+    # (ideal board -> photo, e.g. from cv2.getPerspectiveTransform) each chip
+    # gets a cv2.remap map instead, with the rotation and the perspective
+    # correction baked in.
+    key = (image_shape, tuple(map(tuple, chip_coordinates)), None if homography is None else np.asarray(homography).tobytes())
+    if key in _crop_plans:
+        return _crop_plans[key]
+
+    # A chip running past the image would come out smaller than its buffer slot
+    # (only the homography maps read outside the image, with the border replicated)
+    if homography is None:
+        for i, (x, y, w, h) in enumerate(chip_coordinates):
+            if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > image_shape[1] or y + h > image_shape[0]:
+                raise ValueError(f"chip {i} at {(x, y, w, h)} is outside the {image_shape[1]}x{image_shape[0]} image")
+
+    groups = {}
+    for i, (x, y, w, h) in enumerate(chip_coordinates):
+        groups.setdefault((w, h), []).append((i, x, y))
+
+    plan = []
+    for (w, h), chips in groups.items():
+        buffer = np.empty((len(chips), w, h, 3), dtype=np.uint8)
+
+        if homography is None:
+            sources = [(slice(y, y + h), slice(x, x + w)) for _, x, y in chips]
+            remap = None
+        else:
+            # Rotated 90 degrees clockwise: out[r, c] = chip[h - 1 - c, r]
+            r = np.arange(w, dtype=np.float32)[None, :, None]
+            c = np.arange(h, dtype=np.float32)[None, None, :]
+            xs = np.array([x for _, x, _ in chips], dtype=np.float32)[:, None, None]
+            ys = np.array([y for _, _, y in chips], dtype=np.float32)[:, None, None]
+            ideal = np.stack(np.broadcast_arrays(xs + r, ys + h - 1 - c), axis=-1)
+            warped = cv2.perspectiveTransform(ideal.reshape(-1, 1, 2), np.asarray(homography, dtype=np.float64))
+            warped = warped.reshape(len(chips), w, h, 2)
+            sources = None
+            remap = [cv2.convertMaps(np.ascontiguousarray(warped[j, :, :, 0]), np.ascontiguousarray(warped[j, :, :, 1]),
+                                     cv2.CV_16SC2) for j in range(len(chips))]
+
+        plan.append(([i for i, _, _ in chips], buffer, sources, remap))
+
+    _crop_plans[key] = plan
+    return plan
+
+
+def crop_chips(image, chip_coordinates, homography=None):
+
+    # All chips of one side, rotated, in chip order. The crops are views of the
+    # plan buffers: they stay valid until the next board with the same layout is
+    # cropped (its artifacts are flushed before that, in main_process/preprocess_board).
+    plan = get_crop_plan(image.shape, chip_coordinates, homography)
+
+    rotated_chips = [None] * len(chip_coordinates)
+    for chip_indices, buffer, sources, remap in plan:
+        for j, i in enumerate(chip_indices):
+            slot = buffer[j]
+            if remap is None:
+                rotated = cv2.rotate(image[sources[j]], cv2.ROTATE_90_CLOCKWISE, dst=slot)
+            else:
+                rotated = cv2.remap(image, remap[j][0], remap[j][1], cv2.INTER_LINEAR, dst=slot,
+                                    borderMode=cv2.BORDER_REPLICATE)
+            # OpenCV allocates a new array when the result does not fit the slot
+            # (then the slot still holds the previous board): keep that one
+            rotated_chips[i] = slot if rotated is slot else rotated
+
+    return rotated_chips
+
+####################################################################
+
+_job_store = None
+
+def get_job_store():
+    global _job_store
+    if _job_store is None:
+        _job_store = job_store.open_job_store()
+    return _job_store
+
+####################################################################
+
+_results_index = None
+
+def get_results_index():
+    global _results_index
+    if _results_index is None:
+        _results_index = results_index.open_index()
+    return _results_index
+
+####################################################################
+
+_generation_stats = None  # saved to generation_limits.generation_stats_path
+_limit_stats = None       # the same plus the baseline file (generation_limits.baseline_stats_path)
+
+def get_generation_stats():
+    global _generation_stats, _limit_stats
+    if _generation_stats is None:
+        _generation_stats = generation_limits.load_stats()
+        _limit_stats = _generation_stats
+        if generation_limits.baseline_stats_path:
+            _limit_stats = generation_limits.merge_stats(
+                generation_limits.load_stats(generation_limits.baseline_stats_path), _generation_stats)
+    return _generation_stats
+
+
+def get_limit_stats():
+    get_generation_stats()
+    return _limit_stats
+
+
+def record_generation(key, tokens, valid, decode_type):
+    generation_limits.record(get_generation_stats(), key, tokens, valid, decode_type)
+    if _limit_stats is not _generation_stats:
+        generation_limits.record(_limit_stats, key, tokens, valid, decode_type)
+
+####################################################################
+
+_review_queue = None
+
+def get_review_queue():
+    global _review_queue
+    if _review_queue is None:
+        _review_queue = review_queue.open_review_queue()
+    return _review_queue
+
+####################################################################
+
+def get_stored_chip(board_key, side, chip_number):
+
+    # OCR result of this chip from a previous (interrupted) run, if any
+    if board_key is None or not reuse_checkpoints:
+        return None
+    stored = job_store.get_chip(get_job_store(), board_key, side, chip_number)
+    if stored and stored["state"] in ("ocr_done", "validated"):
+        return stored
+    return None
+
+
+def checkpoint_chip(board_key, side, chip_number, state, ocr_result=None, sn_only=False, error=None):
+
+    if board_key is not None:
+        job_store.record_chip(get_job_store(), board_key, side, chip_number, state, ocr_result, sn_only, error)
+
+####################################################################
+
+def perform_ocr_with_retries(chip_image, chip_type, board_key, side, chip_number, tuned=True):
+
+    for attempt in range(ocr_max_retries + 1):
+        if attempt:
+            delay = ocr_retry_backoff * 2 ** (attempt - 1)
+            print(f"Retrying Chip #{chip_number} [{side}] in {delay:.0f} s (attempt {attempt + 1})...")
+            time.sleep(delay)
+
+        try:
+            ocr_result = perform_ocr_minicpm(chip_image, chip_type, tuned=tuned)
+        except requests.RequestException as e:
+            ocr_result = f"Error: {e}"
+
+        if ocr_result and not ocr_result.startswith("Error"):
+            return ocr_result
+
+        checkpoint_chip(board_key, side, chip_number, 'failed', error=ocr_result or "Empty OCR response")
+
+    return ocr_result or "Error: Empty OCR response"
+
+####################################################################
+
+_crnn_session = None
+_crnn_unavailable = False
+_crnn_lock = threading.Lock()
+
+def get_crnn_session():
+
+    # Loaded once for all OCR threads; None (reported once) when the model or
+    # onnxruntime is missing, then every chip goes to MiniCPM
+    global _crnn_session, _crnn_unavailable
+    with _crnn_lock:
+        if _crnn_session is None and not _crnn_unavailable:
+            try:
+                import chip_recognizer
+                _crnn_session = chip_recognizer.load_recognizer(crnn_model_path)
+            except Exception as e:
+                _crnn_unavailable = True
+                print(f"Error: CRNN recognizer unavailable ({e}), reading every chip with MiniCPM")
+    return _crnn_session
+
+
+def read_chip_crnn(rotated_chip, chip_type, side, chip_number):
+
+    # Reading of the CPU recognizer, or None when MiniCPM has to read the chip
+    session = get_crnn_session()
+    if session is None:
+        return None
+
+    import chip_recognizer
+
+    text, confidence = chip_recognizer.recognize([rotated_chip], session)[0]
+    _, valid = results_index.split_fields(correct_ocr(text, chip_number=chip_number, side=side), chip_type)
+    if confidence < crnn_min_confidence or not valid:
+        print(f"CRNN not sure about Chip #{chip_number} [{side}] ('{text}', {confidence:.2f}), asking MiniCPM")
+        return None
+    return text
+
+####################################################################
+
+def read_chip(i, rotated_chip, file_suffix, directory_name, board_key, preprocessed):
+
+    # OCR of one chip, run concurrently for all chips of a side
+
+    if not preprocessed:
+        ## Save the processed chip image to a file (the worker already did in batch mode)
+        write_artifact(os.path.join(directory_name, f'{file_suffix}_chip_{i}.png'), rotated_chip)
+
+    chip_type = get_chip_type(i, file_suffix)
+
+    # Chip already read before this run was interrupted?
+    stored = get_stored_chip(board_key, file_suffix, i)
+
+    # Serial number only, for the configured chip types:
+    serial_number = None
+    sn_generation = None
+    read_full_marking = True
+    if stored:
+        if stored["sn_only"]:
+            serial_number, read_full_marking = stored["ocr_result"], False
+    elif chip_type in sn_only_chip_types:
+        _last_generation.info = None
+        serial_number = read_chip_sn_only(rotated_chip, i, file_suffix, directory_name)
+        if getattr(_last_generation, "info", None):
+            # Strip readings have their own generation limits (valid: matched the serial number pattern)
+            sn_generation = dict(_last_generation.info, valid=serial_number is not None)
+        read_full_marking = random.random() < full_marking_sample_rate
+        if serial_number and not read_full_marking:
+            checkpoint_chip(board_key, file_suffix, i, 'validated', serial_number, sn_only=True)
+
+    if serial_number and not read_full_marking:
+        return {"serial_number": serial_number, "sn_only": True, "from_store": bool(stored), "sn_generation": sn_generation}
+
+    # Perform OCR (or reuse the stored result)
+    _last_generation.info = None
+    if stored and not stored["sn_only"]:
+        ocr_result = stored["ocr_result"]
+    else:
+        ocr_result = read_chip_crnn(rotated_chip, chip_type, file_suffix, i) if ocr_engine == 'crnn' else None
+        if ocr_result is None:
+            # OCR straight from memory, without waiting for the PNG on disk
+            chip_image = Image.fromarray(cv2.cvtColor(rotated_chip, cv2.COLOR_BGR2RGB))
+            ocr_result = perform_ocr_with_retries(chip_image, chip_type, board_key, file_suffix, i)
+
+    return {"ocr_result": ocr_result, "serial_number": serial_number, "sn_only": False, "from_store": bool(stored),
+            "generation": getattr(_last_generation, "info", None), "sn_generation": sn_generation}
 
 ####################################################################
 
-def process_chips(image_path, chip_coordinates, directory_name, file_suffix, barcode_content, date_str):
+def process_chips(image_path, chip_coordinates, directory_name, file_suffix, barcode_content, date_str, rotated_chips=None, board_key=None):
+
+    # Chips already cropped (and saved) by a preprocessing worker?
+    preprocessed = rotated_chips is not None
 
-    # Read the image:
-    image = cv2.imread(image_path)
+    if not preprocessed:
+        # Read the image:
+        image = cv2.imread(image_path)
 
-    # save a copy of the original image
-    cv2.imwrite(f'{directory_name}/{image_path}', image)
+        # save a copy of the original image (now, so the frame is not kept in the writer queue)
+        write_artifact_now(os.path.join(directory_name, os.path.basename(image_path)), image)
+
+        # Crop all chips to small arrays and release the full frame before the OCR loop
+        rotated_chips = crop_chips(image, chip_coordinates, chip_perspective.get(file_suffix))
+        del image
 
     # Creating the file name:
     result_filename = os.path.join(directory_name, f"{file_suffix}_results.txt")
@@ -218,42 +784,110 @@ def process_chips(image_path, chip_coordinates, directory_name, file_suffix, bar
     print(f"-------------- STARTING SERIAL NUMBER RECOGNITION --------------")
     print(f"------------------- FOR [{file_suffix}] SIDE ---------------------\n\n\n")
 
-    with open(result_filename, 'w', encoding='utf-8') as file:
-
-        file.write(f"FEMB SN: {barcode_content}\n\n{date_str}\n\n")
-
-        for i, (x, y, w, h) in enumerate(chip_coordinates):
-
-            ## Crop the image
-            chip_image = image[y:y+h, x:x+w]
+    # All chips of the side are sent at once, spread over the model servers
+    # (as many in flight as the servers accept), and written back in order
+    n_chips = len(rotated_chips)
+    pool = ThreadPoolExecutor(max_workers=max(1, min(n_chips, ocr_client.total_capacity(minicpm_urls))))
 
-            print(f'Processing Chip #{i} [{file_suffix}]...')
+    # Corrections already merged from the review queue are applied again when a board is read again
+    reviewed = review_queue.merged_corrections(get_review_queue(), result_filename, file_suffix) if use_review_queue else {}
 
-            # Rotate the chip:
-            rotated_chip = cv2.rotate(chip_image, cv2.ROTATE_90_CLOCKWISE)
+    # Results are collected in memory and handed to the artifact writer in one piece
+    all_valid = True
+    with pool, io.StringIO() as file:
 
-            ## Save the processed chip image to a file
-            chip_image_path = os.path.join(directory_name, f'{file_suffix}_chip_{i}.png')
-            cv2.imwrite(chip_image_path, rotated_chip)
+        file.write(f"FEMB SN: {barcode_content}\n\n{date_str}\n\n")
 
+        chip_reads = pool.map(read_chip, range(n_chips), rotated_chips, [file_suffix] * n_chips,
+                              [directory_name] * n_chips, [board_key] * n_chips, [preprocessed] * n_chips)
 
-            # Perform OCR
-            ocr_result = perform_ocr_minicpm(chip_image_path)
+        for i, chip_read in enumerate(chip_reads):
 
-            # Apply correction before printing and saving
-            corrected_ocr_result = correct_ocr(ocr_result, chip_number=i, side=file_suffix)
+            print(f'Processing Chip #{i} [{file_suffix}]...')
+            if chip_read["from_store"]:
+                print("(OCR result from the job store)")
+
+            serial_number = chip_read["serial_number"]
+
+            # Output length of the serial-number strip readings, per chip type
+            sn_generation = chip_read["sn_generation"]
+            if tune_generation and sn_generation:
+                record_generation(sn_generation["key"], sn_generation["tokens"],
+                                  sn_generation["valid"], sn_generation["limits"]["decode_type"])
+
+            if chip_read["sn_only"]:
+                original_line = f"Original OCR result (serial number only): {serial_number}"
+                if i in reviewed:
+                    print(f"(corrected in review: {reviewed[i]})")
+                    original_line = review_queue.correction_note(original_line, reviewed[i])
+                formatted_serial = reviewed.get(i, serial_number).replace(" ", "\n")
+                file.write(f"* Chip {i} ({file_suffix}):\n")
+                file.write(original_line)
+                file.write(f"\nFormatted OCR result:\n{formatted_serial}\n\n")
+                print(f"OCR results (serial number only): \n\n{serial_number}")
+                print("***********************************************************************")
+                continue
+
+            ocr_result = chip_read["ocr_result"]
+            generation = chip_read["generation"]
+
+            # Apply correction before printing and saving (the operator's correction wins
+            # over the new reading), and validate the result once
+            if i in reviewed:
+                corrected_ocr_result = reviewed[i]
+            else:
+                corrected_ocr_result = correct_ocr(ocr_result, chip_number=i, side=file_suffix)
+            valid = validate_ocr_result(corrected_ocr_result, chip_number=i, side=file_suffix)
+
+            # Reading with the tuned generation limits failing validation: read again with the defaults
+            if (generation and generation["limits"]["tuned"] and not ocr_result.startswith("Error")
+                    and not valid and i not in reviewed):
+                print(f"Chip #{i} [{file_suffix}] read with {generation_limits.describe_limits(generation['limits'])} "
+                      f"gave {generation['tokens']} tokens that failed validation, reading it again with the defaults")
+                record_generation(generation["key"], generation["tokens"], False,
+                                  generation["limits"]["decode_type"])
+                _last_generation.info = None
+                chip_image = Image.fromarray(cv2.cvtColor(rotated_chips[i], cv2.COLOR_BGR2RGB))
+                ocr_result = perform_ocr_with_retries(chip_image, get_chip_type(i, file_suffix), board_key, file_suffix, i, tuned=False)
+                generation = getattr(_last_generation, "info", None)
+                corrected_ocr_result = correct_ocr(ocr_result, chip_number=i, side=file_suffix)
+                valid = validate_ocr_result(corrected_ocr_result, chip_number=i, side=file_suffix)
+
+            # Sampled chip: compare the strip reading with the full marking
+            if serial_number and not corrected_ocr_result.endswith(serial_number):
+                print(f"(!) WARNING: serial number strip read '{serial_number}', full marking disagrees")
 
             # Writing original OCR result to file (single line per chip):
             file.write(f"* Chip {i} ({file_suffix}):\n")
-            file.write(f"Original OCR result: ")
-            file.write(ocr_result)
+            if i in reviewed:
+                print(f"(corrected in review: {reviewed[i]})")
+                file.write(review_queue.correction_note(f"Original OCR result: {ocr_result}", reviewed[i]))
+            else:
+                file.write(f"Original OCR result: ")
+                file.write(ocr_result)
 
             # Giving the corrected result a nice format to print in terminal
             formatted_ocr_result = corrected_ocr_result.replace(" ", "\n")
             print(f"OCR results: \n\n{formatted_ocr_result}")
 
-            # Validate the OCR result:
-            validate_ocr_result(corrected_ocr_result, chip_number=i, side=file_suffix)
+            all_valid = all_valid and valid
+
+            if not ocr_result.startswith("Error"):
+                checkpoint_chip(board_key, file_suffix, i, 'validated' if valid else 'ocr_done', ocr_result)
+
+            # Output length of the valid readings, per chip type
+            if tune_generation and generation and not ocr_result.startswith("Error") and i not in reviewed:
+                record_generation(generation["key"], generation["tokens"], valid,
+                                  generation["limits"]["decode_type"])
+
+            # Chips failing validation wait for the operator in the review queue
+            if use_review_queue and i not in reviewed:
+                chip_image_path = os.path.join(directory_name, f'{file_suffix}_chip_{i}.png')
+                if valid:
+                    review_queue.clear_review(get_review_queue(), result_filename, file_suffix, i)
+                else:
+                    review_queue.enqueue(get_review_queue(), result_filename, file_suffix, i, chip_image_path,
+                                         corrected_ocr_result, "failed validation")
 
             file.write(f"\nFormatted OCR result:\n")
             # Writing validated OCR result to file:
@@ -264,153 +898,105 @@ def process_chips(image_path, chip_coordinates, directory_name, file_suffix, bar
 
             file.write("\n\n")
 
+        results_text = file.getvalue()
+        write_artifact(result_filename, results_text)
+
+    # The results text (also kept for hwdb_stream.py) and whether every chip passed validation
+    return results_text, all_valid
+
 ############################################################################################
 
-def count_chips(result_filename):
+def crop_sn_strip(rotated_chip, chip_type):
 
-    with open(result_filename, 'r', encoding='utf-8') as file:
-        content = file.read()
-    return content.count('*')
+    fx, fy, fw, fh = chip_sn_roi[chip_type]
+    h, w = rotated_chip.shape[:2]
+    x, y = int(fx * w), int(fy * h)
+
+    return rotated_chip[y:y+int(fh * h), x:x+int(fw * w)]
 
 ############################################################################################
 
-def extract_date_from_filename(filename):
-    match = re.search(r'--(\d{2}-\d{2}-\d{4})', filename)
-    return match.group(1) if match else "Unknown date"
+def read_chip_sn_only(rotated_chip, chip_number, side, directory_name):
 
-############################################################################################
+    chip_type = get_chip_type(chip_number, side)
 
+    # Crop and save the serial-number strip next to the chip image
+    strip_path = os.path.join(directory_name, f'{side}_chip_{chip_number}_sn.png')
+    sn_strip = np.ascontiguousarray(crop_sn_strip(rotated_chip, chip_type))
+    write_artifact(strip_path, sn_strip)
 
+    sn_image = Image.fromarray(cv2.cvtColor(sn_strip, cv2.COLOR_BGR2RGB))
+    serial_number = perform_ocr_minicpm(sn_image, chip_type, sn_only=True).strip()
+    serial_number = serial_number.replace(" ", "")
 
-def correct_ocr(ocr_result, chip_number, side):
-    # Define expected spaces based on side and chip number
-    if side == "front":
-        if chip_number in [0, 1]:       # COLDATA 1 and 2 on the front side
-            max_spaces = 3
-        elif chip_number in [2, 3, 4, 5]:  # ColdADC 1-4 on the front side
-            max_spaces = 3
-        elif chip_number in [6, 7, 8, 9]:  # LArASIC 1-4 on the front side
-            max_spaces = 5
-        else:
-            print(f"Warning: Chip number {chip_number} invalid for front side.")
-            return ocr_result
-    elif side == "back":
-        if chip_number in [0, 1, 2, 3]:    # ColdADC 1-4 on the back side
-            max_spaces = 3
-        elif chip_number in [4, 5, 6, 7]:  # LArASIC 1-4 on the back side
-            max_spaces = 5
-        else:
-            print(f"Warning: Chip number {chip_number} invalid for back side.")
-            return ocr_result
-    else:
-        print("Warning: Invalid side specified.")
-        return ocr_result
-
-    # Count spaces in the OCR result
-    space_count = ocr_result.count(" ")
-
-
-    # Automatically replace specific incorrect variants of "ColdADC" for specified chips
-    if (side == "front" and chip_number in [2, 3, 4, 5]) or (side == "back" and chip_number in [0, 1, 2, 3]):
-        ocr_result = re.sub(r"\b(Col dADC|Co1 dADC|Cold ADC|Co1d ADC|CoI dADC)\b", "ColdADC", ocr_result)
-    #if (side == "front" and chip_number in [6, 7, 8, 9]) or (side == "back" and chip_number in [4, 5, 6, 7]):
-    #    ocr_result = re.sub(r"\b(BNl.)\b", "BNL ", ocr_result)
-
-    # Correcting Serial Number impurities: Remove "-" or "." from serial numbers for specified chips
-    lines = ocr_result.replace(" ", "\n").split("\n")
-
-    if side == "front":
-        # Serial numbers for front chips 0, 1, 2-5, and 6-9
-        if chip_number in [0, 1] or chip_number in [2, 3, 4, 5]:  # line 3
-            serial_number_line_index = 2
-        elif chip_number in [6, 7, 8, 9]:  # line 6
-            serial_number_line_index = 5
-    elif side == "back":
-        if chip_number in [0, 1, 2, 3]:  # line 3
-            serial_number_line_index = 2
-        elif chip_number in [4, 5, 6, 7]:  # line 6
-            serial_number_line_index = 5
-
-    # Apply the correction if we are in the specified range and line exists
-    if serial_number_line_index < len(lines):
-        if side == "front" and chip_number in [0, 1, 2, 3, 4, 5] or side == "back" and chip_number in [0, 1, 2, 3]:
-            # Remove any impurities in the serial number for these specific chips
-            lines[serial_number_line_index] = re.sub(r"[-.']", "", lines[serial_number_line_index])
-
-    #return ocr_result
-    # Reconstruct the corrected OCR result by replacing newlines with spaces
-    corrected_result = " ".join(lines)
-    return corrected_result
+    if not re.match(chip_sn_patterns[chip_type], serial_number):
+        print(f"Serial number strip read as '{serial_number}', reading the full marking instead.")
+        return None
+
+    return serial_number
 
 ############################################################################################
 
 
 
-def validate_ocr_result(ocr_result, chip_number, side):
+def read_reduced_image(image_path, max_dimension):
 
-    # Correct OCR result for extra or missing spaces
-    corrected_ocr_result = correct_ocr(ocr_result, chip_number, side)
+    # Largest decoder reduction that still leaves at least max_dimension pixels
+    # (the header is read without decoding the image)
+    with Image.open(image_path) as header:
+        full_size = max(header.size)
 
+    flags = cv2.IMREAD_COLOR
+    for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if full_size / factor >= max_dimension:
+            flags = reduced_flag
+            break
 
-    # Define regex patterns based on the chip number and side
-    patterns = {
-        "front": {
-            "COLDATA": re.compile(r"^(COLDATA|colddata|ColdData|CO1DATA)\s+([A-Za-z0-9]+\.[A-Za-z0-9]+)\s+(\d{5})\s+(\d{4})$"),
-            "ColdADC": re.compile(r"^(ColdADC|coldadc|Coldadc|Co1dADC|ColADC|CoIdADC)\s+([A-Za-z0-9]+\.[A-Za-z0-9]+)\s+(\d{5})\s+(\d{4})$"),
-            "LArASIC": re.compile(r"^BNL\s+LArASIC\s+Version\s+([A-Z0-9]+)\s+(\d{2}/\d{2})\s+(\d{3}-\d{5})$")
-        },
-        "back": {
-            "ColdADC": re.compile(r"^(ColdADC|coldadc|Coldadc|Co1dADC|ColADC|CoIdADC)\s+([A-Za-z0-9]+\.[A-Za-z0-9]+)\s+(\d{5})\s+(\d{4})$"),
-            "LArASIC": re.compile(r"^BNL\s+LArASIC\s+Version\s+([A-Z0-9]+)\s+(\d{2}/\d{2})\s+(\d{3}-\d{5})$")
-        }
-    }
-        # TO DO: Include "BNL.", "Version."
-
-    # Determine chip type based on chip number and side
-    if side == "front":
-        if chip_number in [0, 1]:
-            pattern = patterns["front"]["COLDATA"]
-        elif chip_number in [2, 3, 4, 5]:
-            pattern = patterns["front"]["ColdADC"]
-        elif chip_number in [6, 7, 8, 9]:
-            pattern = patterns["front"]["LArASIC"]
-        else:
-            print("Warning: Invalid chip number for front side")
-            return
-
-    elif side == "back":
-        if chip_number in [0, 1, 2, 3]:
-            pattern = patterns["back"]["ColdADC"]
-        elif chip_number in [4, 5, 6, 7]:
-            pattern = patterns["back"]["LArASIC"]
-        else:
-            print("Warning: Invalid chip number for back side")
-            return
-    else:
-        print("Warning: Invalid side specified")
-        return
+    return cv2.imread(image_path, flags)
 
-    # Validate OCR result
-    match = pattern.match(corrected_ocr_result) #was ocr_result
-    if not match:
-        print("(!) WARNING: check OCR result")
 
-    # Validate the serial number format
-    if side == "front" and chip_number in [6, 7, 8, 9] or side == "back" and chip_number in [4, 5, 6, 7]:
-        components = corrected_ocr_result.split()
-        if components:
-            serial_number = components[-1]  # Expected to be the last component for LArASIC
-            if not re.match(r"^\d{3}-\d{5}$", serial_number):
-                print("(!) ERROR: Serial Number needs correction!")
+############################################################################################
 
+def reset_peak_rss():
 
-############################################################################################
+    # On Linux, writing 5 to clear_refs resets the peak RSS (VmHWM) of this process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
 
 
+def get_peak_rss_mb():
 
-def save_reduced_image(image_path, directory_name, suffix, max_dimension=1600):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
 
-    image = cv2.imread(image_path)
+    # Fallback: peak RSS over the whole process lifetime (kB on Linux)
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+
+def estimate_frame_mb(image_path):
+
+    # Size of one decoded full-resolution BGR frame
+    with Image.open(image_path) as header:
+        w, h = header.size
+    return w * h * 3 / (1024 * 1024)
+
+
+############################################################################################
+
+def save_reduced_image(image_path, directory_name, suffix, max_dimension=1600, image=None):
+
+    if image is None:
+        image = read_reduced_image(image_path, max_dimension) if reduced_resolution_reads else cv2.imread(image_path)
     h, w = image.shape[:2]
 
     # Calculate the scaling factor to maintain aspect ratio
@@ -423,7 +1009,7 @@ def save_reduced_image(image_path, directory_name, suffix, max_dimension=1600):
 
     # Save the resized image
     reduced_image_path = os.path.join(directory_name, f"{suffix}_reduced.png")
-    cv2.imwrite(reduced_image_path, resized_image)
+    write_artifact(reduced_image_path, resized_image)
     #print(f"Reduced-size image saved as {reduced_image_path}")
 
 
@@ -431,13 +1017,7 @@ def save_reduced_image(image_path, directory_name, suffix, max_dimension=1600):
 
 
 
-def main_process(image_path_front, image_path_back):
-
-    image_front = cv2.imread(image_path_front)
-
-    # identify the QR code from the board
-    barcode_content = read_barcode(image_front, qr_position if barcode_type == 'QR' else dm_position, barcode_type)
-    date_str = extract_date_from_filename(image_path_front)
+def make_board_directory(barcode_content):
 
     # create a new directory ...
     sanitized_name = sanitize_filename(barcode_content)
@@ -446,20 +1026,67 @@ def main_process(image_path_front, image_path_back):
     if not os.path.exists(directory_name):
         os.makedirs(directory_name)
 
-    # save the QR code image to this directory ...
-    save_barcode_image(image_front, qr_position if barcode_type == 'QR' else dm_position, barcode_type, directory_name)
+    return directory_name
+
+
+############################################################################################
+
+
+
+def main_process(image_path_front, image_path_back, board=None):
 
-    # Save reduced-size copies of the front and back images to pload to HWDB later:
-    save_reduced_image(image_path_front, directory_name, "FEMB_FRONT")
-    save_reduced_image(image_path_back, directory_name, "FEMB_BACK")
+    reset_peak_rss()
+    ocr_timings.clear()  # the summary covers this board only
+
+    # Load the model on the servers while the images are decoded
+    start_warm_up()
+
+    board_key = job_store.make_board_key(image_path_front, image_path_back) if use_job_store else None
+
+    if board is None:
+        image_front = cv2.imread(image_path_front)
+
+        # identify the QR code from the board
+        barcode_content = read_barcode(image_front, qr_position if barcode_type == 'QR' else dm_position, barcode_type)
+        date_str = extract_date_from_filename(image_path_front)
+
+        directory_name = make_board_directory(barcode_content)
+
+        # save the QR code image to this directory ...
+        save_barcode_image(image_front, qr_position if barcode_type == 'QR' else dm_position, barcode_type, directory_name)
+
+        # Save reduced-size copies of the front and back images to pload to HWDB later:
+        save_reduced_image(image_path_front, directory_name, "FEMB_FRONT", image=image_front)
+        del image_front  # full frame no longer needed, process_chips decodes what it crops
+        save_reduced_image(image_path_back, directory_name, "FEMB_BACK")
+
+        front_chips = back_chips = None
+    else:
+        # Board already decoded and cropped by preprocess_board
+        barcode_content = board["barcode_content"]
+        date_str = board["date_str"]
+        directory_name = board["directory_name"]
+        front_chips = board["front_chips"]
+        back_chips = board["back_chips"]
+
+    if board_key is not None:
+        job_store.start_board(get_job_store(), board_key, image_path_front, image_path_back, directory_name)
+
+    wait_for_warm_up()
 
     # Front processing with front-specific OCR cleaning
-    process_chips(image_path_front, chip_coordinates_front, directory_name, "front",barcode_content, date_str)
+    front_text, front_valid = process_chips(image_path_front, chip_coordinates_front, directory_name, "front",barcode_content, date_str, front_chips, board_key)
 
     # Back processing with back-specific OCR cleaning, same directory
-    process_chips(image_path_back, chip_coordinates_back, directory_name, "back",barcode_content, date_str)
-
-    # Post-processing OCR results:
+    back_text, back_valid = process_chips(image_path_back, chip_coordinates_back, directory_name, "back",barcode_content, date_str, back_chips, board_key)
+
+    # Post-processing OCR results (once they are on disk):
+    if not flush_artifacts():
+        # Missing chip images or results: neither counted, indexed nor uploaded
+        if board_key is not None:
+            job_store.fail_board(get_job_store(), board_key)
+        print("(!) Some files of this board could not be written (see above), it will be read again on the next run")
+        return
 
     front_result_file = os.path.join(directory_name, "front_results.txt")
     back_result_file = os.path.join(directory_name, "back_results.txt")
@@ -470,14 +1097,244 @@ def main_process(image_path_front, image_path_back):
     print(f"Number of chips processed on the front side: {front_chip_count}")
     print(f"Number of chips processed on the back side: {back_chip_count}")
 
+    # One archive per board instead of the directory (see board_archive.py)
+    if pack_boards:
+        board_archive.pack_board(directory_name, remove_directory=True)
+
+    if update_results_index:
+        results_index.index_board(get_results_index(), directory_name)
+
+    # HWDB record built from the results in memory and uploaded in the background
+    if stream_to_hwdb:
+        hwdb_stream.stream_board(directory_name, front_text, back_text, front_valid and back_valid,
+                                 get_results_index() if update_results_index else None)
+
+    if tune_generation and _generation_stats is not None:
+        try:
+            generation_limits.save_stats(_generation_stats)
+        except OSError as e:  # statistics only, the board itself is done
+            print(f"Error saving the generation statistics: {e}")
+
+    if board_key is not None:
+        board_state = job_store.finish_board(get_job_store(), board_key)
+        if board_state == 'failed':
+            print("(!) Some chips could not be read, they will be retried on the next run")
+
+    print_ocr_timing_summary()
+    ocr_client.print_endpoint_stats()
+
+    peak_rss_mb = get_peak_rss_mb()
+    if peak_rss_mb is not None:
+        print(f"Peak RSS for this board: {peak_rss_mb:.0f} MB")
+    if board is not None and board.get("worker_peak_rss_mb") is not None:
+        print(f"Peak RSS of the preprocessing worker: {board['worker_peak_rss_mb']:.0f} MB")
+
+
+############################################################################################
+# Batch mode: decode, crop and save all images of many boards in worker processes,
+# while the main process runs the OCR of boards that are ready.
+############################################################################################
+
+def find_board_pairs(images_dir, quiet=False):
+
+    board_pairs = []
+    for filename in sorted(os.listdir(images_dir)):
+        if filename.startswith("FEMB_FRONT_"):
+            back_filename = filename.replace("FEMB_FRONT_", "FEMB_BACK_", 1)
+            if os.path.exists(os.path.join(images_dir, back_filename)):
+                board_pairs.append((os.path.join(images_dir, filename), os.path.join(images_dir, back_filename)))
+            elif not quiet:
+                print(f"Skipping '{filename}' (missing {back_filename})")
+
+    return board_pairs
+
+############################################################################################
+
+def build_chip_layout():
+
+    # Offset and shape of every rotated chip inside one shared memory block
+    layout = {}
+    offset = 0
+    for side, chip_coordinates in (("front", chip_coordinates_front), ("back", chip_coordinates_back)):
+        layout[side] = []
+        for x, y, w, h in chip_coordinates:
+            shape = (w, h, 3)  # rotated 90 degrees
+            layout[side].append((offset, shape))
+            offset += w * h * 3
+
+    return layout, offset
+
+############################################################################################
+
+def preprocess_board(image_path_front, image_path_back, shm_name, layout):
+
+    reset_peak_rss()
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image_front = cv2.imread(image_path_front)
+
+        # identify the QR code from the board
+        barcode_content = read_barcode(image_front, qr_position if barcode_type == 'QR' else dm_position, barcode_type)
+        date_str = extract_date_from_filename(image_path_front)
+
+        directory_name = make_board_directory(barcode_content)
+        save_barcode_image(image_front, qr_position if barcode_type == 'QR' else dm_position, barcode_type, directory_name)
+
+        sides = (
+            ("front", image_path_front, chip_coordinates_front, "FEMB_FRONT"),
+            ("back", image_path_back, chip_coordinates_back, "FEMB_BACK"),
+        )
+        for side, image_path, chip_coordinates, suffix in sides:
+
+            image = image_front if side == "front" else cv2.imread(image_path)
+            image_front = None
+
+            save_reduced_image(image_path, directory_name, suffix, image=image)
+            write_artifact_now(os.path.join(directory_name, os.path.basename(image_path)), image)
+
+            for i, rotated_chip in enumerate(crop_chips(image, chip_coordinates, chip_perspective.get(side))):
+                write_artifact(os.path.join(directory_name, f'{side}_chip_{i}.png'), rotated_chip)
+
+                # Hand the crop back through shared memory instead of pickling it
+                offset, shape = layout[side][i]
+                np.copyto(np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset), rotated_chip)
+
+            del image
+
+        # Files of this board are on disk before it is handed to the OCR
+        if not flush_artifacts():
+            raise OSError("some files of the board could not be written (see above)")
+    finally:
+        shm.close()
+
+    return {"barcode_content": barcode_content, "date_str": date_str, "directory_name": directory_name,
+            "worker_peak_rss_mb": get_peak_rss_mb()}
+
+############################################################################################
+
+def run_batch(images_dir):
+
+    board_pairs = find_board_pairs(images_dir)
+    if use_job_store:
+        # Boards finished in a previous run are not read again
+        conn = get_job_store()
+        board_pairs = [(front, back) for front, back in board_pairs
+                       if job_store.get_board_state(conn, job_store.make_board_key(front, back)) != 'done']
+    if not board_pairs:
+        print(f"No FEMB_FRONT_*/FEMB_BACK_* pairs found in {images_dir}")
+        return
+    layout, block_size = build_chip_layout()
+
+    # Load the model on the servers while the first boards are decoded
+    start_warm_up()
+
+    # Each worker holds one decoded frame plus about as much again while
+    # resizing and encoding, so fit the number of workers to the memory budget
+    worker_mb = 2 * estimate_frame_mb(board_pairs[0][0])
+    workers = max(1, min(batch_workers, int(memory_budget_mb // worker_mb)))
+    if workers < batch_workers:
+        print(f"Memory budget of {memory_budget_mb} MB allows {workers} workers (~{worker_mb:.0f} MB each)")
+
+    # One shared memory block per board in flight, reused as boards finish
+    in_flight = min(2 * workers, len(board_pairs))
+    free_blocks = [shared_memory.SharedMemory(create=True, size=block_size) for _ in range(in_flight)]
+    all_blocks = list(free_blocks)
+
+    print(f"Batch of {len(board_pairs)} boards, {workers} preprocessing workers")
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            next_board = 0
+
+            while next_board < len(board_pairs) or pending:
+
+                # Keep the workers busy while the OCR drains the ready boards
+                while free_blocks and next_board < len(board_pairs):
+                    shm = free_blocks.pop()
+                    image_path_front, image_path_back = board_pairs[next_board]
+                    next_board += 1
+                    future = pool.submit(preprocess_board, image_path_front, image_path_back, shm.name, layout)
+                    pending[future] = (image_path_front, image_path_back, shm)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    image_path_front, image_path_back, shm = pending.pop(future)
+                    try:
+                        board = dict(future.result())
+                    except Exception as e:
+                        print(f"Error preprocessing {image_path_front}: {e}")
+                    else:
+                        for side in ("front", "back"):
+                            board[f"{side}_chips"] = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)
+                                                      for offset, shape in layout[side]]
+                        main_process(image_path_front, image_path_back, board)
+                        del board  # release the views before the block is reused
+                    free_blocks.append(shm)
+    finally:
+        for shm in all_blocks:
+            shm.close()
+            shm.unlink()
+
+
+def resume_unfinished_boards():
+
+    # Boards left pending or failed by an earlier run (crash, model server down, ...)
+    for image_path_front, image_path_back in job_store.unfinished_boards(get_job_store()):
+        if os.path.exists(image_path_front) and os.path.exists(image_path_back):
+            print(f"Resuming board {os.path.basename(image_path_front)}")
+            main_process(image_path_front, image_path_back)
+
 
 # Configuration:
 
 image_path_front = 'images/FEMB_FRONT_21--06-06-2024.png'
 image_path_back = 'images/FEMB_BACK_21--06-06-2024.png'
 
-#Let's crop and read some chips!
-main_process(image_path_front, image_path_back)
+# Batch configuration: set a directory to process every FEMB_FRONT_*/FEMB_BACK_* pair in it
+batch_images_dir = None  # e.g. 'images'
+batch_workers = os.cpu_count() or 1
+
+# Memory configuration: budget (MB) for full-resolution frames held by the batch workers,
+# and whether to let the decoder read the reduced-size HWDB images at lower resolution
+memory_budget_mb = 4096
+reduced_resolution_reads = False
+
+# Job store configuration: checkpoint every chip in results/jobs.db, reuse the stored
+# OCR results when a board is read again (not after its pictures were taken again),
+# and resume unfinished boards at startup
+use_job_store = True
+reuse_checkpoints = True
+resume_unfinished = True
+ocr_max_retries = 3
+ocr_retry_backoff = 2.0  # seconds, doubled after every failed attempt
+
+# Put the chips failing validation in the review queue (results/review_queue.db, see review_queue.py)
+use_review_queue = True
+
+# Pack every board directory into results/<FEMB>.zip once it is done
+pack_boards = False
+
+# Add every board to the chip index (results/results_index.db, see results_index.py)
+update_results_index = True
+
+# Upload every board that passes validation to the HWDB as soon as it is read (see hwdb_stream.py),
+# instead of running produce_json.py and upload_FEMBs.py over the whole results tree afterwards
+stream_to_hwdb = False
+
+
+if __name__ == "__main__":
+
+    if use_job_store and resume_unfinished:
+        resume_unfinished_boards()
+
+    #Let's crop and read some chips!
+    if batch_images_dir:
+        run_batch(batch_images_dir)
+    else:
+        main_process(image_path_front, image_path_back)
 
 
-print("FEMB Processing complete!")
+    print("FEMB Processing complete!")
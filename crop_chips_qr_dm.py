@@ -3,25 +3,48 @@
 # and White format to be analized for text recognition.
 
 # Code reads EITHER QR codes or Data Matrices.
-# Code is user-interactive, so the user can correct bad readings.
+# Code is user-interactive, so the user can correct bad readings: either at
+# prompts after each side, or later through the review queue (review_queue.py)
+# while the OCR keeps running (use_review_queue).
 # Code processes both FRONT and BACK chip readings.
 
 import cv2
 import numpy as np
-import pytesseract
 from PIL import Image
 import re
 import os
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from chip_specs import validate_ocr_result
+import review_queue
 
-# Import libraries for both QR and Data Matrix decoding
-from pylibdmtx.pylibdmtx import decode as decode_dm
-from qreader import QReader
+# No OpenMP threads inside Tesseract: the chips are read in parallel instead
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Tesseract runs in-process through tesserocr (C API) when it is installed;
+# otherwise pytesseract starts one tesseract process per chip
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+# Libraries for QR and Data Matrix decoding are imported in read_barcode,
+# only the one in use is loaded
 
 
 # Configuration variable: 'QR' or 'DM' (Data Matrix)
 barcode_type = 'QR'  # Change this to 'QR' if decoding QR codes
 
+# OCR configuration
+tesseract_lang = 'eng'
+ocr_threads = os.cpu_count() or 1
+
+# Flagged chips go to the review queue instead of stopping at input() prompts
+use_review_queue = True
+
 # Define the positions for QR and DM
 qr_position = (1048, 1497, 142, 142)
 dm_position = (1058, 1520, 152, 152)
@@ -51,6 +74,18 @@ chip_coordinates_back = [
     (3139,1832,180,192), #LArASIC 4
 ]
 
+# Characters of each chip marking: the Tesseract whitelist (ocr_whitelist) and
+# what clean_ocr_text_front/clean_ocr_text_back keep
+coldata_chars = string.ascii_uppercase + string.digits + "."
+coldadc_chars = string.ascii_letters + string.digits + "."
+larasic_chars = string.ascii_letters + string.digits + "/-_"
+other_chars = string.ascii_letters + string.digits + "./-_"
+
+
+def invalid_chars_pattern(chars, spaces=False):
+    # Escaped: in a character class "/-_" would be a range, not three characters
+    return f"[^{re.escape(chars)}{' ' if spaces else ''}]"
+
 ########################################################################
 
 def clean_ocr_text_front(chip_index, ocr_text):
@@ -62,19 +97,19 @@ def clean_ocr_text_front(chip_index, ocr_text):
     if chip_index in [0, 1]:
         min_chars = 4
         expected_lines = 4
-        valid_char_pattern = r'[^A-Z0-9.]'
+        valid_char_pattern = invalid_chars_pattern(coldata_chars)
     elif chip_index in [2, 3, 4, 5]:
         min_chars = 4
         expected_lines = 4
-        valid_char_pattern = r'[^A-Za-z0-9.]'
+        valid_char_pattern = invalid_chars_pattern(coldadc_chars)
     elif chip_index in [6, 7, 8, 9]:
         min_chars = 3
         expected_lines = 5
-        valid_char_pattern = r'[^A-Za-z0-9/-_ ]'
+        valid_char_pattern = invalid_chars_pattern(larasic_chars, spaces=True)
     else:
         min_chars = 3
         expected_lines = 4  # Default case, can be adjusted
-        valid_char_pattern = r'[^A-Za-z0-9./-_]'
+        valid_char_pattern = invalid_chars_pattern(other_chars)
 
 
     # Filter and clean lines based on the defined patterns and rules
@@ -113,15 +148,15 @@ def clean_ocr_text_back(chip_index, ocr_text):
     if  chip_index in [0, 1, 2, 3]:
         min_chars = 4
         expected_lines = 4
-        valid_char_pattern = r'[^A-Za-z0-9.]'
+        valid_char_pattern = invalid_chars_pattern(coldadc_chars)
     elif chip_index in [4, 5, 6, 7]:
         min_chars = 3
         expected_lines = 5
-        valid_char_pattern = r'[^A-Za-z0-9/-_ ]'
+        valid_char_pattern = invalid_chars_pattern(larasic_chars, spaces=True)
     else:
         min_chars = 4
         expected_lines = 4  # Default case, can be adjusted
-        valid_char_pattern = r'[^A-Za-z0-9./-_]'
+        valid_char_pattern = invalid_chars_pattern(other_chars)
 
 
     # Filter and clean lines based on the defined patterns and rules
@@ -151,11 +186,57 @@ def clean_ocr_text_back(chip_index, ocr_text):
 
 ####################################################################
 
+def ocr_whitelist(file_suffix, chip_index):
+
+    # Characters Tesseract may return for each chip (see coldata_chars ...)
+    if file_suffix == "front" and chip_index in [0, 1]:
+        return coldata_chars
+    if (file_suffix == "front" and chip_index in [2, 3, 4, 5]) or (file_suffix == "back" and chip_index in [0, 1, 2, 3]):
+        return coldadc_chars
+    if (file_suffix == "front" and chip_index in [6, 7, 8, 9]) or (file_suffix == "back" and chip_index in [4, 5, 6, 7]):
+        return larasic_chars
+    return other_chars
+
+####################################################################
+
+# One Tesseract instance per thread of the OCR pool, initialized once (language
+# data loaded) and kept for the whole run
+_tesseract = threading.local()
+_ocr_pool = None
+
+def get_ocr_pool():
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ThreadPoolExecutor(max_workers=max(1, ocr_threads))
+    return _ocr_pool
+
+def get_tesseract_api():
+    api = getattr(_tesseract, "api", None)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(lang=tesseract_lang, psm=tesserocr.PSM.SINGLE_BLOCK)  # --psm 6
+        _tesseract.api = api
+    return api
+
+
+def ocr_chip(chip_image, whitelist):
+
+    if tesserocr is None:
+        import pytesseract
+        return pytesseract.image_to_string(chip_image, config=f'--psm 6 -c tessedit_char_whitelist={whitelist}')
+
+    api = get_tesseract_api()
+    api.SetVariable("tessedit_char_whitelist", whitelist)
+    api.SetImage(Image.fromarray(chip_image))
+    return api.GetUTF8Text()
+
+####################################################################
+
 def read_barcode(image, position, barcode_type):
     x, y, w, h = position
     cropped_image = image[y:y+h, x:x+w]
 
     if barcode_type == 'QR':
+        from qreader import QReader
         qreader = QReader()
         try:
             data = qreader.detect_and_decode(image=cropped_image)
@@ -172,6 +253,7 @@ def read_barcode(image, position, barcode_type):
         cv2.imwrite(f'cropped/QR_code.png', cropped_image)
 
     elif barcode_type == 'DM':
+        from pylibdmtx.pylibdmtx import decode as decode_dm
         dm_image = Image.fromarray(cropped_image)  # Convert to PIL Image format
         results = decode_dm(dm_image)
         if results:
@@ -212,7 +294,7 @@ def process_chips(image_path, chip_coordinates, directory_name, file_suffix, cle
 
 
 
-    all_ocr_results = []
+    rotated_chips = []
     for i, (x, y, w, h) in enumerate(chip_coordinates):
 
         ## Crop the image using the coordinates and sizes
@@ -224,18 +306,56 @@ def process_chips(image_path, chip_coordinates, directory_name, file_suffix, cle
 
         # Rotate the chip:
         rotated_chip = cv2.rotate(bw_chip, cv2.ROTATE_90_CLOCKWISE)
-
-        ## Use pytesseract to do OCR on the processed chip image
-        text = pytesseract.image_to_string(rotated_chip, config='--psm 6')
-
-        ## Clean and record OCR results
-        clean_text, _ = clean_ocr_text(i, text)
-        all_ocr_results.append((i, clean_text.split('\n')))
+        rotated_chips.append(rotated_chip)
 
         ## Save the processed chip image to a file
         chip_image_path = os.path.join(directory_name, f'chip_{i}_{file_suffix}.png')
         cv2.imwrite(chip_image_path, rotated_chip)
 
+    ## OCR of all chips in parallel, each with the characters its chip type can have
+    whitelists = [ocr_whitelist(file_suffix, i) for i in range(len(rotated_chips))]
+    texts = list(get_ocr_pool().map(ocr_chip, rotated_chips, whitelists))
+
+    ## Clean and record OCR results
+    all_ocr_results = []
+    flagged_chips = []
+    for i, text in enumerate(texts):
+        clean_text, corrections_detected = clean_ocr_text(i, text)
+        all_ocr_results.append((i, clean_text.split('\n')))
+
+        if corrections_detected:
+            flagged_chips.append((i, "OCR text needed corrections"))
+        elif not validate_ocr_result(" ".join(clean_text.split()), i, file_suffix):
+            flagged_chips.append((i, "failed validation"))
+
+    if use_review_queue:
+        queue = review_queue.open_review_queue()
+
+        # Chips corrected in an earlier review keep their correction
+        merged = review_queue.merged_corrections(queue, result_filename, file_suffix)
+        for chip_idx, corrected_text in merged.items():
+            if chip_idx < len(all_ocr_results):
+                all_ocr_results[chip_idx] = (chip_idx, corrected_text.split())
+        flagged_chips = [(chip_idx, reason) for chip_idx, reason in flagged_chips if chip_idx not in merged]
+
+        # Save the results as read, queue the flagged chips and move on
+        with open(result_filename, 'w', encoding='utf-8') as file:
+            for chip_idx, lines in all_ocr_results:
+                file.write(f"* Chip {chip_idx} ({file_suffix}):\n")
+                for line in lines:
+                    file.write(f"{line}\n")
+                file.write("\n\n")
+
+        for chip_idx, reason in flagged_chips:
+            chip_image_path = os.path.join(directory_name, f'chip_{chip_idx}_{file_suffix}.png')
+            review_queue.enqueue(queue, result_filename, file_suffix, chip_idx, chip_image_path,
+                                 " ".join(all_ocr_results[chip_idx][1]), reason)
+        queue.close()
+
+        print(f"\n{file_suffix.upper()} results saved in {directory_name}: {len(flagged_chips)} chips queued for review "
+              f"(python review_queue.py review)")
+        return
+
     # Print all OCR results for user review
     print(f"\n\n\n\n\n------- OCR RESULTS FOR **{file_suffix.upper()}** OF THE BOARD -------\n")
     for chip_idx, lines in all_ocr_results:
@@ -330,6 +450,7 @@ image_path_front = '/home/karla/Documents/CE-QC/QC_camera/text_recognition/Image
 image_path_back = '/home/karla/Documents/CE-QC/QC_camera/text_recognition/Images/FEMB_BACK_2PBars_10PL_88PF_1s.png'
 
 #Let's crop and read some chips!
-main_process(image_path_front, image_path_back)
+if __name__ == "__main__":
+    main_process(image_path_front, image_path_back)
 
 
@@ -0,0 +1,410 @@
+# Reprocessing of an image archive by several hosts sharing the same
+# filesystem (image archive and results/ tree).
+
+# Every host runs one or more workers over the same images directory. A
+# worker claims a board by creating results/claims/<board>.lock (O_EXCL, so
+# exactly one worker gets it), runs the usual crop_chips_FEMB.main_process on
+# it, and leaves results/claims/<board>.done behind. While it works, it
+# touches its lock file every heartbeat_interval seconds; a lock that has not
+# been touched for lease_timeout seconds (worker or host died) is released
+# and the board is claimed again by someone else. Ages are measured with the
+# clock of the file server, not of the hosts.
+
+# The shared SQLite files are not written by the workers (SQLite locking is
+# not reliable over network filesystems): each worker keeps its own job store,
+# review queue and generation statistics under results/workers/<worker>/, and
+# the merge step rebuilds the chip index, moves the flagged chips to the main
+# review queue and adds the statistics to results/generation_stats.json (the
+# workers tune their requests with that file, but only record their own readings).
+
+#   python distributed_worker.py work images/            on every host (as many as wanted)
+#   python distributed_worker.py local images/ --workers 4   N local workers, then the merge
+#   python distributed_worker.py status images/
+#   python distributed_worker.py merge [--json]          once every board is done
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+import generation_limits
+import job_store
+import results_index
+import review_queue
+
+
+# Configuration:
+results_dir = "results"
+claims_dir = os.path.join(results_dir, "claims")
+workers_dir = os.path.join(results_dir, "workers")
+heartbeat_interval = 15  # seconds between two touches of the lock file
+lease_timeout = 120      # seconds without heartbeat before a claim is released
+poll_interval = 30       # seconds between two looks at the boards claimed by others
+max_attempts = 3         # a board failing this many times is left out
+
+
+############################################################################################
+# Claims
+############################################################################################
+
+def board_id(images_dir, image_path_front):
+
+    # File name of the front picture, relative to the archive (unique per board)
+    relative = os.path.splitext(os.path.relpath(image_path_front, images_dir))[0]
+    return relative.replace(os.sep, "__")
+
+
+def claim_path(board, suffix):
+
+    return os.path.join(claims_dir, f"{board}{suffix}")
+
+
+def read_json_file(path):
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_file(path, data):
+
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+class Worker:
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.alive_path = os.path.join(claims_dir, f"{self.worker_id}.alive")
+        self.lock = threading.Lock()
+        self.current = None  # (lock path, claim) of the board being read
+        self.stopped = threading.Event()
+        os.makedirs(claims_dir, exist_ok=True)
+
+    def filesystem_now(self):
+        # Current time of the file server: mtime of a file just touched
+        with open(self.alive_path, 'a'):
+            os.utime(self.alive_path, None)
+        return os.path.getmtime(self.alive_path)
+
+    def claim(self, board):
+        path = claim_path(board, ".lock")
+        claim = {"worker": self.worker_id, "token": uuid.uuid4().hex, "claimed": time.time()}
+
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if attempt or not self.release_if_stale(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump(claim, f)
+            with self.lock:
+                self.current = (path, claim)
+            return True
+
+        return False
+
+    def release_if_stale(self, path):
+        # True when the lock is gone (or was stale and is now removed)
+        try:
+            mtime, owner = self.read_claim(path)
+        except FileNotFoundError:
+            return True
+        age = self.filesystem_now() - mtime
+        if age < lease_timeout:
+            return False
+
+        stale_path = f"{path}.stale-{self.worker_id}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True  # released by its owner or by another worker
+
+        try:
+            unchanged = self.read_claim(stale_path) == (mtime, owner)
+        except FileNotFoundError:
+            return True
+        if not unchanged:
+            # Another worker replaced the stale lock with a fresh claim (or the owner
+            # touched it) meanwhile: give it back
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+
+        os.remove(stale_path)
+        print(f"Released the stale claim of {(owner or {}).get('worker', '?')} on {os.path.basename(path)} "
+              f"(no heartbeat for {age:.0f} s)")
+        return True
+
+    def read_claim(self, path):
+        # Modification time and content of a claim, read together: the file must not
+        # change (be touched, or replaced by another claim) while it is read
+        while True:
+            before = os.stat(path)
+            owner = read_json_file(path)
+            after = os.stat(path)
+            if (before.st_ino, before.st_mtime_ns) == (after.st_ino, after.st_mtime_ns):
+                return after.st_mtime, owner
+
+    def release(self):
+        with self.lock:
+            path, claim = self.current
+            self.current = None
+        # Only our own claim: it may have been taken over after a long stall
+        if read_json_file(path) == claim:
+            os.remove(path)
+
+    def heartbeat(self):
+        while not self.stopped.wait(heartbeat_interval):
+            with self.lock:
+                current = self.current
+            try:
+                self.filesystem_now()
+                if current is not None:
+                    os.utime(current[0], None)
+            except FileNotFoundError:
+                if current is not None:
+                    print(f"(!) WARNING: the claim {os.path.basename(current[0])} was taken over by another worker")
+            except OSError as e:
+                print(f"(!) WARNING: heartbeat failed: {e}")
+
+############################################################################################
+# Worker loop
+############################################################################################
+
+def board_status(board):
+
+    # 'done', 'failed' (max_attempts reached), 'claimed' or None
+    if os.path.exists(claim_path(board, ".done")):
+        return 'done'
+    failed = read_json_file(claim_path(board, ".failed")) or {}
+    if failed.get("attempts", 0) >= max_attempts:
+        return 'failed'
+    if os.path.exists(claim_path(board, ".lock")):
+        return 'claimed'
+    return None
+
+
+def record_failure(board, worker_id, error):
+
+    path = claim_path(board, ".failed")
+    failed = read_json_file(path) or {"attempts": 0, "errors": []}
+    failed["attempts"] += 1
+    failed["errors"].append(f"{worker_id}: {error}")
+    write_json_file(path, failed)
+
+
+def setup_worker_state(worker_id):
+
+    # Per-worker SQLite files, no shared index writes (rebuilt by the merge)
+    import crop_chips_FEMB
+
+    state_dir = os.path.join(workers_dir, worker_id)
+    os.makedirs(state_dir, exist_ok=True)
+    job_store.job_store_path = os.path.join(state_dir, "jobs.db")
+    review_queue.review_queue_path = os.path.join(state_dir, "review_queue.db")
+    # The limits learned so far come from the main file, only the new readings go to the worker's
+    generation_limits.baseline_stats_path = generation_limits.generation_stats_path
+    generation_limits.generation_stats_path = os.path.join(state_dir, "generation_stats.json")
+    crop_chips_FEMB.update_results_index = False
+    crop_chips_FEMB.stream_to_hwdb = False  # no consistency checks without the index: upload after the merge
+
+    return crop_chips_FEMB
+
+
+def run_worker(images_dir, worker_id=None):
+
+    worker = Worker(worker_id)
+    crop_chips_FEMB = setup_worker_state(worker.worker_id)
+
+    board_pairs = crop_chips_FEMB.find_board_pairs(images_dir, quiet=True)
+    boards = [(board_id(images_dir, front), front, back) for front, back in board_pairs]
+
+    # Workers start at different places of the list, so they rarely race for the same lock
+    if boards:
+        start = zlib.crc32(worker.worker_id.encode()) % len(boards)
+        boards = boards[start:] + boards[:start]
+
+    heartbeat = threading.Thread(target=worker.heartbeat, daemon=True)
+    heartbeat.start()
+    crop_chips_FEMB.start_warm_up()
+
+    processed = 0
+    print(f"Worker {worker.worker_id}: {len(boards)} boards in {images_dir}")
+    try:
+        while True:
+            remaining = [b for b in boards if board_status(b[0]) not in ('done', 'failed')]
+            if not remaining:
+                break
+
+            claimed_any = False
+            for board, image_path_front, image_path_back in remaining:
+                # (a claim of another worker is only taken when it went stale)
+                if board_status(board) in ('done', 'failed') or not worker.claim(board):
+                    continue
+                claimed_any = True
+                try:
+                    if board_status(board) == 'done':  # finished just before we claimed it
+                        continue
+                    print(f"\n\nWorker {worker.worker_id}: board {board}")
+                    start_time = time.time()
+                    try:
+                        crop_chips_FEMB.main_process(image_path_front, image_path_back)
+                    except Exception as e:
+                        print(f"Error processing {image_path_front}: {e}")
+                        record_failure(board, worker.worker_id, e)
+                        continue
+                    write_json_file(claim_path(board, ".done"),
+                                    {"worker": worker.worker_id, "started": start_time, "finished": time.time()})
+                    processed += 1
+                    print(f"Board {board} done in {time.time() - start_time:.1f} s")
+                finally:
+                    worker.release()
+
+            if not claimed_any:
+                # Everything left is being read by other workers: wait for them (or for their claims to go stale)
+                time.sleep(poll_interval)
+    finally:
+        worker.stopped.set()
+        if os.path.exists(worker.alive_path):
+            os.remove(worker.alive_path)
+
+    print(f"Worker {worker.worker_id}: {processed} boards read, nothing left to claim")
+    return processed
+
+############################################################################################
+# Status and merge
+############################################################################################
+
+def print_status(images_dir):
+
+    # (without loading the OCR pipeline: only the front picture names are needed)
+    counts = {}
+    for name in sorted(os.listdir(images_dir)):
+        if not name.startswith("FEMB_FRONT_"):
+            continue
+        status = board_status(board_id(images_dir, os.path.join(images_dir, name))) or 'waiting'
+        counts[status] = counts.get(status, 0) + 1
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "No boards")
+
+
+def merge_results(run_produce_json=False):
+
+    # Consolidated outputs once the workers are done
+    done = []
+    for name in sorted(os.listdir(claims_dir)) if os.path.isdir(claims_dir) else []:
+        if name.endswith(".done"):
+            done.append(read_json_file(os.path.join(claims_dir, name)) or {})
+        elif name.endswith(".failed"):
+            failed = read_json_file(os.path.join(claims_dir, name)) or {}
+            print(f"Error: {name[:-len('.failed')]} failed {failed.get('attempts', 0)} times: {failed.get('errors', [])[-1:]}")
+        elif name.endswith(".lock"):
+            print(f"(!) WARNING: {name[:-len('.lock')]} is still claimed by {(read_json_file(os.path.join(claims_dir, name)) or {}).get('worker')}")
+
+    # Boards per worker and overall rate
+    if done:
+        per_worker = {}
+        for board in done:
+            per_worker[board.get("worker")] = per_worker.get(board.get("worker"), 0) + 1
+        elapsed = max(b["finished"] for b in done) - min(b["started"] for b in done)
+        print(f"{len(done)} boards read by {len(per_worker)} workers in {elapsed:.0f} s "
+              f"({3600 * len(done) / max(elapsed, 1e-9):.0f} boards/hour)")
+        for worker_id, count in sorted(per_worker.items()):
+            print(f"  {worker_id}: {count} boards")
+
+    # Flagged chips of every worker into the main review queue
+    queue = review_queue.open_review_queue()
+    moved = 0
+    for worker_id in sorted(os.listdir(workers_dir)) if os.path.isdir(workers_dir) else []:
+        worker_queue_path = os.path.join(workers_dir, worker_id, "review_queue.db")
+        if not os.path.exists(worker_queue_path):
+            continue
+        worker_queue = review_queue.open_review_queue(worker_queue_path)
+        for review in review_queue.pending_reviews(worker_queue):
+            review_queue.enqueue(queue, review["result_file"], review["side"], review["chip"],
+                                 review["chip_image"], review["ocr_text"], review["reason"])
+            moved += 1
+        with worker_queue:
+            worker_queue.execute("DELETE FROM reviews WHERE state = 'pending'")
+        worker_queue.close()
+    print(f"{moved} flagged chips moved to {review_queue.review_queue_path}")
+
+    # Generation statistics of every worker into the main file
+    stats = generation_limits.load_stats()
+    merged = 0
+    for worker_id in sorted(os.listdir(workers_dir)) if os.path.isdir(workers_dir) else []:
+        worker_stats_path = os.path.join(workers_dir, worker_id, "generation_stats.json")
+        if not os.path.exists(worker_stats_path):
+            continue
+        generation_limits.merge_stats(stats, generation_limits.load_stats(worker_stats_path))
+        os.remove(worker_stats_path)
+        merged += 1
+    if merged:
+        generation_limits.save_stats(stats)
+        print(f"Generation statistics of {merged} workers merged into {generation_limits.generation_stats_path}")
+
+    # Chip index of all boards
+    updated = results_index.update_index(results_index.open_index(), results_dir)
+    print(f"{updated} boards (re)indexed in {results_index.index_path}")
+
+    if run_produce_json:
+        import produce_json
+        produce_json.process_all_folders(results_dir, produce_json.NAME)
+
+    return len(done)
+
+
+def run_local(images_dir, n_workers, run_produce_json=False):
+
+    # N worker processes on this host (same protocol as separate hosts), then the merge
+    start_time = time.time()
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "work", images_dir,
+                                 "--worker-id", f"{socket.gethostname()}-local{i}"])
+               for i in range(n_workers)]
+    for worker in workers:
+        worker.wait()
+    print(f"{n_workers} local workers finished in {time.time() - start_time:.1f} s")
+    merge_results(run_produce_json)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Reprocess an image archive with several workers sharing results/")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    work = subparsers.add_parser("work", help="claim and read boards until none is left")
+    work.add_argument("images_dir")
+    work.add_argument("--worker-id", help="default: <host>-<pid>")
+    local = subparsers.add_parser("local", help="run N workers on this host, then merge")
+    local.add_argument("images_dir")
+    local.add_argument("--workers", type=int, default=2)
+    local.add_argument("--json", action="store_true", help="also produce the .JSON files")
+    status = subparsers.add_parser("status", help="boards done, claimed, failed and waiting")
+    status.add_argument("images_dir")
+    merge = subparsers.add_parser("merge", help="consolidate the outputs of the workers")
+    merge.add_argument("--json", action="store_true", help="also produce the .JSON files")
+    args = parser.parse_args()
+
+    if args.command == "work":
+        run_worker(args.images_dir, args.worker_id)
+    elif args.command == "local":
+        run_local(args.images_dir, args.workers, args.json)
+    elif args.command == "status":
+        print_status(args.images_dir)
+    elif args.command == "merge":
+        merge_results(args.json)
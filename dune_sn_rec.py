@@ -0,0 +1,171 @@
+# Command line entry point for the serial number recognition pipeline:
+#
+#   dune-sn-rec crop FRONT.png BACK.png      read one board (crop_chips_FEMB.py)
+#   dune-sn-rec crop --batch images/         read every board in a directory
+#   dune-sn-rec crop --watch images/         keep watching the QC camera directory
+#   dune-sn-rec json                         produce the HWDB .JSON files (produce_json.py)
+#   dune-sn-rec upload                       send them to HWDB (upload_FEMBs.py)
+#   dune-sn-rec index serial 02454           look up chips in the results index (results_index.py)
+#   dune-sn-rec bench results/<board>        OCR latency over the stored chip crops
+#   dune-sn-rec bench --imports              startup cost of every subcommand
+#
+# Every subcommand imports what it needs when it runs, so quick tasks like
+# regenerating the JSON files never load OpenCV, the barcode decoders or the
+# OCR clients.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+
+# Modules loaded by each subcommand (used by "bench --imports")
+SUBCOMMAND_MODULES = {
+    "crop": "crop_chips_FEMB",
+    "json": "produce_json",
+    "upload": "upload_FEMBs",
+    "index": "results_index",
+}
+
+
+############################################################################################
+
+def run_crop(args):
+
+    import crop_chips_FEMB
+
+    if crop_chips_FEMB.use_job_store and crop_chips_FEMB.resume_unfinished:
+        crop_chips_FEMB.resume_unfinished_boards()
+
+    if args.watch:
+        import watch_folder
+        watch_folder.watch_folder(args.watch)
+    elif args.batch:
+        crop_chips_FEMB.run_batch(args.batch)
+    elif args.front and args.back:
+        crop_chips_FEMB.main_process(args.front, args.back)
+    else:
+        print("Give the FRONT and BACK images, --batch DIR or --watch DIR")
+        return 1
+
+    print("FEMB Processing complete!")
+    return 0
+
+############################################################################################
+
+def run_json(args):
+
+    import produce_json
+    produce_json.process_all_folders(args.base_dir, args.name)
+    return 0
+
+############################################################################################
+
+def run_upload(args):
+
+    import upload_FEMBs
+    upload_FEMBs.upload_all_boards(args.base_dir, refresh=args.refresh)
+    return 0
+
+############################################################################################
+
+def run_index(args):
+
+    import results_index
+    return results_index.main(["--base-dir", args.base_dir] + args.index_args)
+
+############################################################################################
+
+def measure_import_time(module):
+
+    # Cumulative import time (ms) of a module in a fresh interpreter, from -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    if result.returncode != 0:
+        print(f"Could not import {module}: {result.stderr.strip().splitlines()[-1]}")
+        return None
+
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s?(\S+)$", line)
+        if match and match.group(2) == module:
+            return int(match.group(1)) / 1000
+
+    return None
+
+
+def run_bench(args):
+
+    if args.imports:
+        for subcommand, module in SUBCOMMAND_MODULES.items():
+            import_ms = measure_import_time(module)
+            if import_ms is not None:
+                print(f"{subcommand:8s} imports {module}: {import_ms:.0f} ms")
+        return 0
+
+    if not args.board_dir:
+        print("Give a board directory (e.g. results/<FEMB>) or --imports")
+        return 1
+
+    import crop_chips_FEMB
+    from chip_specs import get_chip_type
+
+    crop_chips_FEMB.ocr_stream = args.stream
+    crop_chips_FEMB.start_warm_up()
+    crop_chips_FEMB.wait_for_warm_up()
+
+    for filename in sorted(os.listdir(args.board_dir)):
+        match = re.match(r"(front|back)_chip_(\d+)\.png$", filename)
+        if not match:
+            continue
+        side, chip_number = match.group(1), int(match.group(2))
+        ocr_result = crop_chips_FEMB.perform_ocr_minicpm(os.path.join(args.board_dir, filename),
+                                                         get_chip_type(chip_number, side))
+        print(f"{filename}: {ocr_result}")
+
+    crop_chips_FEMB.print_ocr_timing_summary()
+    crop_chips_FEMB.ocr_client.print_endpoint_stats()
+    return 0
+
+############################################################################################
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="dune-sn-rec", description="DUNE FEMB chip serial number recognition")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    crop = subparsers.add_parser("crop", help="crop the chips of a board and read them")
+    crop.add_argument("front", nargs="?", help="FEMB_FRONT_* image")
+    crop.add_argument("back", nargs="?", help="FEMB_BACK_* image")
+    crop.add_argument("--batch", metavar="DIR", help="read every FEMB_FRONT_*/FEMB_BACK_* pair in DIR")
+    crop.add_argument("--watch", metavar="DIR", help="read boards as they appear in DIR")
+    crop.set_defaults(func=run_crop)
+
+    json_parser = subparsers.add_parser("json", help="produce the HWDB .JSON file of every board")
+    json_parser.add_argument("--base-dir", default="results")
+    json_parser.add_argument("--name", default="Karla F.", help="who took the pictures")
+    json_parser.set_defaults(func=run_json)
+
+    upload = subparsers.add_parser("upload", help="upload the .JSON files and pictures to HWDB")
+    upload.add_argument("--base-dir", default="results")
+    upload.add_argument("--refresh", action="store_true", help="fetch the HWDB component list even if the cached one is recent")
+    upload.set_defaults(func=run_upload)
+
+    index = subparsers.add_parser("index", help="update or query the chip index (update|serial|lot|dates)")
+    index.add_argument("--base-dir", default="results")
+    index.add_argument("index_args", nargs=argparse.REMAINDER, help="e.g. serial 02454, lot N6Y381.00")
+    index.set_defaults(func=run_index)
+
+    bench = subparsers.add_parser("bench", help="measure OCR latency or startup time")
+    bench.add_argument("board_dir", nargs="?", help="board directory with the *_chip_*.png crops")
+    bench.add_argument("--stream", action="store_true", help="use streaming OCR with early stop")
+    bench.add_argument("--imports", action="store_true", help="measure the import time of each subcommand")
+    bench.set_defaults(func=run_bench)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
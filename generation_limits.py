@@ -0,0 +1,121 @@
+# Generation settings of the MiniCPM request, learned per chip type.
+
+# Every request used to ask for beam search (3 beams) and up to 2048 new
+# tokens, whatever the chip. The markings are short and their length is
+# known per chip type (4 fields for ColdADC, 6 for LArASIC), so the length of
+# the readings that passed validate_ocr_result is recorded per chip type in
+# results/generation_stats.json, and once there are enough of them:
+#   - the token cap is the longest valid reading seen, plus a margin
+#   - greedy decoding replaces beam search, as long as it validates about as
+#     often as beam search did (otherwise beam search comes back for that type)
+# A reading that fails validation with the tuned settings is read again with
+# the defaults (crop_chips_FEMB.py), so a cap that is too tight costs one
+# extra request, never a wrong serial number.
+
+import json
+import math
+import os
+import uuid
+
+
+# Configuration:
+generation_stats_path = os.path.join("results", "generation_stats.json")
+baseline_stats_path = None  # read-only statistics also used for the limits (distributed workers: the main file)
+min_samples = 30        # valid readings of a chip type before its settings are tuned
+token_margin = 1.25     # cap = longest valid reading x margin + extra_tokens
+extra_tokens = 4
+history_size = 500      # token counts kept per chip type
+max_valid_rate_drop = 0.02  # greedy decoding may validate this much less often than the defaults
+
+DEFAULT_LIMITS = {"num_predict": 42, "max_new_tokens": 2048, "num_beams": 3, "decode_type": "beam_search", "tuned": False}
+
+
+############################################################################################
+
+def load_stats(path=None):
+
+    path = path or generation_stats_path
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_stats(stats, path=None):
+
+    path = path or generation_stats_path
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # Unique temporary name: other processes may save at the same time
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(stats, f)
+    os.replace(temp_path, path)
+
+############################################################################################
+
+def generation_key(chip_type, sn_only=False, structured=False):
+
+    # Output lengths differ between free text, JSON and serial-number-only readings
+    return f"{chip_type}:{'json' if structured else 'sn' if sn_only else 'text'}"
+
+
+def new_entry():
+
+    return {"tokens": [], "beam_search": {"valid": 0, "total": 0}, "greedy": {"valid": 0, "total": 0}}
+
+
+def record(stats, key, tokens, valid, decode_type):
+
+    entry = stats.setdefault(key, new_entry())
+    counts = entry["greedy" if decode_type == "greedy" else "beam_search"]
+    counts["total"] += 1
+    if valid:
+        counts["valid"] += 1
+        if tokens:
+            entry["tokens"] = (entry["tokens"] + [tokens])[-history_size:]
+
+
+def merge_stats(stats, other):
+
+    # Adds the readings of other (e.g. the file of a distributed worker) to stats
+    for key, entry in other.items():
+        target = stats.setdefault(key, new_entry())
+        target["tokens"] = (target["tokens"] + entry["tokens"])[-history_size:]
+        for decode_type in ("beam_search", "greedy"):
+            target[decode_type]["valid"] += entry[decode_type]["valid"]
+            target[decode_type]["total"] += entry[decode_type]["total"]
+    return stats
+
+############################################################################################
+
+def valid_rate(counts):
+
+    return counts["valid"] / counts["total"] if counts["total"] else None
+
+
+def get_limits(stats, key):
+
+    entry = stats.get(key)
+    if not entry or len(entry["tokens"]) < min_samples:
+        return dict(DEFAULT_LIMITS)
+
+    cap = int(math.ceil(max(entry["tokens"]) * token_margin)) + extra_tokens
+    cap = min(cap, DEFAULT_LIMITS["max_new_tokens"])
+
+    # Greedy unless it proved worse than beam search for this chip type
+    # (then it stays beam search: delete the stats file to try again)
+    beam_rate = valid_rate(entry["beam_search"])
+    greedy_rate = valid_rate(entry["greedy"])
+    greedy = (entry["greedy"]["total"] < min_samples or beam_rate is None
+              or greedy_rate >= beam_rate - max_valid_rate_drop)
+
+    return {"num_predict": cap, "max_new_tokens": cap,
+            "num_beams": 1 if greedy else DEFAULT_LIMITS["num_beams"],
+            "decode_type": "greedy" if greedy else "beam_search", "tuned": True}
+
+
+def describe_limits(limits):
+
+    return f"{'tuned' if limits['tuned'] else 'defaults'} ({limits['decode_type']}, {limits['num_predict']} tokens)"
@@ -0,0 +1,438 @@
+# Continuous mode: each board goes to the HWDB as soon as it is read.
+
+# Instead of waiting for produce_json.py and upload_FEMBs.py to run over the
+# whole results tree, crop_chips_FEMB.py (stream_to_hwdb = True) hands every
+# board to stream_board once it is read. A board whose chips all passed
+# validation, with every serial number found and matching the results index, and
+# no blocking consistency issue (check_consistency.py, against the chips already
+# in the results index), has
+# its HWDB record built from the results text still in memory. The .JSON file is
+# written to the board directory as usual, and the record is uploaded with the
+# reduced pictures by a background thread, so the next board is read meanwhile.
+
+# Every upload is recorded in results/upload_queue.db first: uploads that fail
+# (HWDB unreachable, request refused) are retried by the same thread after
+# retry_interval seconds, doubled after every failure, and the ones left when
+# the program stops are retried the next time it starts.
+
+#   python hwdb_stream.py list            uploads waiting for a retry (--all for every board)
+#   python hwdb_stream.py retry           retry them now (not while a reading is uploading)
+
+import argparse
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no guard against a second uploader
+    fcntl = None
+
+import board_archive
+import check_consistency
+import produce_json
+import upload_FEMBs
+
+
+# Configuration:
+upload_queue_path = os.path.join("results", "upload_queue.db")
+operator_name = produce_json.NAME   # "Picture taken on ..., by <name>" in the HWDB comments
+check_consistency_first = True      # hold back boards with a blocking issue (duplicate serial, bad date code)
+retry_interval = 60                 # seconds before the first retry, doubled after every failure
+max_retry_interval = 3600
+
+_upload_queue = queue.Queue()
+_uploader_thread = None
+_uploader_lock = threading.Lock()
+_upload_pass_lock = threading.Lock()  # held while the uploader thread is sending
+_queue_conn = None
+_uploader_lock_file = None            # held by the process whose uploader thread is running
+_lock_warning_shown = False
+
+# HWDB components known to the uploader thread (see upload_FEMBs.load_hwdb_components)
+_hwdb_components = None
+_hwdb_fetched = None
+
+
+############################################################################################
+
+def open_upload_queue(path=None):
+
+    path = path or upload_queue_path
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    # state: pending -> uploaded | retry -> uploaded
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS uploads (
+            board_dir TEXT PRIMARY KEY,
+            femb_id TEXT,
+            record TEXT NOT NULL,
+            front_image TEXT,
+            back_image TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL,
+            last_error TEXT,
+            created REAL,
+            uploaded REAL
+        );
+        CREATE INDEX IF NOT EXISTS uploads_state ON uploads (state, next_attempt);
+    """)
+    conn.commit()
+
+    return conn
+
+
+def get_queue_conn():
+
+    # Connection of the reading thread (the uploader thread opens its own)
+    global _queue_conn
+    if _queue_conn is None:
+        _queue_conn = open_upload_queue()
+    return _queue_conn
+
+############################################################################################
+
+def board_issues(conn, board_dir):
+
+    # Blocking consistency issues of one board: its own chips, plus the chips
+    # of the other boards sharing one of its serial numbers
+    board_dir = os.path.abspath(board_dir)
+    chips = conn.execute("""
+        SELECT * FROM chips WHERE board_dir = ?
+        OR serial IN (SELECT serial FROM chips WHERE board_dir = ? AND serial IS NOT NULL AND serial != '')
+    """, (board_dir, board_dir)).fetchall()
+
+    return [issue for issue in check_consistency.check_chips(chips)
+            if issue[1] == board_dir and issue[0] in check_consistency.blocking_issues]
+
+
+def index_mismatches(conn, board_dir, specifications):
+
+    # Serial numbers of the record differing from the ones in the results index
+    # for this board (the record and the index are two readings of the same text)
+    index_serials = {(row["side"], row["chip"]): row["serial"] for row in
+                     conn.execute("SELECT side, chip, serial FROM chips WHERE board_dir = ?",
+                                  (os.path.abspath(board_dir),))}
+
+    mismatches = []
+    for field, side, chip_index, _, _ in produce_json.SPECIFICATION_CHIPS:
+        index_serial = index_serials.get((side, chip_index))
+        if index_serial != specifications[field]:
+            mismatches.append((field, specifications[field], index_serial))
+    return mismatches
+
+
+def stream_board(board_dir, front_text, back_text, all_valid, index_conn=None):
+
+    # Builds the HWDB record of a board from its results text and queues its upload.
+    # Returns False when the board is held back (then produce_json.py and
+    # upload_FEMBs.py pick it up once the review queue is cleared).
+    if not all_valid:
+        print("Not uploaded to the HWDB: some chips failed validation (see the review queue)")
+        return False
+
+    record = produce_json.build_record(front_text.splitlines(keepends=True), back_text.splitlines(keepends=True),
+                                       operator_name)
+    specifications = record["specifications"]
+    missing = [name for name, value in specifications.items() if value == "Not found"]
+    if missing:
+        print(f"Not uploaded to the HWDB: {', '.join(missing)} not found")
+        return False
+
+    # Without the index (e.g. update_results_index = False) there is nothing to compare with
+    if index_conn is not None:
+        mismatches = index_mismatches(index_conn, board_dir, specifications)
+        if mismatches:
+            for field, serial, index_serial in mismatches:
+                print(f"(!) {field}: {serial} in the record, {index_serial or 'none'} in the results index")
+            print("Not uploaded to the HWDB: record and results index differ")
+            return False
+
+    if check_consistency_first and index_conn is not None:
+        issues = board_issues(index_conn, board_dir)
+        if issues:
+            for kind, _, femb_id, side, chip_number, message in issues:
+                print(f"(!) {kind}: {femb_id} {side} chip {chip_number}: {message}")
+            print("Not uploaded to the HWDB: consistency check failed")
+            return False
+
+    # Same .JSON file as produce_json.py, for upload_FEMBs.py and review_queue.py
+    data = json.dumps(record, indent=4)
+    json_file = produce_json.json_path(board_dir, specifications["FEMB ID"])
+    board_archive.write_file(json_file, data)
+
+    queue_upload(board_dir, specifications["FEMB ID"], data,
+                 os.path.join(board_dir, "FEMB_FRONT_reduced.png"), os.path.join(board_dir, "FEMB_BACK_reduced.png"))
+    print(f"{specifications['FEMB ID']} queued for upload to the HWDB")
+    return True
+
+############################################################################################
+
+def queue_upload(board_dir, femb_id, record, front_image, back_image):
+
+    # Recorded first, so an upload interrupted by a crash is retried on the next start.
+    # A board read again replaces its previous upload.
+    conn = get_queue_conn()
+    with conn:
+        conn.execute("""
+            INSERT INTO uploads (board_dir, femb_id, record, front_image, back_image, state, attempts, next_attempt, created)
+            VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?)
+            ON CONFLICT (board_dir) DO UPDATE SET
+                femb_id = excluded.femb_id, record = excluded.record, front_image = excluded.front_image,
+                back_image = excluded.back_image, state = 'pending', attempts = 0, next_attempt = excluded.next_attempt,
+                last_error = NULL, created = excluded.created, uploaded = NULL
+        """, (os.path.abspath(board_dir), femb_id, record, os.path.abspath(front_image), os.path.abspath(back_image),
+              time.time(), time.time()))
+
+    start_uploader()
+    _upload_queue.put(board_dir)
+
+
+def start_uploader():
+
+    # Also picks up the retries left by a previous run
+    global _uploader_thread
+    with _uploader_lock:
+        if _uploader_thread is None or not _uploader_thread.is_alive():
+            _uploader_thread = threading.Thread(target=_uploader_loop, name="hwdb-uploader", daemon=True)
+            _uploader_thread.start()
+
+
+def lock_uploads():
+
+    # One uploader per upload queue: a second one (another reading, or
+    # "hwdb_stream.py retry") could create the same component again.
+    # Returns False when another process holds the lock.
+    global _uploader_lock_file
+    if fcntl is None or _uploader_lock_file is not None:
+        return True
+
+    lock_file = open(f"{upload_queue_path}.lock", 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    _uploader_lock_file = lock_file
+    return True
+
+
+def unlock_uploads():
+
+    global _uploader_lock_file
+    if _uploader_lock_file is not None:
+        fcntl.flock(_uploader_lock_file, fcntl.LOCK_UN)
+        _uploader_lock_file.close()
+        _uploader_lock_file = None
+
+
+def flush_uploads():
+
+    # Wait until every board queued so far was uploaded (or put back for a retry),
+    # and for a retry being sent at the time
+    _upload_queue.join()
+    with _upload_pass_lock:
+        pass
+
+############################################################################################
+
+def get_hwdb_components():
+
+    # Fetched again once the cached list is older than upload_FEMBs.hwdb_cache_ttl
+    global _hwdb_components, _hwdb_fetched
+    if _hwdb_components is None or time.time() - _hwdb_fetched >= upload_FEMBs.hwdb_cache_ttl:
+        cache_path = os.path.join(os.path.dirname(upload_queue_path), upload_FEMBs.hwdb_cache_file)
+        _hwdb_components, _hwdb_fetched = upload_FEMBs.load_hwdb_components(cache_path)
+    return _hwdb_components
+
+
+def save_hwdb_components():
+
+    cache_path = os.path.join(os.path.dirname(upload_queue_path), upload_FEMBs.hwdb_cache_file)
+    upload_FEMBs.save_hwdb_components(cache_path, _hwdb_components, _hwdb_fetched)
+
+
+def schedule_retry(conn, row, error):
+
+    attempts = row["attempts"] + 1
+    delay = min(retry_interval * 2 ** (attempts - 1), max_retry_interval)
+    with conn:
+        conn.execute("UPDATE uploads SET state = 'retry', attempts = ?, next_attempt = ?, last_error = ? WHERE board_dir = ?",
+                     (attempts, time.time() + delay, error, row["board_dir"]))
+    print(f"Error: upload of {row['femb_id']} to the HWDB failed ({error}), retrying in {delay:.0f} s")
+
+
+def upload_due(conn):
+
+    # Uploads every board whose (first or next) attempt is due
+    rows = conn.execute("""
+        SELECT * FROM uploads WHERE state IN ('pending', 'retry') AND next_attempt <= ? ORDER BY next_attempt
+    """, (time.time(),)).fetchall()
+    if not rows:
+        return 0
+
+    # Without the list, every board would be created again
+    try:
+        hwdb_components = get_hwdb_components()
+    except Exception as e:
+        print(f"Error: {e}")
+        hwdb_components = None
+    if hwdb_components is None:
+        for row in rows:
+            schedule_retry(conn, row, "could not fetch the FEMB components from the HWDB")
+        return 0
+
+    uploaded = 0
+    changed = False
+    for row in rows:
+        try:
+            outcome = upload_FEMBs.upload_board(row["record"].encode('utf-8'), row["front_image"], row["back_image"],
+                                                hwdb_components, row["board_dir"])
+        except Exception as e:
+            schedule_retry(conn, row, str(e))
+            continue
+        if outcome is None:
+            # (the board may have been created, with its pictures still pending)
+            changed = True
+            schedule_retry(conn, row, "request refused by the HWDB")
+            continue
+
+        changed = changed or outcome in ("created", "updated")
+        uploaded += 1
+        with conn:
+            conn.execute("UPDATE uploads SET state = 'uploaded', attempts = attempts + 1, last_error = NULL, uploaded = ? "
+                         "WHERE board_dir = ?", (time.time(), row["board_dir"]))
+        if outcome == "unchanged":
+            print(f"{row['femb_id']} already up to date in the HWDB")
+
+    # Keep the cache in step with what was just sent (its age stays the one of the fetched list)
+    if changed:
+        save_hwdb_components()
+
+    return uploaded
+
+
+def next_due(conn):
+
+    # Seconds until the next retry, None if there is none
+    row = conn.execute("SELECT MIN(next_attempt) FROM uploads WHERE state IN ('pending', 'retry')").fetchone()
+    return None if row[0] is None else max(0.0, row[0] - time.time())
+
+
+def _uploader_loop():
+
+    global _lock_warning_shown
+    conn = open_upload_queue()
+    while True:
+        # Woken up by a new board, or when the next retry is due (checking at least
+        # every retry_interval while another process holds the uploads)
+        timeout = next_due(conn)
+        if _uploader_lock_file is None and timeout is not None:
+            timeout = min(timeout, retry_interval)
+        try:
+            _upload_queue.get(timeout=timeout)
+            woken = 1
+        except queue.Empty:
+            woken = 0
+
+        # Boards queued meanwhile go in the same pass
+        while True:
+            try:
+                _upload_queue.get_nowait()
+                woken += 1
+            except queue.Empty:
+                break
+
+        failed = False
+        try:
+            with _upload_pass_lock:
+                # The boards stay in the queue until the other uploader is done
+                if lock_uploads():
+                    upload_due(conn)
+                    _lock_warning_shown = False
+                elif not _lock_warning_shown:
+                    print(f"Error: {upload_queue_path} is in use by another uploader, the uploads wait for it")
+                    _lock_warning_shown = True
+        except Exception as e:
+            print(f"Error uploading to the HWDB: {e}")
+            failed = True
+        for _ in range(woken):
+            _upload_queue.task_done()
+
+        # e.g. the queue database locked: wait, rather than trying again at once
+        if failed:
+            time.sleep(retry_interval)
+
+
+atexit.register(flush_uploads)
+
+############################################################################################
+
+def list_uploads(conn, show_all=False):
+
+    states = ("pending", "retry", "uploaded") if show_all else ("pending", "retry")
+    rows = conn.execute(f"SELECT * FROM uploads WHERE state IN ({', '.join('?' * len(states))}) ORDER BY created",
+                        states).fetchall()
+    for row in rows:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["uploaded"] or row["next_attempt"]))
+        error = f"  ({row['last_error']})" if row["last_error"] else ""
+        print(f"{row['femb_id']}  {row['state']:8s} {row['attempts']} attempts  {when}{error}")
+    print(f"{len(rows)} boards")
+
+
+def retry_now(conn):
+
+    if not lock_uploads():
+        print(f"Error: {upload_queue_path} is in use by a running reading, its uploader retries the boards itself")
+        return
+
+    with conn:
+        conn.execute("UPDATE uploads SET next_attempt = ? WHERE state = 'retry'", (time.time(),))
+    try:
+        uploaded = upload_due(conn)
+    finally:
+        unlock_uploads()
+    print(f"{uploaded} boards uploaded")
+
+
+def main(argv=None):
+
+    global upload_queue_path
+
+    parser = argparse.ArgumentParser(description="HWDB uploads of the continuous mode")
+    parser.add_argument("--queue", default=None, help=f"upload queue (default {upload_queue_path})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="uploads waiting for a retry")
+    list_parser.add_argument("--all", action="store_true", help="also the boards already uploaded")
+    subparsers.add_parser("retry", help="retry the failed uploads now")
+
+    args = parser.parse_args(argv)
+    if args.queue:
+        upload_queue_path = args.queue
+    conn = open_upload_queue()
+
+    if args.command == "list":
+        list_uploads(conn, args.all)
+    elif args.command == "retry":
+        retry_now(conn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# Persistent job store for the serial number recognition (SQLite).
+
+# Keeps the state of every board and every chip, so a crash or a model
+# server hiccup never costs more than the chip being read:
+#   board: pending -> done | failed
+#   chip:  pending -> ocr_done (OCR answered) -> validated (passed validate_ocr_result)
+#                  -> failed (no usable answer after the retries)
+# Rerunning a board reuses every chip that already has an OCR result, as long
+# as its pictures were not replaced (their modification time and size are part
+# of the board key, so a board photographed again is read from scratch).
+
+import os
+import sqlite3
+import threading
+import time
+
+
+# Default location, next to the board directories
+job_store_path = os.path.join("results", "jobs.db")
+
+_store_lock = threading.Lock()
+
+
+############################################################################################
+
+def open_job_store(path=None):
+
+    path = path or job_store_path
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS boards (
+            board_key TEXT PRIMARY KEY,
+            image_path_front TEXT,
+            image_path_back TEXT,
+            directory_name TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            updated REAL
+        );
+        CREATE TABLE IF NOT EXISTS chips (
+            board_key TEXT NOT NULL,
+            side TEXT NOT NULL,
+            chip INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            ocr_result TEXT,
+            sn_only INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated REAL,
+            PRIMARY KEY (board_key, side, chip)
+        );
+        CREATE INDEX IF NOT EXISTS boards_state ON boards (state);
+    """)
+    conn.commit()
+
+    return conn
+
+############################################################################################
+
+def image_stamp(image_path):
+
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return os.path.abspath(image_path)
+    return f"{os.path.abspath(image_path)}@{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def make_board_key(image_path_front, image_path_back):
+
+    return f"{image_stamp(image_path_front)}|{image_stamp(image_path_back)}"
+
+############################################################################################
+
+def start_board(conn, board_key, image_path_front, image_path_back, directory_name=None):
+
+    with _store_lock, conn:
+        # Earlier pictures of the same board (replaced since): their checkpoints are stale
+        # and they must not be resumed
+        stale_keys = [row["board_key"] for row in conn.execute(
+            "SELECT board_key FROM boards WHERE image_path_front = ? AND image_path_back = ? AND board_key != ?",
+            (image_path_front, image_path_back, board_key))]
+        for stale_key in stale_keys:
+            conn.execute("DELETE FROM chips WHERE board_key = ?", (stale_key,))
+            conn.execute("DELETE FROM boards WHERE board_key = ?", (stale_key,))
+
+        conn.execute("""
+            INSERT INTO boards (board_key, image_path_front, image_path_back, directory_name, state, updated)
+            VALUES (?, ?, ?, ?, 'pending', ?)
+            ON CONFLICT (board_key) DO UPDATE SET
+                directory_name = COALESCE(excluded.directory_name, directory_name),
+                state = 'pending', updated = excluded.updated
+        """, (board_key, image_path_front, image_path_back, directory_name, time.time()))
+
+############################################################################################
+
+def finish_board(conn, board_key):
+
+    # A board is done only if none of its chips failed
+    with _store_lock, conn:
+        failed = conn.execute("SELECT COUNT(*) FROM chips WHERE board_key = ? AND state = 'failed'",
+                              (board_key,)).fetchone()[0]
+        state = 'failed' if failed else 'done'
+        conn.execute("UPDATE boards SET state = ?, updated = ? WHERE board_key = ?",
+                     (state, time.time(), board_key))
+
+    return state
+
+def fail_board(conn, board_key):
+
+    # e.g. files of the board could not be written: read it again on the next run
+    with _store_lock, conn:
+        conn.execute("UPDATE boards SET state = 'failed', updated = ? WHERE board_key = ?", (time.time(), board_key))
+
+############################################################################################
+
+def get_board_state(conn, board_key):
+
+    with _store_lock:
+        row = conn.execute("SELECT state FROM boards WHERE board_key = ?", (board_key,)).fetchone()
+    return row["state"] if row else None
+
+############################################################################################
+
+def unfinished_boards(conn):
+
+    with _store_lock:
+        rows = conn.execute("SELECT image_path_front, image_path_back FROM boards "
+                            "WHERE state != 'done' ORDER BY updated").fetchall()
+    return [(row["image_path_front"], row["image_path_back"]) for row in rows]
+
+############################################################################################
+
+def get_chip(conn, board_key, side, chip):
+
+    with _store_lock:
+        row = conn.execute("SELECT * FROM chips WHERE board_key = ? AND side = ? AND chip = ?",
+                           (board_key, side, chip)).fetchone()
+    return dict(row) if row else None
+
+############################################################################################
+
+def record_chip(conn, board_key, side, chip, state, ocr_result=None, sn_only=False, error=None):
+
+    with _store_lock, conn:
+        conn.execute("""
+            INSERT INTO chips (board_key, side, chip, state, ocr_result, sn_only, error, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (board_key, side, chip) DO UPDATE SET
+                state = excluded.state,
+                ocr_result = COALESCE(excluded.ocr_result, ocr_result),
+                sn_only = excluded.sn_only,
+                error = excluded.error,
+                updated = excluded.updated
+        """, (board_key, side, chip, state, ocr_result, int(sn_only), error, time.time()))
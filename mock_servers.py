@@ -0,0 +1,371 @@
+# Local mock servers, to try the pipeline without the real services
+# (the tests start them in-process, see make_server and tests/conftest.py).
+
+#   python mock_servers.py minicpm --port 11500 --delay 1.0 [--failures N]
+#       Ollama-style /api/generate answering with a fixed chip marking
+#       (start several on different ports and list them in minicpm_urls);
+#       the first N requests get a 500 error (circuit breaker of ocr_client.py)
+#   python mock_servers.py hwdb --port 8443 [--image-failures N]
+#       HWDB REST API for the FEMB components (paged list, create, update,
+#       images), kept in memory; set api_url = 'http://127.0.0.1:8443/cdbdev/api'
+#       and curl_command = ['curl'] in upload_FEMBs.py. The first N picture
+#       uploads are answered with an error (pending pictures)
+#   python mock_servers.py openai --port 8900 --rpm 60
+#       OpenAI chat completions (answering 429 with retry-after above --rpm
+#       requests per minute), files and Batch API; set
+#       openai_base_url = 'http://127.0.0.1:8900/v1' in read_sn_gpt_api.py
+
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Sample values for the structured-output fields, by field pattern
+SAMPLE_FIELD_VALUES = {
+    r"^[A-Za-z0-9]+\.[A-Za-z0-9]+$": "N6Y381.00",
+    r"^\d{5}$": "02454",
+    r"^\d{4}$": "2315",
+    r"^[A-Z0-9]+$": "P5B",
+    r"^\d{2}/\d{2}$": "23/16",
+    r"^\d{3}-\d{5}$": "003-04637",
+}
+
+
+############################################################################################
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    server_version = "MockServer/1.0"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+############################################################################################
+
+class MiniCPMHandler(MockHandler):
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            self.send_json({"error": "not found"}, 404)
+            return
+
+        request = self.read_json()
+        self.server.requests += 1
+
+        with self.server.lock:
+            failed = self.server.failures > 0
+            self.server.failures -= failed
+        if failed:
+            self.send_json({"error": "model runner crashed"}, 500)
+            return
+
+        # Warm-up request (no prompt): just "load" the model
+        if not request.get("prompt"):
+            self.send_json({"model": request.get("model"), "response": "", "done": True})
+            return
+
+        if request.get("format"):
+            properties = request["format"].get("properties", {})
+            answer = json.dumps({name: SAMPLE_FIELD_VALUES.get(field.get("pattern"), "X")
+                                 for name, field in properties.items()})
+            tokens = re.findall(r'[^,]+,?', answer)
+        elif "serial number" in request["prompt"]:
+            answer = self.server.answer.split()[-1]
+            tokens = [answer]
+        else:
+            answer = self.server.answer
+            tokens = [word + " " for word in answer.split()]
+
+        if not request.get("stream", True):
+            time.sleep(self.server.delay)
+            self.send_json({"model": request.get("model"), "response": answer, "done": True,
+                            "eval_count": len(tokens), "eval_duration": int(self.server.delay * 1e9)})
+            return
+
+        # Streamed answer, one chunk per token
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            time.sleep(self.server.delay / 2)  # prompt evaluation
+            for token in tokens:
+                time.sleep(self.server.delay / 2 / len(tokens))
+                self.wfile.write(json.dumps({"response": token, "done": False}).encode() + b"\n")
+                self.wfile.flush()
+            self.wfile.write(json.dumps({"response": "", "done": True, "eval_count": len(tokens),
+                                         "eval_duration": int(self.server.delay / 2 * 1e9)}).encode() + b"\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client stopped reading (early stop)
+
+############################################################################################
+
+class HWDBHandler(MockHandler):
+
+    # /cdbdev/api/component-types/<type>/components   GET (paged) / POST
+    # /cdbdev/api/components/<part_id>                 GET / PATCH
+    # /cdbdev/api/components/<part_id>/images          POST
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests += 1
+
+        match = re.fullmatch(r"/cdbdev/api/component-types/([^/]+)/components", url.path)
+        if match:
+            query = parse_qs(url.query)
+            page = int(query.get("page", ["1"])[0])
+            size = int(query.get("size", ["100"])[0])
+            with self.server.lock:
+                components = [c for c in self.server.components.values() if c["part_type_id"] == match.group(1)]
+            pages = max(1, -(-len(components) // size))
+            self.send_json({"data": components[(page - 1) * size:page * size], "status": "OK",
+                            "pagination": {"page": page, "page_size": size, "pages": pages, "total": len(components)}})
+            return
+
+        match = re.fullmatch(r"/cdbdev/api/components/([^/]+)", url.path)
+        if match and match.group(1) in self.server.components:
+            self.send_json({"data": self.server.components[match.group(1)], "status": "OK"})
+            return
+
+        self.send_json({"status": "ERROR", "data": "not found"}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.server.requests += 1
+
+        match = re.fullmatch(r"/cdbdev/api/component-types/([^/]+)/components", url.path)
+        if match:
+            record = self.read_json()
+            with self.server.lock:
+                part_id = f"{match.group(1)}-{len(self.server.components) + 1:05d}"
+                self.server.components[part_id] = {"part_id": part_id, "part_type_id": match.group(1),
+                                                   "specifications": [record.get("specifications", {})]}
+            self.send_json({"part_id": part_id, "status": "OK"})
+            return
+
+        match = re.fullmatch(r"/cdbdev/api/components/([^/]+)/images", url.path)
+        if match and match.group(1) in self.server.components:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with self.server.lock:
+                failed = self.server.image_failures > 0
+                self.server.image_failures -= failed
+            if failed:
+                self.send_json({"status": "ERROR", "data": "image upload failed"}, 500)
+                return
+            with self.server.lock:
+                self.server.images[match.group(1)] = self.server.images.get(match.group(1), 0) + 1
+            self.send_json({"status": "OK"})
+            return
+
+        self.send_json({"status": "ERROR", "data": "not found"}, 404)
+
+    def do_PATCH(self):
+        match = re.fullmatch(r"/cdbdev/api/components/([^/]+)", urlparse(self.path).path)
+        self.server.requests += 1
+        if not match or match.group(1) not in self.server.components:
+            self.send_json({"status": "ERROR", "data": "not found"}, 404)
+            return
+
+        record = self.read_json()
+        with self.server.lock:
+            self.server.components[match.group(1)]["specifications"].append(record.get("specifications", {}))
+        self.send_json({"part_id": match.group(1), "status": "OK"})
+
+############################################################################################
+
+class OpenAIHandler(MockHandler):
+
+    # /v1/chat/completions                  POST (rate limited to --rpm per minute)
+    # /v1/files, /v1/files/<id>/content     POST (multipart) / GET
+    # /v1/batches, /v1/batches/<id>         POST / GET (a batch is done at once)
+
+    def completion(self, request):
+        prompt_tokens = 300
+        completion_tokens = 2 * len(self.server.answer.split())
+        return {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion", "created": int(time.time()),
+                "model": request.get("model", "gpt-4o"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.server.answer},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}}
+
+    def rate_limited(self):
+        # Seconds until the next request is allowed, 0 if this one is
+        with self.server.lock:
+            now = time.time()
+            recent = self.server.recent
+            while recent and recent[0] < now - self.server.rate_window:
+                recent.popleft()
+            if self.server.rpm and len(recent) >= self.server.rpm:
+                return recent[0] + self.server.rate_window - now
+            recent.append(now)
+            return 0
+
+    def batch_object(self, batch):
+        return dict(batch, object="batch", endpoint="/v1/chat/completions", completion_window="24h")
+
+    def do_POST(self):
+        self.server.requests += 1
+
+        if self.path == "/v1/chat/completions":
+            request = self.read_json()
+            wait = self.rate_limited()
+            if wait:
+                self.server.rejected += 1
+                self.send_json({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                               429, {"retry-after": f"{wait:.2f}"})
+                return
+            time.sleep(self.server.delay)
+            self.send_json(self.completion(request))
+            return
+
+        if self.path == "/v1/files":
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            message = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            data = fields["file"].get_payload(decode=True)
+            file_id = f"file-{uuid.uuid4().hex[:12]}"
+            with self.server.lock:
+                self.server.files[file_id] = data
+            self.send_json({"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                            "filename": fields["file"].get_filename() or "upload", "purpose": "batch"})
+            return
+
+        if self.path == "/v1/batches":
+            request = self.read_json()
+            output = []
+            for line in self.server.files.get(request.get("input_file_id"), b"").decode().splitlines():
+                if line.strip():
+                    item = json.loads(line)
+                    output.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": item["custom_id"],
+                                              "response": {"status_code": 200, "body": self.completion(item["body"])},
+                                              "error": None}))
+            batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+            output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+            with self.server.lock:
+                self.server.files[output_file_id] = "\n".join(output).encode()
+                self.server.batches[batch_id] = {"id": batch_id, "input_file_id": request.get("input_file_id"),
+                                                 "status": "completed", "output_file_id": output_file_id,
+                                                 "created_at": int(time.time()),
+                                                 "request_counts": {"total": len(output), "completed": len(output), "failed": 0}}
+            self.send_json(self.batch_object(self.server.batches[batch_id]))
+            return
+
+        self.send_json({"error": {"message": "not found"}}, 404)
+
+    def do_GET(self):
+        self.server.requests += 1
+
+        match = re.fullmatch(r"/v1/batches/([^/]+)", self.path)
+        if match and match.group(1) in self.server.batches:
+            self.send_json(self.batch_object(self.server.batches[match.group(1)]))
+            return
+
+        match = re.fullmatch(r"/v1/files/([^/]+)/content", self.path)
+        if match and match.group(1) in self.server.files:
+            body = self.server.files[match.group(1)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_json({"error": {"message": "not found"}}, 404)
+
+############################################################################################
+
+def make_server(handler, port=0, quiet=True, **settings):
+
+    # Port 0: any free port (server.server_port)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.quiet = quiet
+    server.requests = 0
+    for name, value in settings.items():
+        setattr(server, name, value)
+    return server
+
+
+def minicpm_settings(delay=1.0, answer="ColdADC N6Y381.00 02454 2315", failures=0):
+
+    return {"delay": delay, "answer": answer, "failures": failures, "lock": threading.Lock()}
+
+
+def openai_settings(delay=0.5, rpm=0, answer="ColdADC N6Y381.00 02454 2315", rate_window=60):
+
+    # rpm requests per rate_window seconds (shorter windows for the tests)
+    return {"delay": delay, "rpm": rpm, "answer": answer, "rate_window": rate_window, "recent": deque(),
+            "rejected": 0, "files": {}, "batches": {}, "lock": threading.Lock()}
+
+
+def hwdb_settings(image_failures=0):
+
+    return {"components": {}, "images": {}, "image_failures": image_failures, "lock": threading.Lock()}
+
+
+def run_server(handler, port, quiet, **settings):
+
+    server = make_server(handler, port, quiet, **settings)
+
+    print(f"Mock {handler.__name__[:-len('Handler')]} server on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local mock servers for the DUNE-sn-rec pipeline")
+    parser.add_argument("--quiet", action="store_true", help="do not log every request")
+    subparsers = parser.add_subparsers(dest="server", required=True)
+
+    minicpm = subparsers.add_parser("minicpm", help="Ollama-style MiniCPM /api/generate")
+    minicpm.add_argument("--port", type=int, default=11500)
+    minicpm.add_argument("--delay", type=float, default=1.0, help="seconds per generation")
+    minicpm.add_argument("--answer", default="ColdADC N6Y381.00 02454 2315")
+    minicpm.add_argument("--failures", type=int, default=0, help="requests to answer with a 500 error")
+
+    hwdb = subparsers.add_parser("hwdb", help="HWDB REST API (FEMB components)")
+    hwdb.add_argument("--port", type=int, default=8443)
+    hwdb.add_argument("--image-failures", type=int, default=0, help="picture uploads to answer with an error")
+
+    openai_parser = subparsers.add_parser("openai", help="OpenAI chat completions, files and Batch API")
+    openai_parser.add_argument("--port", type=int, default=8900)
+    openai_parser.add_argument("--delay", type=float, default=0.5, help="seconds per completion")
+    openai_parser.add_argument("--rpm", type=int, default=0, help="requests per minute before answering 429 (0: no limit)")
+    openai_parser.add_argument("--answer", default="ColdADC N6Y381.00 02454 2315")
+
+    args = parser.parse_args()
+
+    if args.server == "minicpm":
+        run_server(MiniCPMHandler, args.port, args.quiet, **minicpm_settings(args.delay, args.answer, args.failures))
+    elif args.server == "hwdb":
+        run_server(HWDBHandler, args.port, args.quiet, **hwdb_settings(args.image_failures))
+    elif args.server == "openai":
+        run_server(OpenAIHandler, args.port, args.quiet, **openai_settings(args.delay, args.rpm, args.answer))
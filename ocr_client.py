@@ -0,0 +1,191 @@
+# HTTP client for the MiniCPM model servers (Ollama-style /api/generate).
+
+# - connect/read timeouts, so a hung server cannot stall the pipeline
+# - bounded retries, trying the next endpoint after a failure
+# - a circuit breaker per endpoint: after a few consecutive failures the
+#   endpoint is skipped for a cool-down period; if every endpoint is down,
+#   submissions pause until the first one may be tried again
+# - least-outstanding-requests routing over the healthy endpoints, with a
+#   limit of requests in flight per endpoint (one model host can only run
+#   so many generations at once)
+# - per-endpoint statistics (requests, failures, latency, throughput)
+
+import json
+import threading
+import time
+
+import requests
+
+
+# Configuration:
+connect_timeout = 5.0     # seconds
+read_timeout = 120.0      # seconds, a whole generation must fit in here
+max_attempts = 3          # per request, over all endpoints
+breaker_failures = 3      # consecutive failures that open the circuit of an endpoint
+breaker_cooldown = 30.0   # seconds an open endpoint is skipped
+max_in_flight = 2         # requests in flight per endpoint ...
+endpoint_max_in_flight = {}  # ... or per URL, e.g. {"http://gpu-host-2:11434/api/generate": 4}
+
+_session = requests.Session()
+_lock = threading.Condition()
+_endpoint_state = {}
+
+
+############################################################################################
+
+def _state(url):
+
+    if url not in _endpoint_state:
+        _endpoint_state[url] = {"failures": 0, "open_until": 0.0, "in_flight": 0,
+                                "requests": 0, "errors": 0, "busy_time": 0.0, "first_use": None}
+    return _endpoint_state[url]
+
+
+def endpoint_limit(url):
+
+    return endpoint_max_in_flight.get(url, max_in_flight)
+
+
+def total_capacity(urls):
+
+    # Requests that can usefully be in flight at once over all endpoints
+    return sum(endpoint_limit(url) for url in urls)
+
+############################################################################################
+
+def pick_endpoint(urls, tried=()):
+
+    # Healthy endpoint with the fewest requests in flight (and below its limit),
+    # preferring endpoints this request has not tried yet. When all circuits are
+    # open, wait for the first to close; when all are busy, wait for a request to finish.
+    with _lock:
+        while True:
+            now = time.time()
+            healthy = [url for url in urls if _state(url)["open_until"] <= now]
+            available = [url for url in healthy if _state(url)["in_flight"] < endpoint_limit(url)]
+
+            if available:
+                url = min(available, key=lambda u: (u in tried, _state(u)["in_flight"] / endpoint_limit(u),
+                                                    _state(u)["failures"]))
+                state = _state(url)
+                state["in_flight"] += 1
+                if state["first_use"] is None:
+                    state["first_use"] = now
+                return url
+
+            if healthy:
+                _lock.wait()
+            else:
+                wait_time = min(_state(url)["open_until"] for url in urls) - now
+                print(f"All OCR servers unavailable, pausing submissions for {wait_time:.0f} s")
+                _lock.wait(max(wait_time, 0.1))
+
+############################################################################################
+
+def release_endpoint(url, start_time, success):
+
+    # Frees the slot taken by pick_endpoint and updates the breaker and the stats
+    with _lock:
+        state = _state(url)
+        state["in_flight"] -= 1
+        state["requests"] += 1
+        state["busy_time"] += time.time() - start_time
+
+        if success:
+            state["failures"] = 0
+            state["open_until"] = 0.0
+        else:
+            state["errors"] += 1
+            state["failures"] += 1
+            if state["failures"] >= breaker_failures:
+                if state["open_until"] <= time.time():
+                    print(f"OCR server {url} marked unhealthy for {breaker_cooldown:.0f} s")
+                state["open_until"] = time.time() + breaker_cooldown
+
+        _lock.notify_all()
+
+
+def finish_stream(response, success):
+
+    # Streamed responses keep their endpoint slot until the caller is done reading;
+    # success is False when reading the stream failed (counted by the circuit breaker)
+    response.close()
+    release_endpoint(response.ocr_endpoint, response.ocr_start_time, success)
+
+############################################################################################
+
+def print_endpoint_stats():
+
+    with _lock:
+        for url, state in _endpoint_state.items():
+            if not state["requests"]:
+                continue
+            elapsed = time.time() - state["first_use"]
+            print(f"{url}: {state['requests']} requests, {state['errors']} errors, "
+                  f"mean latency {state['busy_time'] / state['requests']:.2f} s, "
+                  f"{state['requests'] / elapsed:.2f} requests/s, "
+                  f"{'unhealthy' if state['open_until'] > time.time() else 'healthy'}")
+
+############################################################################################
+
+def warm_up(urls, model, keep_alive):
+
+    # Loads the model on every endpoint (a request without prompt) and keeps it
+    # resident for keep_alive. Returns the load time of each endpoint.
+    load_times = {}
+
+    def load(url):
+        start_time = time.time()
+        try:
+            response = _session.post(url, json={"model": model, "keep_alive": keep_alive, "stream": False},
+                                     timeout=(connect_timeout, read_timeout))
+            response.raise_for_status()
+            load_times[url] = time.time() - start_time
+        except requests.RequestException as e:
+            print(f"Warm-up of {url} failed: {e}")
+
+    threads = [threading.Thread(target=load, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return load_times
+
+############################################################################################
+
+def post_generate(urls, data, stream=False):
+
+    # Returns the requests.Response of the first endpoint that answers, or None.
+    # A streamed response must be handed back with finish_stream() once read.
+    body = json.dumps(data)
+    headers = {"Content-Type": "application/json"}
+
+    tried = set()
+    for attempt in range(max_attempts):
+        url = pick_endpoint(urls, tried)
+        tried.add(url)
+        start_time = time.time()
+        try:
+            response = _session.post(url, headers=headers, data=body, stream=stream,
+                                     timeout=(connect_timeout, read_timeout))
+        except requests.RequestException as e:
+            print(f"OCR request to {url} failed: {e}")
+            release_endpoint(url, start_time, False)
+            continue
+
+        if response.status_code >= 500:
+            print(f"Error {response.status_code} from {url}: {response.text}")
+            response.close()
+            release_endpoint(url, start_time, False)
+            continue
+
+        # Any other answer (including a 4xx for a bad request) means the server is alive
+        if stream and response.status_code == 200:
+            response.ocr_endpoint = url
+            response.ocr_start_time = start_time
+        else:
+            release_endpoint(url, start_time, True)
+        return response
+
+    return None
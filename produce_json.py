@@ -2,13 +2,13 @@ import json
 import re
 import os
 
+from chip_specs import sanitize_filename
+import board_archive
+import check_consistency
 
-def sanitize_filename(filename):
-     # Replace slashes with underscores first to avoid directory paths
-    filename = filename.replace('/', '_')
-    invalid_chars = '<>:"/\\|?*'
-    return "".join([c if c.isalnum() or c in ['_', '.'] else '_' for c in filename if c not in invalid_chars])
 
+# "Original OCR result" line of the chips read from their serial-number strip (crop_chips_FEMB.py)
+SERIAL_ONLY_HEADER = "Original OCR result (serial number only)"
 
 
 def extract_chip_sn(lines, chip_index, offset, pattern):
@@ -18,50 +18,68 @@ def extract_chip_sn(lines, chip_index, offset, pattern):
     for i, line in enumerate(lines):
 
         if line.startswith(chip_key):
-            target_line = lines[i + offset].strip()
+            # Lines of this chip only: a serial-number-only block is shorter
+            # than the offset, which would land in the next chip
+            end = i + 1
+            while end < len(lines) and not lines[end].startswith("* Chip "):
+                end += 1
+            block = lines[i:end]
+
+            target_line = block[offset].strip() if offset < len(block) else ""
             if re.match(pattern, target_line):
                 return target_line
 
-    return "Not found"
+            # Serial-number-only readings have the serial number as the only
+            # formatted line (a full reading with a misplaced serial number is not
+            # searched: its lot or date code could pass for one)
+            if any(block_line.startswith(SERIAL_ONLY_HEADER) for block_line in block[1:]):
+                for next_line in block[1:]:
+                    if re.fullmatch(pattern, next_line.strip()):
+                        return next_line.strip()
 
+    return "Not found"
 
 
-def create_json(front_file, back_file, name, output_dir):
 
-    with open(front_file, 'r', encoding='utf-8') as f:
-        front_lines = f.readlines()
-    with open(back_file, 'r', encoding='utf-8') as f:
-        back_lines = f.readlines()
+# HWDB specification field of every chip: side, chip number, and line offset
+# and pattern of its serial number in the results file
+SPECIFICATION_CHIPS = [
+    ("(F) COLDATA 1 SN", "front", 0, 5, r'\d{5}'),
+    ("(F) COLDATA 2 SN", "front", 1, 5, r'\d{5}'),
+    ("(F) ColdADC 1 SN", "front", 2, 5, r'\d{5}'),
+    ("(F) ColdADC 2 SN", "front", 3, 5, r'\d{5}'),
+    ("(F) ColdADC 3 SN", "front", 4, 5, r'\d{5}'),
+    ("(F) ColdADC 4 SN", "front", 5, 5, r'\d{5}'),
+    ("(F) LArASIC 1 SN", "front", 6, 8, r'\d{3}-\d{5}'),
+    ("(F) LArASIC 2 SN", "front", 7, 8, r'\d{3}-\d{5}'),
+    ("(F) LArASIC 3 SN", "front", 8, 8, r'\d{3}-\d{5}'),
+    ("(F) LArASIC 4 SN", "front", 9, 8, r'\d{3}-\d{5}'),
+    ("(B) ColdADC 1 SN", "back", 0, 5, r'\d{5}'),
+    ("(B) ColdADC 2 SN", "back", 1, 5, r'\d{5}'),
+    ("(B) ColdADC 3 SN", "back", 2, 5, r'\d{5}'),
+    ("(B) ColdADC 4 SN", "back", 3, 5, r'\d{5}'),
+    ("(B) LArASIC 1 SN", "back", 4, 8, r'\d{3}-\d{5}'),
+    ("(B) LArASIC 2 SN", "back", 5, 8, r'\d{3}-\d{5}'),
+    ("(B) LArASIC 3 SN", "back", 6, 8, r'\d{3}-\d{5}'),
+    ("(B) LArASIC 4 SN", "back", 7, 8, r'\d{3}-\d{5}'),
+]
+
+
+def build_record(front_lines, back_lines, name):
+
+    # HWDB record of a board from the lines of its front and back results
+    # (from the results files, or straight from memory, see hwdb_stream.py)
 
     # Extract required information
     #qr_code = front_lines[0].strip()
     qr_code = front_lines[0].replace("FEMB SN: ", "").strip()
-    sanitized_qr_code = sanitize_filename(qr_code)
     date = front_lines[2].strip()
 
-    specifications = {
-        "FEMB ID": qr_code,
-        "(F) COLDATA 1 SN": extract_chip_sn(front_lines, 0, 5, r'\d{5}'),
-        "(F) COLDATA 2 SN": extract_chip_sn(front_lines, 1, 5, r'\d{5}'),
-        "(F) ColdADC 1 SN": extract_chip_sn(front_lines, 2, 5, r'\d{5}'),
-        "(F) ColdADC 2 SN": extract_chip_sn(front_lines, 3, 5, r'\d{5}'),
-        "(F) ColdADC 3 SN": extract_chip_sn(front_lines, 4, 5, r'\d{5}'),
-        "(F) ColdADC 4 SN": extract_chip_sn(front_lines, 5, 5, r'\d{5}'),
-        "(F) LArASIC 1 SN": extract_chip_sn(front_lines, 6, 8, r'\d{3}-\d{5}'),
-        "(F) LArASIC 2 SN": extract_chip_sn(front_lines, 7, 8, r'\d{3}-\d{5}'),
-        "(F) LArASIC 3 SN": extract_chip_sn(front_lines, 8, 8, r'\d{3}-\d{5}'),
-        "(F) LArASIC 4 SN": extract_chip_sn(front_lines, 9, 8, r'\d{3}-\d{5}'),
-        "(B) ColdADC 1 SN": extract_chip_sn(back_lines, 0, 5, r'\d{5}'),
-        "(B) ColdADC 2 SN": extract_chip_sn(back_lines, 1, 5, r'\d{5}'),
-        "(B) ColdADC 3 SN": extract_chip_sn(back_lines, 2, 5, r'\d{5}'),
-        "(B) ColdADC 4 SN": extract_chip_sn(back_lines, 3, 5, r'\d{5}'),
-        "(B) LArASIC 1 SN": extract_chip_sn(back_lines, 4, 8, r'\d{3}-\d{5}'),
-        "(B) LArASIC 2 SN": extract_chip_sn(back_lines, 5, 8, r'\d{3}-\d{5}'),
-        "(B) LArASIC 3 SN": extract_chip_sn(back_lines, 6, 8, r'\d{3}-\d{5}'),
-        "(B) LArASIC 4 SN": extract_chip_sn(back_lines, 7, 8, r'\d{3}-\d{5}')
-    }
+    specifications = {"FEMB ID": qr_code}
+    for field, side, chip_index, offset, pattern in SPECIFICATION_CHIPS:
+        specifications[field] = extract_chip_sn(front_lines if side == "front" else back_lines, chip_index, offset, pattern)
 
-    json_data = {
+    return {
         "component_type": {
             "part_type_id": "D08100400001"
         },
@@ -76,29 +94,52 @@ def create_json(front_file, back_file, name, output_dir):
         "specifications": specifications
     }
 
+
+def json_path(output_dir, qr_code):
+
+    return os.path.join(output_dir, f"{sanitize_filename(qr_code)}.JSON")
+
+
+def create_json(front_file, back_file, name, output_dir):
+
+    # Board directory or packed board (board_archive.py)
+    front_lines = board_archive.read_text(front_file).splitlines(keepends=True)
+    back_lines = board_archive.read_text(back_file).splitlines(keepends=True)
+
+    json_data = build_record(front_lines, back_lines, name)
+
     #output_filename = f"{qr_code}.json"
-    output_filename = os.path.join(output_dir, f"{sanitized_qr_code}.JSON")
-    with open(output_filename, 'w', encoding='utf-8') as f:
-        json.dump(json_data, f, indent=4)
+    output_filename = json_path(output_dir, json_data["specifications"]["FEMB ID"])
+    board_archive.write_file(output_filename, json.dumps(json_data, indent=4))
 
     print(f"JSON file '{output_filename}' created successfully.")
 
 
 def process_all_folders(base_dir, name):
-    for folder_name in os.listdir(base_dir):
+
+    # Cross-board checks (duplicate serial numbers, lots, date codes) before anything goes to HWDB
+    blocked = set()
+    if CHECK_CONSISTENCY:
+        blocked = check_consistency.blocked_boards(check_consistency.check_all_boards(base_dir))
+
+    for folder_name in board_archive.find_boards(base_dir):
         folder_path = os.path.join(base_dir, folder_name)
-        if os.path.isdir(folder_path):
-            front_file = os.path.join(folder_path, "front_results.txt")
-            back_file = os.path.join(folder_path, "back_results.txt")
-            if os.path.exists(front_file) and os.path.exists(back_file):
-                create_json(front_file, back_file, name, folder_path)
-            else:
-                print(f"Skipping folder '{folder_name}' (missing front_results.txt or back_results.txt)")
+        if os.path.abspath(folder_path) in blocked:
+            print(f"Skipping folder '{folder_name}' (consistency check failed, see above)")
+            continue
+        front_file = os.path.join(folder_path, "front_results.txt")
+        back_file = os.path.join(folder_path, "back_results.txt")
+        if board_archive.file_exists(front_file) and board_archive.file_exists(back_file):
+            create_json(front_file, back_file, name, folder_path)
+        else:
+            print(f"Skipping folder '{folder_name}' (missing front_results.txt or back_results.txt)")
 
 # User input
 NAME = "Karla F."
 BASE_DIR = "results"
+CHECK_CONSISTENCY = True  # skip the boards failing check_consistency.py
 
-process_all_folders(BASE_DIR, NAME)
+if __name__ == "__main__":
+    process_all_folders(BASE_DIR, NAME)
 
 
@@ -5,19 +5,31 @@
 # Code reads EITHER QR codes or Data Matrices.
 # Code processes both FRONT and BACK chip readings.
 
+# All chips (of both sides, and of every board given) are requested
+# concurrently through one AsyncOpenAI client, within the requests and tokens
+# per minute of the account (RateLimiter); 429 answers pause all requests for
+# the retry-after time the API gives. The token usage and cost of each board
+# are saved in its directory (gpt_usage.json).
+
+#   python read_sn_gpt_api.py [read] FRONT BACK [FRONT BACK ...]
+#   python read_sn_gpt_api.py submit FRONT BACK [...]    Batch API, for large backlogs
+#   python read_sn_gpt_api.py collect                    results of the finished batches
+
 import cv2
 import numpy as np
 from PIL import Image
 import re
 import os
+import argparse
+import asyncio
+import json
+import time
 
-from openai import OpenAI
 #import openai
 import base64
 import io
 
-from pylibdmtx.pylibdmtx import decode as decode_dm
-from qreader import QReader
+# (openai and the QR/DM decoders are imported where they are used)
 
 # Open the image file and encode it as a base64 string
 def encode_image(image_path):
@@ -74,6 +86,7 @@ def read_barcode(image, position, barcode_type):
     cropped_image = image[y:y+h, x:x+w]
 
     if barcode_type == 'QR':
+        from qreader import QReader
         qreader = QReader()
         try:
             data = qreader.detect_and_decode(image=cropped_image)
@@ -89,6 +102,7 @@ def read_barcode(image, position, barcode_type):
         cv2.imwrite(f'cropped/QR_code.png', cropped_image)
 
     elif barcode_type == 'DM':
+        from pylibdmtx.pylibdmtx import decode as decode_dm
         dm_image = Image.fromarray(cropped_image)  # Convert to PIL Image format
         results = decode_dm(dm_image)
         if results:
@@ -125,34 +139,125 @@ def sanitize_filename(filename):
 
 ####################################################################
 
-def process_chips(image_path, chip_coordinates, directory_name, file_suffix, barcode_content, date_str):
+# Configuration variables: OpenAI API
+MODEL = "gpt-4o"
+openai_base_url = None  # e.g. 'http://127.0.0.1:8900/v1' with the mock of mock_servers.py
+max_output_tokens = 100  # a chip marking is a few words
 
-    # Read the image:
-    image = cv2.imread(image_path)
+# Rate limits of the account (the requests wait instead of failing with 429)
+requests_per_minute = 500
+tokens_per_minute = 30000
+max_concurrent_requests = 16
+estimated_prompt_tokens = 350  # per chip (100x100 image + prompt), reserved before each request
+max_retries = 5
+retry_backoff = 1.0  # seconds, doubled after every failed attempt (unless the API says how long to wait)
 
-    # save a copy of the original image
-    cv2.imwrite(f'{directory_name}/{image_path}', image)
+# Prices in $ per million tokens, for the usage report of each board
+price_per_million_input_tokens = 2.50
+price_per_million_output_tokens = 10.00
+batch_discount = 0.5  # Batch API price / regular price
 
-    # Creating the file name:
-    result_filename = os.path.join(directory_name, f"{file_suffix}_results.txt")
+# Batch API: state of the submitted batches, to collect their results later
+batch_state_file = "gpt_batches.json"
+
+
+class RateLimiter:
+
+    # Token buckets for the requests and the tokens per minute, shared by all
+    # the requests of the run. A 429 answer pauses everybody for the time the
+    # API asks (retry-after).
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_rate = requests_per_minute / 60.0
+        self.token_rate = tokens_per_minute / 60.0
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.requests = min(self.request_capacity, self.requests + (now - self.updated) * self.request_rate)
+        self.tokens = min(self.token_capacity, self.tokens + (now - self.updated) * self.token_rate)
+        self.updated = now
+
+    async def acquire(self, tokens):
+        # Waits (in arrival order) until one request and this many tokens fit in the budget
+        tokens = min(tokens, self.token_capacity)
+        async with self.lock:
+            while True:
+                self.refill()
+                wait = max(self.paused_until - time.monotonic(),
+                           (1 - self.requests) / self.request_rate,
+                           (tokens - self.tokens) / self.token_rate)
+                if wait <= 0:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+    def settle(self, reserved, used):
+        # Gives back what was reserved but not used (or takes the excess)
+        self.tokens += reserved - used
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def new_usage():
+
+    return {"requests": 0, "retries": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+
+
+def add_usage(usage, prompt_tokens, completion_tokens, discount=1.0):
+
+    usage["requests"] += 1
+    usage["prompt_tokens"] += prompt_tokens
+    usage["completion_tokens"] += completion_tokens
+    usage["cost"] += discount * (prompt_tokens * price_per_million_input_tokens
+                                 + completion_tokens * price_per_million_output_tokens) / 1e6
 
-    ## Set the API key and model name
-    MODEL="gpt-4o"
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", "<your api key>"))
-    
 
-    file = open(result_filename, 'w', encoding='utf-8')
+def save_usage(directory_name, usage):
 
-    file.write(f"{barcode_content}\n\n{date_str}\n\n")
+    with open(os.path.join(directory_name, "gpt_usage.json"), 'w', encoding='utf-8') as f:
+        json.dump(usage, f, indent=2)
+    print(f"{usage['requests']} requests ({usage['retries']} retries, {usage['failed']} failed), "
+          f"{usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion tokens, "
+          f"${usage['cost']:.4f} for {os.path.basename(directory_name)}")
 
-    all_ocr_results = []
+
+def retry_delay(error, attempt):
+
+    # The wait the API asks for, otherwise exponential backoff
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            pass
+    return retry_backoff * 2 ** attempt
+
+####################################################################
+
+def prepare_chips(image_path, chip_coordinates, directory_name, file_suffix):
+
+    # Crops, rotates and saves every chip, and returns them as base64 PNGs
+    image = cv2.imread(image_path)
+
+    # save a copy of the original image
+    cv2.imwrite(f'{directory_name}/{image_path}', image)
+
+    chip_images = []
     for i, (x, y, w, h) in enumerate(chip_coordinates):
 
         ## Crop the image
         chip_image = image[y:y+h, x:x+w]
 
-        print(f'Processing {i}th chip')
-
         # Rotate the chip:
         rotated_chip = cv2.rotate(chip_image, cv2.ROTATE_90_CLOCKWISE)
 
@@ -162,42 +267,94 @@ def process_chips(image_path, chip_coordinates, directory_name, file_suffix, bar
 
         image_cv = cv2.imread(chip_image_path, cv2.IMREAD_ANYDEPTH)
 
-
         # Resize the image to make the text more clear
         #resized_image = cv2.resize(image_cv, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
         resized_image = cv2.resize(image_cv, (100, 100))  # Resize to a smaller size if possible
 
-
         pil_image = Image.fromarray(resized_image)
         buffered = io.BytesIO()
         pil_image.save(buffered, format="PNG", optimize=True, quality=75)  # Adjust quality for compression
-        processed_base64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        chip_images.append(base64.b64encode(buffered.getvalue()).decode('utf-8'))
+
+    return chip_images
 
 
-        #base64_image = encode_image(IMAGE_PATH)
+def chip_request(processed_base64_image):
 
-        file.write(f"* Chip {i} ({file_suffix}):\n")
+    # Chat completion parameters for one chip (same body for the Batch API)
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant. Help me with an Optical Character Recognition (OCR) task."},
+            {"role": "user", "content": [
+                {"type": "text", "text": "Can you provide a manual transcription of the visible text from this image?"},
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{processed_base64_image}"}},
+            ]},
+        ],
+        "temperature": 0.0,
+        "max_tokens": max_output_tokens,
+    }
 
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                        {"role": "system", "content": "You are a helpful assistant. Help me with an Optical Character Recognition (OCR) task."},
-                        {"role": "user", "content": [
-                        {"type": "text", "text": "Can you provide a manual transcription of the visible text from this image?"},
-                        {"type": "image_url", "image_url": {
-#                       "url": f"data:image/png;base64,{base64_image}"}
-                        "url": f"data:image/png;base64,{processed_base64_image}"}
-                        }
-                        ]}
-                    ],
-            temperature=0.0,
-        )
 
+def write_results(result_filename, barcode_content, date_str, file_suffix, ocr_results):
 
-        file.write(response.choices[0].message.content)
+    with open(result_filename, 'w', encoding='utf-8') as file:
+        file.write(f"{barcode_content}\n\n{date_str}\n\n")
+        for i, ocr_result in enumerate(ocr_results):
+            file.write(f"* Chip {i} ({file_suffix}):\n")
+            file.write(ocr_result)
+            file.write("\n\n")
 
+####################################################################
 
-        file.write("\n\n")
+async def read_chip(client, limiter, semaphore, request, usage, label):
+
+    from openai import APIConnectionError, APIStatusError
+
+    reserved = estimated_prompt_tokens + max_output_tokens
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            await limiter.acquire(reserved)
+            try:
+                response = await client.chat.completions.create(**request)
+            except (APIConnectionError, APIStatusError) as e:
+                limiter.settle(reserved, 0)
+                status = getattr(e, "status_code", None)
+                if status is not None and status != 429 and status < 500:
+                    usage["failed"] += 1
+                    return f"Error: {e}"
+                delay = retry_delay(e, attempt)
+                if status == 429:
+                    limiter.pause(delay)
+                if attempt < max_retries:
+                    usage["retries"] += 1
+                    print(f"{label}: {'rate limited' if status == 429 else e}, retrying in {delay:.1f} s")
+                    await asyncio.sleep(delay)
+                continue
+
+            prompt_tokens = response.usage.prompt_tokens if response.usage else 0
+            completion_tokens = response.usage.completion_tokens if response.usage else 0
+            limiter.settle(reserved, prompt_tokens + completion_tokens)
+            add_usage(usage, prompt_tokens, completion_tokens)
+            return response.choices[0].message.content or ""
+
+    usage["failed"] += 1
+    return "Error: API request failed"
+
+
+async def process_chips(client, limiter, semaphore, image_path, chip_coordinates, directory_name, file_suffix, barcode_content, date_str, usage):
+
+    # All chips of the side are requested at once; the rate limiter spaces them out
+    chip_images = prepare_chips(image_path, chip_coordinates, directory_name, file_suffix)
+
+    print(f'Processing {len(chip_images)} chips [{file_suffix}]')
+    ocr_results = await asyncio.gather(*(
+        read_chip(client, limiter, semaphore, chip_request(chip_image), usage, f"Chip {i} ({file_suffix})")
+        for i, chip_image in enumerate(chip_images)))
+
+    # Creating the file name:
+    result_filename = os.path.join(directory_name, f"{file_suffix}_results.txt")
+    write_results(result_filename, barcode_content, date_str, file_suffix, ocr_results)
 
 ############################################################################################
 
@@ -215,7 +372,7 @@ def extract_date_from_filename(filename):
 
 ############################################################################################
 
-def main_process(image_path_front, image_path_back):
+def prepare_board(image_path_front):
 
     image_front = cv2.imread(image_path_front)
 
@@ -233,11 +390,10 @@ def main_process(image_path_front, image_path_back):
     # save the QR code image to this directory ...
     save_barcode_image(image_front, qr_position if barcode_type == 'QR' else dm_position, barcode_type, directory_name)
 
-    # Front processing with front-specific OCR cleaning
-    process_chips(image_path_front, chip_coordinates_front, directory_name, "front",barcode_content, date_str)
+    return directory_name, barcode_content, date_str
 
-    # Back processing with back-specific OCR cleaning, same directory
-    process_chips(image_path_back, chip_coordinates_back, directory_name, "back",barcode_content, date_str)
+
+def report_board(directory_name):
 
     # Post-processing OCR results:
 
@@ -251,10 +407,163 @@ def main_process(image_path_front, image_path_back):
     print(f"Number of chips processed on the back side: {back_chip_count}")
 
 
+async def read_board(client, limiter, semaphore, image_path_front, image_path_back):
+
+    directory_name, barcode_content, date_str = prepare_board(image_path_front)
+    usage = new_usage()
+
+    # Front and back, same directory, read concurrently
+    await asyncio.gather(
+        process_chips(client, limiter, semaphore, image_path_front, chip_coordinates_front, directory_name, "front", barcode_content, date_str, usage),
+        process_chips(client, limiter, semaphore, image_path_back, chip_coordinates_back, directory_name, "back", barcode_content, date_str, usage))
+
+    report_board(directory_name)
+    save_usage(directory_name, usage)
+    return usage
+
+
+async def read_boards(image_pairs):
+
+    # One client and one rate limit budget for all the boards of the run
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY", "<your api key>"), base_url=openai_base_url,
+                         max_retries=0)  # retries go through the rate limiter
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    try:
+        return await asyncio.gather(*(read_board(client, limiter, semaphore, front, back) for front, back in image_pairs))
+    finally:
+        await client.close()
+
+
+def main_process(image_path_front, image_path_back):
+
+    return asyncio.run(read_boards([(image_path_front, image_path_back)]))[0]
+
+############################################################################################
+# Batch API: for large backlogs, at half the price, results within 24 h
+############################################################################################
+
+def load_batch_state():
+
+    if not os.path.exists(batch_state_file):
+        return {}
+    with open(batch_state_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_batch_state(state):
+
+    with open(f"{batch_state_file}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{batch_state_file}.tmp", batch_state_file)
+
+
+def new_sync_client():
+
+    from openai import OpenAI
+    return OpenAI(api_key=os.environ.get("OPENAI_API_KEY", "<your api key>"), base_url=openai_base_url)
+
+
+def submit_batch(image_pairs):
+
+    # Crops the chips of every board and submits all of them as one batch
+    boards = []
+    lines = []
+    for image_path_front, image_path_back in image_pairs:
+        directory_name, barcode_content, date_str = prepare_board(image_path_front)
+        board = {"directory": directory_name, "barcode": barcode_content, "date": date_str, "chips": {}}
+        for image_path, chip_coordinates, file_suffix in ((image_path_front, chip_coordinates_front, "front"),
+                                                          (image_path_back, chip_coordinates_back, "back")):
+            chip_images = prepare_chips(image_path, chip_coordinates, directory_name, file_suffix)
+            board["chips"][file_suffix] = len(chip_images)
+            for i, chip_image in enumerate(chip_images):
+                lines.append(json.dumps({"custom_id": f"{len(boards)}:{file_suffix}:{i}", "method": "POST",
+                                         "url": "/v1/chat/completions", "body": chip_request(chip_image)}))
+        boards.append(board)
+
+    client = new_sync_client()
+    batch_file = client.files.create(file=("chips.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+
+    state = load_batch_state()
+    state[batch.id] = {"submitted": time.time(), "boards": boards}
+    save_batch_state(state)
+    print(f"Batch {batch.id} submitted: {len(lines)} chips of {len(boards)} boards. "
+          f"Run 'python read_sn_gpt_api.py collect' to write the results once it is done.")
+    return batch.id
+
+
+def collect_batches():
+
+    # Writes the results of every finished batch; the others stay in the state file
+    state = load_batch_state()
+    client = new_sync_client()
+
+    for batch_id, job in list(state.items()):
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelled"):
+            print(f"Error: batch {batch_id} {batch.status}, submit its boards again")
+            del state[batch_id]
+            continue
+        if batch.status != "completed":
+            print(f"Batch {batch_id}: {batch.status}")
+            continue
+
+        answers = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                for line in client.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        answer = json.loads(line)
+                        answers[answer["custom_id"]] = answer
+
+        for board_number, board in enumerate(job["boards"]):
+            usage = new_usage()
+            for file_suffix, n_chips in board["chips"].items():
+                ocr_results = []
+                for i in range(n_chips):
+                    answer = answers.get(f"{board_number}:{file_suffix}:{i}") or {}
+                    response = answer.get("response") or {}
+                    body = response.get("body") or {}
+                    if response.get("status_code") != 200 or not body.get("choices"):
+                        usage["failed"] += 1
+                        ocr_results.append(f"Error: {answer.get('error') or body.get('error') or 'no answer'}")
+                        continue
+                    add_usage(usage, body["usage"]["prompt_tokens"], body["usage"]["completion_tokens"], batch_discount)
+                    ocr_results.append(body["choices"][0]["message"]["content"] or "")
+
+                result_filename = os.path.join(board["directory"], f"{file_suffix}_results.txt")
+                write_results(result_filename, board["barcode"], board["date"], file_suffix, ocr_results)
+
+            report_board(board["directory"])
+            save_usage(board["directory"], usage)
+
+        del state[batch_id]
+
+    save_batch_state(state)
+
+
 # Configuration:
 
 image_path_front = '/home/karla/Documents/CE-QC/QC_camera/text_recognition/Images/femb_batch_5_new_boards/FEMB_FRONT_01--06-06-2024.png'
 image_path_back = '/home/karla/Documents/CE-QC/QC_camera/text_recognition/Images/femb_batch_5_new_boards/FEMB_BACK_01--06-06-2024.png'
 
 #Let's crop and read some chips!
-main_process(image_path_front, image_path_back)
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Read the chips of FEMBs with GPT-4o")
+    parser.add_argument("command", nargs="?", default="read", choices=["read", "submit", "collect"],
+                        help="read now, submit to the Batch API, or collect the finished batches")
+    parser.add_argument("images", nargs="*", help="FRONT BACK image pairs (default: the configured pair)")
+    args = parser.parse_args()
+
+    image_pairs = list(zip(args.images[0::2], args.images[1::2])) or [(image_path_front, image_path_back)]
+    if args.command == "read":
+        asyncio.run(read_boards(image_pairs))
+    elif args.command == "submit":
+        submit_batch(image_pairs)
+    elif args.command == "collect":
+        collect_batches()
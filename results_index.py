@@ -0,0 +1,263 @@
+# Index of every chip read so far (SQLite), built from the results of each board.
+
+# One row per chip: FEMB ID, side, position, chip type, lot, serial number,
+# date code, photo date, validation status and chip image. Finding which FEMB
+# holds a given serial number, or every chip of a lot, is then a single
+# indexed query instead of a scan of every results/*/front_results.txt.
+
+# The index is updated incrementally: a board is only parsed again when its
+# results files changed. crop_chips_FEMB.py updates it after every board.
+
+#   python results_index.py update
+#   python results_index.py serial 02454
+#   python results_index.py lot N6Y381.00
+#   python results_index.py dates 2024-06-01 2024-06-30
+
+import argparse
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+import board_archive
+from chip_specs import chip_marking_prefix, get_chip_type, get_ocr_fields
+
+
+# Configuration:
+index_path = os.path.join("results", "results_index.db")
+photo_date_format = "%m-%d-%Y"  # date in the picture file names (FEMB_FRONT_21--06-06-2024.png)
+
+
+############################################################################################
+
+def open_index(path=None):
+
+    path = path or index_path
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS boards (
+            board_dir TEXT PRIMARY KEY,
+            femb_id TEXT,
+            photo_date TEXT,
+            results_mtime REAL
+        );
+        CREATE TABLE IF NOT EXISTS chips (
+            board_dir TEXT NOT NULL,
+            femb_id TEXT,
+            side TEXT NOT NULL,
+            chip INTEGER NOT NULL,
+            chip_type TEXT,
+            lot TEXT,
+            serial TEXT,
+            date_code TEXT,
+            version TEXT,
+            photo_date TEXT,
+            valid INTEGER,
+            ocr_text TEXT,
+            image_path TEXT,
+            PRIMARY KEY (board_dir, side, chip)
+        );
+        CREATE INDEX IF NOT EXISTS chips_serial ON chips (serial);
+        CREATE INDEX IF NOT EXISTS chips_lot ON chips (lot);
+        CREATE INDEX IF NOT EXISTS chips_photo_date ON chips (photo_date);
+        CREATE INDEX IF NOT EXISTS chips_femb_id ON chips (femb_id);
+    """)
+    conn.commit()
+
+    return conn
+
+############################################################################################
+
+def parse_results_file(result_filename):
+
+    # Returns the FEMB ID, the photo date and, for every chip, the OCR text
+    # ("Formatted OCR result" lines joined by spaces)
+    lines = board_archive.read_text(result_filename).split('\n')
+
+    femb_id = lines[0].replace("FEMB SN: ", "").strip() if lines else ""
+    photo_date = lines[2].strip() if len(lines) > 2 else ""
+
+    chips = {}
+    chip_number = None
+    in_formatted = False
+    for line in lines[3:]:
+        header = re.match(r"\* Chip (\d+)", line)
+        if header:
+            chip_number = int(header.group(1))
+            chips[chip_number] = []
+            in_formatted = False
+        elif line.startswith("Formatted OCR result:"):
+            in_formatted = True
+        elif chip_number is not None and in_formatted and line.strip():
+            chips[chip_number].append(line.strip())
+
+    return femb_id, photo_date, {chip: " ".join(words) for chip, words in chips.items()}
+
+############################################################################################
+
+def split_fields(ocr_text, chip_type):
+
+    # Field values of a chip marking, and whether all of them look right.
+    # A serial-number-only reading has just the serial number.
+    words = ocr_text.split()
+    if chip_type is None:
+        return {}, False
+
+    fields = get_ocr_fields(chip_type)
+    if len(words) == 1:
+        fields = get_ocr_fields(chip_type, sn_only=True)
+        expected_words = 1
+    else:
+        expected_words = len(chip_marking_prefix[chip_type].split()) + len(fields)
+
+    values = dict(zip([name for name, _ in fields], words[-len(fields):]))
+    valid = len(words) == expected_words and all(
+        re.match(pattern, values.get(name, "")) for name, pattern in fields)
+
+    return values, valid
+
+############################################################################################
+
+def to_iso_date(photo_date):
+
+    try:
+        return datetime.strptime(photo_date, photo_date_format).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+############################################################################################
+
+def results_mtime(board_dir):
+
+    # Packed boards (board_archive.py) count with the time of their archive
+    mtimes = [board_archive.file_mtime(os.path.join(board_dir, f"{side}_results.txt")) for side in ("front", "back")]
+    mtimes = [mtime for mtime in mtimes if mtime is not None]
+    return max(mtimes) if mtimes else None
+
+############################################################################################
+
+def index_board(conn, board_dir):
+
+    board_dir = os.path.abspath(board_dir)
+    rows = []
+    femb_id = photo_date = None
+
+    for side in ("front", "back"):
+        result_filename = os.path.join(board_dir, f"{side}_results.txt")
+        if not board_archive.file_exists(result_filename):
+            continue
+
+        femb_id, photo_date, chips = parse_results_file(result_filename)
+        for chip_number, ocr_text in chips.items():
+            chip_type = get_chip_type(chip_number, side)
+            values, valid = split_fields(ocr_text, chip_type)
+            rows.append((board_dir, femb_id, side, chip_number, chip_type,
+                         values.get("lot"), values.get("serial"), values.get("date"), values.get("version"),
+                         to_iso_date(photo_date), int(valid), ocr_text,
+                         os.path.join(board_dir, f"{side}_chip_{chip_number}.png")))
+
+    with conn:
+        conn.execute("DELETE FROM chips WHERE board_dir = ?", (board_dir,))
+        conn.executemany("INSERT INTO chips VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO boards VALUES (?, ?, ?, ?)",
+                     (board_dir, femb_id, to_iso_date(photo_date or ""), results_mtime(board_dir)))
+
+    return len(rows)
+
+############################################################################################
+
+def update_index(conn, base_dir="results"):
+
+    # Parse only the boards whose results changed since they were indexed
+    indexed = {row["board_dir"]: row["results_mtime"] for row in conn.execute("SELECT * FROM boards")}
+
+    updated = 0
+    present = set()
+    for folder_name in board_archive.find_boards(base_dir):
+        board_dir = os.path.abspath(os.path.join(base_dir, folder_name))
+        mtime = results_mtime(board_dir)
+        if mtime is None:
+            continue
+        present.add(board_dir)
+        if indexed.get(board_dir) != mtime:
+            index_board(conn, board_dir)
+            updated += 1
+
+    # Boards removed from the results tree
+    with conn:
+        for board_dir in set(indexed) - present:
+            conn.execute("DELETE FROM chips WHERE board_dir = ?", (board_dir,))
+            conn.execute("DELETE FROM boards WHERE board_dir = ?", (board_dir,))
+
+    return updated
+
+############################################################################################
+
+def find_by_serial(conn, serial, chip_type=None):
+
+    if chip_type:
+        return conn.execute("SELECT * FROM chips WHERE serial = ? AND chip_type = ?", (serial, chip_type)).fetchall()
+    return conn.execute("SELECT * FROM chips WHERE serial = ?", (serial,)).fetchall()
+
+
+def find_by_lot(conn, lot):
+
+    return conn.execute("SELECT * FROM chips WHERE lot = ? ORDER BY femb_id, side, chip", (lot,)).fetchall()
+
+
+def find_by_date_range(conn, first_date, last_date):
+
+    # ISO dates (YYYY-MM-DD), both included
+    return conn.execute("SELECT * FROM chips WHERE photo_date BETWEEN ? AND ? ORDER BY photo_date, femb_id, side, chip",
+                        (first_date, last_date)).fetchall()
+
+############################################################################################
+
+def print_chips(rows):
+
+    for row in rows:
+        status = "ok" if row["valid"] else "CHECK"
+        print(f"{row['femb_id']}  {row['side']:5s} chip {row['chip']}  {row['chip_type'] or '?':8s} "
+              f"lot {row['lot'] or '-':10s} SN {row['serial'] or '-':10s} {row['photo_date'] or '-'}  [{status}]")
+    print(f"{len(rows)} chips")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Index of all chips read so far")
+    parser.add_argument("--base-dir", default="results")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("update", help="index new or changed boards")
+    serial = subparsers.add_parser("serial", help="chips with this serial number")
+    serial.add_argument("serial")
+    serial.add_argument("--chip-type")
+    lot = subparsers.add_parser("lot", help="chips of this lot")
+    lot.add_argument("lot")
+    dates = subparsers.add_parser("dates", help="chips photographed in a date range")
+    dates.add_argument("first_date", help="YYYY-MM-DD")
+    dates.add_argument("last_date", help="YYYY-MM-DD")
+    args = parser.parse_args(argv)
+
+    conn = open_index(os.path.join(args.base_dir, os.path.basename(index_path)))
+
+    if args.command == "update":
+        print(f"{update_index(conn, args.base_dir)} boards indexed")
+    elif args.command == "serial":
+        print_chips(find_by_serial(conn, args.serial, args.chip_type))
+    elif args.command == "lot":
+        print_chips(find_by_lot(conn, args.lot))
+    elif args.command == "dates":
+        print_chips(find_by_date_range(conn, args.first_date, args.last_date))
+
+    return 0
+
+
+if __name__ == "__main__":
+    main()
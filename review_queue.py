@@ -0,0 +1,323 @@
+# Review queue for the chips the OCR was not sure about (SQLite).
+
+# Instead of stopping the run at input() prompts, the reading scripts put
+# every flagged chip (OCR text needed corrections, or failed
+# validate_ocr_result) in results/review_queue.db and carry on with the next
+# chip or board. An operator goes through the queue later, in the terminal
+# or on a local web page that shows each chip picture, and the corrections
+# are merged back into the results files (and the .JSON files already made).
+
+#   python review_queue.py review            review in the terminal
+#   python review_queue.py web --port 8800   review on http://127.0.0.1:8800
+#   python review_queue.py merge             write the corrections to the results files
+#   python review_queue.py list
+
+import argparse
+import html
+import json
+import os
+import sqlite3
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import board_archive
+
+
+# Default location, next to the board directories
+review_queue_path = os.path.join("results", "review_queue.db")
+
+# Appended to the "Original OCR result" line of a corrected chip
+CORRECTION_NOTE = "  [corrected in review:"
+
+
+############################################################################################
+
+def open_review_queue(path=None):
+
+    path = path or review_queue_path
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    # state: pending -> accepted (OCR text was right) | corrected -> merged
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY,
+            result_file TEXT NOT NULL,
+            side TEXT NOT NULL,
+            chip INTEGER NOT NULL,
+            chip_image TEXT,
+            ocr_text TEXT,
+            reason TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            corrected_text TEXT,
+            created REAL,
+            reviewed REAL,
+            UNIQUE (result_file, side, chip)
+        );
+        CREATE INDEX IF NOT EXISTS reviews_state ON reviews (state);
+    """)
+    conn.commit()
+
+    return conn
+
+############################################################################################
+
+def enqueue(conn, result_file, side, chip, chip_image, ocr_text, reason):
+
+    # A chip read again replaces its previous review, unless its correction was
+    # already merged (the reading scripts apply it again, see merged_corrections)
+    with conn:
+        conn.execute("""
+            INSERT INTO reviews (result_file, side, chip, chip_image, ocr_text, reason, state, created)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)
+            ON CONFLICT (result_file, side, chip) DO UPDATE SET
+                chip_image = excluded.chip_image, ocr_text = excluded.ocr_text, reason = excluded.reason,
+                state = 'pending', corrected_text = NULL, created = excluded.created, reviewed = NULL
+            WHERE reviews.state != 'merged'
+        """, (os.path.abspath(result_file), side, chip, chip_image and os.path.abspath(chip_image),
+              ocr_text, reason, time.time()))
+
+
+def clear_review(conn, result_file, side, chip):
+
+    # The chip was read again and is fine now
+    with conn:
+        conn.execute("DELETE FROM reviews WHERE result_file = ? AND side = ? AND chip = ? AND state = 'pending'",
+                     (os.path.abspath(result_file), side, chip))
+
+
+def pending_reviews(conn):
+
+    return conn.execute("SELECT * FROM reviews WHERE state = 'pending' ORDER BY id").fetchall()
+
+
+def resolve(conn, review_id, corrected_text=None):
+
+    # No correction: the OCR text was right
+    with conn:
+        conn.execute("UPDATE reviews SET state = ?, corrected_text = ?, reviewed = ? WHERE id = ?",
+                     ('corrected' if corrected_text else 'accepted', corrected_text, time.time(), review_id))
+
+############################################################################################
+
+def correction_note(original_line, corrected_text):
+
+    # "Original OCR result: ..." line of a corrected chip: the OCR text is kept,
+    # followed by the correction (replacing the one of an earlier merge)
+    return original_line.split(CORRECTION_NOTE)[0].rstrip() + f"{CORRECTION_NOTE} {corrected_text}]"
+
+
+def replace_chip_lines(lines, chip, side, new_lines):
+
+    # Replaces the reading of one chip in the lines of a results file:
+    # the lines after "Formatted OCR result:" (crop_chips_FEMB.py), or after
+    # the chip header (crop_chips_qr_dm.py), up to the next blank line.
+    # The "Original OCR result" line is annotated with the correction.
+    for i, line in enumerate(lines):
+        if line.startswith(f"* Chip {chip} ({side})") or line.rstrip() == f"* Chip {chip}:":
+            start = i + 1
+            if start < len(lines) and lines[start].startswith("Original OCR result"):
+                lines = lines[:start] + [correction_note(lines[start], " ".join(new_lines))] + lines[start + 1:]
+                start += 1
+            if start < len(lines) and lines[start].startswith("Formatted OCR result:"):
+                start += 1
+            end = start
+            while end < len(lines) and lines[end].strip():
+                end += 1
+            return lines[:start] + new_lines + lines[end:], True
+
+    return lines, False
+
+
+def merged_corrections(conn, result_file, side):
+
+    # {chip: corrected text} of the corrections already merged into a results file,
+    # applied again when the board is read again (crop_chips_FEMB.py)
+    rows = conn.execute("SELECT chip, corrected_text FROM reviews WHERE result_file = ? AND side = ? AND state = 'merged'",
+                        (os.path.abspath(result_file), side)).fetchall()
+    return {row["chip"]: row["corrected_text"] for row in rows}
+
+
+def update_json(board_dir):
+
+    # Regenerates the .JSON of the board if produce_json.py already made it
+    import produce_json
+
+    front_file = os.path.join(board_dir, "front_results.txt")
+    back_file = os.path.join(board_dir, "back_results.txt")
+    json_files = [f for f in board_archive.list_files(board_dir) if f.endswith(".JSON")]
+    if not json_files or not (board_archive.file_exists(front_file) and board_archive.file_exists(back_file)):
+        return
+
+    name = produce_json.NAME
+    comments = json.loads(board_archive.read_file(os.path.join(board_dir, json_files[0]))).get("comments", "")
+    if ", by " in comments:
+        name = comments.split(", by ", 1)[1]
+
+    produce_json.create_json(front_file, back_file, name, board_dir)
+
+
+def merge_corrections(conn):
+
+    # Writes every correction into its results file, then updates the JSON files
+    corrected = conn.execute("SELECT * FROM reviews WHERE state = 'corrected' ORDER BY result_file, id").fetchall()
+
+    board_dirs = set()
+    by_file = {}
+    for review in corrected:
+        by_file.setdefault(review["result_file"], []).append(review)
+
+    for result_file, reviews in by_file.items():
+        if not board_archive.file_exists(result_file):
+            print(f"Error: {result_file} not found, corrections kept in the queue")
+            continue
+
+        lines = board_archive.read_text(result_file).split('\n')
+
+        merged = []
+        for review in reviews:
+            lines, found = replace_chip_lines(lines, review["chip"], review["side"], review["corrected_text"].split())
+            if found:
+                merged.append(review["id"])
+            else:
+                print(f"Error: chip {review['chip']} ({review['side']}) not found in {result_file}")
+
+        board_archive.write_file(result_file, '\n'.join(lines))
+        with conn:
+            conn.executemany("UPDATE reviews SET state = 'merged' WHERE id = ?", [(i,) for i in merged])
+        board_dirs.add(os.path.dirname(result_file))
+        print(f"{len(merged)} corrections merged into {result_file}")
+
+    for board_dir in sorted(board_dirs):
+        update_json(board_dir)
+
+    return len(corrected)
+
+############################################################################################
+
+def review_in_terminal(conn):
+
+    reviews = pending_reviews(conn)
+    print(f"{len(reviews)} chips to review. For each chip: ENTER if the reading is right, "
+          f"the corrected marking (words separated by spaces, one per line of the marking), "
+          f"S to skip or Q to quit.\n")
+
+    for review in reviews:
+        print(f"---- {os.path.basename(os.path.dirname(review['result_file']))}, "
+              f"chip {review['chip']} ({review['side']}): {review['reason']}")
+        print(f"     picture: {review['chip_image']}")
+        print(f"     OCR:     {review['ocr_text']}")
+        answer = input("     > ").strip()
+        if answer.upper() == 'Q':
+            break
+        if answer.upper() == 'S':
+            continue
+        resolve(conn, review["id"], answer or None)
+
+    print(f"{len(pending_reviews(conn))} chips left to review. Run 'python review_queue.py merge' to apply the corrections.")
+
+############################################################################################
+
+class ReviewHandler(BaseHTTPRequestHandler):
+
+    # Small local page: every pending chip with its picture and a correction box
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        conn = self.server.conn
+
+        if url.path == "/image":
+            review_id = parse_qs(url.query).get("id", ["0"])[0]
+            row = conn.execute("SELECT chip_image FROM reviews WHERE id = ?", (review_id,)).fetchone()
+            if row is None or not row["chip_image"] or not board_archive.file_exists(row["chip_image"]):
+                self.send_body(b"not found", "text/plain", 404)
+                return
+            self.send_body(board_archive.read_file(row["chip_image"]), "image/png")
+            return
+
+        rows = []
+        for review in pending_reviews(conn):
+            rows.append(f"""
+            <tr><td><img src="/image?id={review['id']}" height="160"></td>
+            <td>{html.escape(os.path.basename(os.path.dirname(review['result_file'])))}<br>
+                chip {review['chip']} ({review['side']})<br><i>{html.escape(review['reason'] or '')}</i></td>
+            <td><form method="post" action="/review">
+                <input type="hidden" name="id" value="{review['id']}">
+                <input name="text" size="40" value="{html.escape(review['ocr_text'] or '')}">
+                <button name="action" value="save">Save</button></form></td></tr>""")
+
+        page = f"""<html><head><title>Chip review</title></head><body>
+            <h2>{len(rows)} chips to review</h2>
+            <p>Fix the marking if needed (words separated by spaces) and save.</p>
+            <table border="1" cellpadding="6">{''.join(rows)}</table></body></html>"""
+        self.send_body(page.encode(), "text/html; charset=utf-8")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        review_id = int(form.get("id", ["0"])[0])
+        text = form.get("text", [""])[0].strip()
+
+        review = self.server.conn.execute("SELECT ocr_text FROM reviews WHERE id = ?", (review_id,)).fetchone()
+        if review is not None:
+            resolve(self.server.conn, review_id, text if text != (review["ocr_text"] or "") else None)
+
+        self.send_response(303)
+        self.send_header("Location", "/")
+        self.end_headers()
+
+
+def review_on_web(conn, port):
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), ReviewHandler)
+    server.conn = conn
+    print(f"Review page on http://127.0.0.1:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+############################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Review the chips flagged by the OCR")
+    parser.add_argument("--queue", default=review_queue_path, help="review queue database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the chips waiting for review")
+    subparsers.add_parser("review", help="review in the terminal")
+    web = subparsers.add_parser("web", help="review on a local web page")
+    web.add_argument("--port", type=int, default=8800)
+    subparsers.add_parser("merge", help="write the corrections to the results and JSON files")
+    args = parser.parse_args()
+
+    conn = open_review_queue(args.queue)
+
+    if args.command == "list":
+        for review in pending_reviews(conn):
+            print(f"{review['id']:5d}  {review['result_file']}  chip {review['chip']} ({review['side']})  "
+                  f"{review['reason']}: {review['ocr_text']}")
+    elif args.command == "review":
+        review_in_terminal(conn)
+    elif args.command == "web":
+        review_on_web(conn, args.port)
+    elif args.command == "merge":
+        merge_corrections(conn)
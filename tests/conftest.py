@@ -0,0 +1,28 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_servers
+
+
+@pytest.fixture
+def mock_server():
+
+    # Starts mock_servers.py servers in this process: mock_server(handler, **settings)
+    servers = []
+
+    def start(handler, **settings):
+        server = mock_servers.make_server(handler, **settings)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
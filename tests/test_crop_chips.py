@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("PIL")
+pytest.importorskip("requests")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crop_chips_FEMB
+from crop_chips_FEMB import crop_chips
+
+
+def board_image(seed):
+    return np.random.default_rng(seed).integers(0, 256, (60, 80, 3), dtype=np.uint8)
+
+
+def expected(image, x, y, w, h):
+    return cv2.rotate(image[y:y+h, x:x+w], cv2.ROTATE_90_CLOCKWISE)
+
+
+def test_out_of_bounds_chip_is_refused():
+    crop_chips_FEMB._crop_plans.clear()
+    with pytest.raises(ValueError):
+        crop_chips(board_image(0), [(10, 10, 20, 15), (70, 50, 20, 15)])
+
+
+def test_same_layout_on_two_boards():
+    crop_chips_FEMB._crop_plans.clear()
+    coordinates = [(0, 0, 20, 15), (30, 10, 20, 15), (5, 40, 12, 18)]
+
+    first = board_image(1)
+    chips = [chip.copy() for chip in crop_chips(first, coordinates)]
+    for chip, (x, y, w, h) in zip(chips, coordinates):
+        assert np.array_equal(chip, expected(first, x, y, w, h))
+
+    # The second board reuses the buffers of the first one
+    second = board_image(2)
+    for chip, (x, y, w, h) in zip(crop_chips(second, coordinates), coordinates):
+        assert np.array_equal(chip, expected(second, x, y, w, h))
+    assert len(crop_chips_FEMB._crop_plans) == 1
+
+
+def test_other_image_format_is_not_read_from_the_buffer():
+    crop_chips_FEMB._crop_plans.clear()
+    coordinates = [(0, 0, 20, 15)]
+    crop_chips(board_image(3), coordinates)
+
+    # A grayscale frame does not fit the colour buffers: the crop must be
+    # the one OpenCV allocated, not the empty slot
+    gray = cv2.cvtColor(board_image(4), cv2.COLOR_BGR2GRAY)
+    chip = crop_chips(gray, coordinates)[0]
+    assert np.array_equal(chip, expected(gray, 0, 0, 20, 15))
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+
+import mock_servers
+import ocr_client
+
+
+@pytest.fixture
+def minicpm(mock_server, monkeypatch):
+    monkeypatch.setattr(ocr_client, "_endpoint_state", {})
+    monkeypatch.setattr(ocr_client, "breaker_failures", 3)
+    monkeypatch.setattr(ocr_client, "breaker_cooldown", 0.5)
+    monkeypatch.setattr(ocr_client, "max_attempts", 1)
+    server = mock_server(mock_servers.MiniCPMHandler, **mock_servers.minicpm_settings(delay=0))
+    return server, f"http://127.0.0.1:{server.server_port}/api/generate"
+
+
+def generate(url):
+    return ocr_client.post_generate([url], {"model": "minicpm-v", "prompt": "OCR", "stream": False})
+
+
+def test_breaker_opens_after_consecutive_failures(minicpm):
+    server, url = minicpm
+    server.failures = 3
+
+    for _ in range(3):
+        assert generate(url) is None
+    assert ocr_client._state(url)["open_until"] > time.time()
+
+    # Open: the next request waits for the cool-down instead of hitting the server
+    requests_before = server.requests
+    start = time.time()
+    response = generate(url)
+    assert time.time() - start >= 0.3
+    assert response.status_code == 200 and server.requests == requests_before + 1
+
+
+def test_half_open_trial_request(minicpm):
+    server, url = minicpm
+    server.failures = 4
+
+    for _ in range(3):
+        generate(url)
+    time.sleep(0.6)
+
+    # Half-open: one trial request after the cool-down, a failure opens it again at once
+    assert generate(url) is None
+    assert ocr_client._state(url)["open_until"] > time.time()
+
+    # and a success closes it
+    time.sleep(0.6)
+    assert generate(url).json()["response"] == server.answer
+    assert ocr_client._state(url)["failures"] == 0 and ocr_client._state(url)["open_until"] == 0.0
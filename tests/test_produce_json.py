@@ -0,0 +1,68 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from produce_json import build_record, extract_chip_sn
+
+
+def full_marking(chip, marking):
+    return [f"* Chip {chip} (front):\n", f"Original OCR result: {marking}\n", "Formatted OCR result:\n"] + \
+           [f"{field}\n" for field in marking.split()] + ["\n"]
+
+
+def serial_only(chip, serial):
+    return [f"* Chip {chip} (front):\n", f"Original OCR result (serial number only): {serial}\n",
+            "Formatted OCR result:\n", f"{serial}\n", "\n"]
+
+
+def front_lines():
+    # LArASIC 6 and 9 full marking, 7 and 8 serial number only (sampled chips)
+    lines = ["FEMB SN: BNL/FEMB/I0-1865-1J/00007\n", "\n", "06-06-2024\n", "\n"]
+    lines += full_marking(0, "COLDATA N6Y381.00 00209 2314")
+    lines += full_marking(1, "COLDATA N6Y381.00 00211 2314")
+    for chip, serial in zip(range(2, 6), ("02454", "02426", "02526", "02387")):
+        lines += full_marking(chip, f"ColdADC N6Y381.00 {serial} 2315")
+    lines += full_marking(6, "BNL LArASIC Version P5B 23/16 003-04637")
+    lines += serial_only(7, "003-04630")
+    lines += serial_only(8, "003-04619")
+    lines += full_marking(9, "BNL LArASIC Version P5B 23/16 003-04564")
+    return lines
+
+
+def test_serial_only_chips_keep_their_own_serial():
+    lines = front_lines()
+    serials = [extract_chip_sn(lines, chip, 8, r'\d{3}-\d{5}') for chip in range(6, 10)]
+    assert serials == ["003-04637", "003-04630", "003-04619", "003-04564"]
+
+
+def test_all_serial_only_side():
+    lines = ["FEMB SN: X\n", "\n", "06-06-2024\n", "\n"]
+    for chip, serial in enumerate(("003-00001", "003-00002", "003-00003", "003-00004")):
+        lines += serial_only(chip, serial)
+    serials = [extract_chip_sn(lines, chip, 8, r'\d{3}-\d{5}') for chip in range(4)]
+    assert serials == ["003-00001", "003-00002", "003-00003", "003-00004"]
+
+
+def test_misaligned_full_reading_is_not_found():
+    # Full readings whose serial-number line is not a serial number: the other
+    # lines (here a date code read with an extra digit) must not be taken instead
+    lines = ["FEMB SN: X\n", "\n", "06-06-2024\n", "\n"]
+    lines += full_marking(0, "ColdADC N6Y381.00 O2454 23155")
+    lines += full_marking(1, "ColdADC ColdADC N6Y381.00 02426 2315")
+    assert extract_chip_sn(lines, 0, 5, r'\d{5}') == "Not found"
+    assert extract_chip_sn(lines, 1, 5, r'\d{5}') == "Not found"
+
+
+def test_missing_chip_is_not_found():
+    assert extract_chip_sn(front_lines(), 12, 5, r'\d{5}') == "Not found"
+
+
+def test_build_record_mixed_board():
+    specifications = build_record(front_lines(), front_lines(), "Operator")["specifications"]
+    assert specifications["FEMB ID"] == "BNL/FEMB/I0-1865-1J/00007"
+    assert specifications["(F) ColdADC 4 SN"] == "02387"
+    assert specifications["(F) LArASIC 1 SN"] == "003-04637"
+    assert specifications["(F) LArASIC 2 SN"] == "003-04630"
+    assert specifications["(F) LArASIC 3 SN"] == "003-04619"
+    assert specifications["(F) LArASIC 4 SN"] == "003-04564"
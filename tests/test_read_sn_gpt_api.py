@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("cv2")
+
+import mock_servers
+import read_sn_gpt_api
+
+
+def read_chips(base_url, count, limiter):
+    from openai import AsyncOpenAI
+
+    async def run():
+        client = AsyncOpenAI(api_key="test", base_url=base_url, max_retries=0)
+        usage = read_sn_gpt_api.new_usage()
+        semaphore = asyncio.Semaphore(count)
+        try:
+            results = await asyncio.gather(*(
+                read_sn_gpt_api.read_chip(client, limiter, semaphore, read_sn_gpt_api.chip_request("iVBORw0KGgo="),
+                                          usage, f"chip {i}")
+                for i in range(count)))
+        finally:
+            await client.close()
+        return results, usage
+
+    return asyncio.run(run())
+
+
+def test_rate_limited_requests_wait_for_retry_after(mock_server, monkeypatch):
+    # One request per second allowed by the mock, none by the local budget
+    server = mock_server(mock_servers.OpenAIHandler, **mock_servers.openai_settings(delay=0, rpm=1, rate_window=1.0))
+    monkeypatch.setattr(read_sn_gpt_api, "retry_backoff", 10.0)  # the retry-after of the answer must win
+
+    limiter = read_sn_gpt_api.RateLimiter(requests_per_minute=6000, tokens_per_minute=10 ** 7)
+    start = time.time()
+    results, usage = read_chips(f"http://127.0.0.1:{server.server_port}/v1", 2, limiter)
+    elapsed = time.time() - start
+
+    assert results == [server.answer, server.answer]
+    assert server.rejected == 1 and usage["retries"] == 1 and usage["failed"] == 0
+    assert 0.5 < elapsed < 5
+    assert limiter.paused_until > 0
+
+
+def test_retry_delay_headers():
+    class Response:
+        def __init__(self, headers):
+            self.headers = headers
+
+    class Error:
+        def __init__(self, headers):
+            self.response = Response(headers)
+
+    assert read_sn_gpt_api.retry_delay(Error({"retry-after-ms": "250"}), 0) == 0.25
+    assert read_sn_gpt_api.retry_delay(Error({"retry-after": "2"}), 0) == 2.0
+    assert read_sn_gpt_api.retry_delay(Error({}), 2) == read_sn_gpt_api.retry_backoff * 4
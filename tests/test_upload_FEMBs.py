@@ -0,0 +1,64 @@
+import json
+import shutil
+
+import pytest
+
+import mock_servers
+import upload_FEMBs
+
+pytestmark = pytest.mark.skipif(shutil.which("curl") is None, reason="curl not installed")
+
+
+def make_record(femb_id, serial="02454"):
+    return json.dumps({"component_type": {"part_type_id": upload_FEMBs.part_type_id},
+                       "specifications": {"FEMB ID": femb_id, "(F) ColdADC 1 SN": serial}}).encode()
+
+
+@pytest.fixture
+def hwdb(mock_server, monkeypatch, tmp_path):
+    server = mock_server(mock_servers.HWDBHandler, **mock_servers.hwdb_settings())
+    monkeypatch.setattr(upload_FEMBs, "api_url", f"http://127.0.0.1:{server.server_port}/cdbdev/api")
+    monkeypatch.setattr(upload_FEMBs, "curl_command", ["curl"])
+    monkeypatch.setattr(upload_FEMBs, "curl_timeout", 10)
+    for side in ("FRONT", "BACK"):
+        (tmp_path / f"FEMB_{side}_reduced.png").write_bytes(b"\x89PNG picture")
+    return server, str(tmp_path / "FEMB_FRONT_reduced.png"), str(tmp_path / "FEMB_BACK_reduced.png")
+
+
+def test_create_unchanged_update(hwdb):
+    server, front, back = hwdb
+    components = {}
+
+    assert upload_FEMBs.upload_board(make_record("FEMB-1"), front, back, components) == "created"
+    part_id = components["FEMB-1"]["part_id"]
+    assert server.images[part_id] == 2
+
+    assert upload_FEMBs.upload_board(make_record("FEMB-1"), front, back, components) == "unchanged"
+    assert upload_FEMBs.upload_board(make_record("FEMB-1", "02455"), front, back, components) == "updated"
+    assert server.components[part_id]["specifications"][-1]["(F) ColdADC 1 SN"] == "02455"
+    assert len(server.components) == 1 and server.images[part_id] == 2
+
+    # A fresh list from the HWDB knows the board: nothing created again
+    fetched = upload_FEMBs.fetch_hwdb_components()
+    assert fetched["FEMB-1"]["specifications"]["(F) ColdADC 1 SN"] == "02455"
+    assert upload_FEMBs.upload_board(make_record("FEMB-1", "02455"), front, back, fetched) == "unchanged"
+
+
+def test_pending_pictures_are_retried(hwdb):
+    server, front, back = hwdb
+    server.image_failures = 1
+    components = {}
+
+    # Created, but the front picture was refused: not done yet
+    assert upload_FEMBs.upload_board(make_record("FEMB-2"), front, back, components) is None
+    part_id = components["FEMB-2"]["part_id"]
+    assert components["FEMB-2"]["pending_images"] == ["front"]
+    assert server.images[part_id] == 1
+
+    # Only the missing picture is sent again, the board is not created twice
+    assert upload_FEMBs.upload_board(make_record("FEMB-2"), front, back, components) == "updated"
+    assert "pending_images" not in components["FEMB-2"]
+    assert server.images[part_id] == 2
+    assert len(server.components) == 1
+
+    assert upload_FEMBs.upload_board(make_record("FEMB-2"), front, back, components) == "unchanged"
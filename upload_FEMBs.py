@@ -4,55 +4,273 @@
 # These FEMB pictures and OCR results come from the QC Camera Setup at BNL and its
 # MiniCPM-based Serial Number Recognition algorithm (crop_chips_FEMB.py)
 
+# The FEMB components already in the HWDB are fetched once per run (paged,
+# and cached locally for hwdb_cache_ttl seconds) and compared with the local
+# .JSON records by FEMB ID: boards already registered with the same
+# specifications are skipped, changed ones are updated, and only the missing
+# ones are created (with their pictures). Rerunning after a partial failure
+# never creates duplicates.
+
 # Don't forget to define CURL as: alias CURL='curl --cert Output.pem --pass <phrase>'
 
 import os
 import json
 import subprocess
+import tempfile
+import time
+
+import board_archive
 
 # Base directory containing the variable directories (like 00003)
 base_dir = '/results'
 
 # URL for the API
-post_url = 'https://dbwebapi2.fnal.gov:8443/cdbdev/api/component-types/D08100400001/components'
-image_url_template = 'https://dbwebapi2.fnal.gov:8443/cdbdev/api/components/{}/images'
+api_url = 'https://dbwebapi2.fnal.gov:8443/cdbdev/api'
+part_type_id = 'D08100400001'
+curl_command = ['CURL']  # e.g. ['curl'] with the HWDB mock of mock_servers.py
+
+# Local copy of the FEMB components registered in the HWDB
+hwdb_cache_file = 'hwdb_components.json'  # in base_dir
+hwdb_cache_ttl = 3600  # seconds
+hwdb_page_size = 100
+curl_timeout = 120  # seconds per request, so an unreachable HWDB cannot hang the uploads
+
+
+####################################################################
+
+def curl_json(args, data=None):
+
+    # Runs CURL and returns the JSON answer (None if there is none)
+    try:
+        result = subprocess.run(curl_command + ['-s', '--max-time', str(curl_timeout)] + args, input=data,
+                                capture_output=True, timeout=curl_timeout + 10)
+    except subprocess.TimeoutExpired:
+        print(f"Error: API request timed out after {curl_timeout} s")
+        return None
+    try:
+        return json.loads(result.stdout)
+    except ValueError:
+        print(f"Error: API request failed ({result.stdout[:200]!r})")
+        return None
+
+
+def latest_specifications(component):
+
+    # The HWDB keeps a list of versions of the specifications, the last one is current
+    specifications = component.get("specifications") or {}
+    if isinstance(specifications, list):
+        specifications = specifications[-1] if specifications else {}
+    return specifications
+
+####################################################################
+
+def fetch_hwdb_components():
+
+    # {FEMB ID: {"part_id": ..., "specifications": {...}}}, page by page.
+    # None when the list could not be fetched completely.
+    components = {}
+    page = 1
+    while True:
+        url = f"{api_url}/component-types/{part_type_id}/components?page={page}&size={hwdb_page_size}"
+        response = curl_json([url])
+        if response is None or "data" not in response:
+            return None
+        if not response["data"]:
+            break
+
+        for component in response["data"]:
+            specifications = latest_specifications(component)
+            femb_id = specifications.get("FEMB ID")
+            if femb_id:
+                components[femb_id] = {"part_id": component.get("part_id"), "specifications": specifications}
+
+        if page >= response.get("pagination", {}).get("pages", page):
+            break
+        page += 1
+
+    return components
+
+
+def load_hwdb_components(cache_path, refresh=False):
+
+    # Cached list when it is recent enough, otherwise fetched again.
+    # Returns the components and the time they were fetched.
+    if not refresh and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if time.time() - cache.get("fetched", 0) < hwdb_cache_ttl:
+            print(f"{len(cache['components'])} FEMBs in the HWDB (cached list)")
+            return cache["components"], cache["fetched"]
+
+    fetched = time.time()
+    components = fetch_hwdb_components()
+    if components is None:
+        return None, None
+
+    # Pictures still to upload are only known locally: keep them from the old cache
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)["components"]
+        for femb_id, component in previous.items():
+            if component.get("pending_images") and femb_id in components:
+                components[femb_id]["pending_images"] = component["pending_images"]
+
+    save_hwdb_components(cache_path, components, fetched)
+    print(f"{len(components)} FEMBs in the HWDB")
+    return components, fetched
+
+
+def save_hwdb_components(cache_path, components, fetched):
+
+    temp_file = f"{cache_path}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump({"fetched": fetched, "components": components}, f)
+    os.replace(temp_file, cache_path)
+
+####################################################################
+
+def post_image(image_url, image_path, comments):
 
-# Iterate over each directory in the base directory
-for dir_name in os.listdir(base_dir):
-    dir_path = os.path.join(base_dir, dir_name)
+    # CURL exit code and HTTP code of one picture upload (exit code None on a timeout)
+    try:
+        result = subprocess.run(curl_command + ['-s', '--max-time', str(curl_timeout), '-w', '\n%{http_code}',
+                                                '-H', comments, '-F', f'image=@{image_path}', image_url],
+                                capture_output=True, timeout=curl_timeout + 10)
+    except subprocess.TimeoutExpired:
+        return None, ""
+    return result.returncode, result.stdout.decode(errors='replace').strip().rsplit('\n', 1)[-1]
+
+
+def send_image(image_url, image, comments):
+
+    # True when CURL succeeded and the HWDB answered with a 2xx code
+    if os.path.exists(image):
+        returncode, http_code = post_image(image_url, image, comments)
+    elif not board_archive.file_exists(image):
+        print(f"Error: {image} not found")
+        return False
+    else:
+        # Packed board: the picture goes through a temporary file with the same name
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_image = os.path.join(temp_dir, os.path.basename(image))
+            with open(temp_image, 'wb') as f:
+                f.write(board_archive.read_file(image))
+            returncode, http_code = post_image(image_url, temp_image, comments)
+
+    if returncode is None:
+        print(f"Error: upload of {image} timed out after {curl_timeout} s")
+        return False
+    if returncode != 0 or not http_code.startswith('2'):
+        print(f"Error: upload of {image} failed (CURL exit code {returncode}, HTTP {http_code or 'none'})")
+        return False
+    return True
+
+
+def upload_images(part_id, front_image, back_image, sides=("front", "back")):
+
+    # URLs for uploading images with the obtained part_id.
+    # Returns the sides whose picture could not be uploaded.
+    image_url = f"{api_url}/components/{part_id}/images"
+
+    failed = []
+    for side, image, comments in (("front", front_image, 'comments=Front of the FEMB'),
+                                  ("back", back_image, 'comments=Back of the FEMB')):
+        if side in sides and not send_image(image_url, image, comments):
+            failed.append(side)
+    return failed
+
+
+def upload_board(record, front_image, back_image, hwdb_components, source=""):
+
+    # Sends one board's .JSON record (bytes) to the HWDB, with its pictures if it is new.
+    # Returns "created", "updated" or "unchanged" (and keeps hwdb_components in step),
+    # None when the HWDB did not accept it. Pictures that failed stay in
+    # hwdb_components as "pending_images" and are sent again on the next call.
+    specifications = json.loads(record)["specifications"]
+    femb_id = specifications["FEMB ID"]
+    registered = hwdb_components.get(femb_id)
+
+    images_sent = False
+    if registered and registered.get("pending_images"):
+        failed = upload_images(registered["part_id"], front_image, back_image, registered["pending_images"])
+        if failed:
+            registered["pending_images"] = failed
+            print(f"Pictures of {femb_id} ({', '.join(failed)}) still not uploaded")
+            return None
+        del registered["pending_images"]
+        images_sent = True
+        print(f"Uploaded the missing pictures of {femb_id} ({registered['part_id']})")
+
+    if registered and registered["specifications"] == specifications:
+        return "updated" if images_sent else "unchanged"
+
+    if registered:
+        # Already in the HWDB with other chip serial numbers: update its specifications
+        response = curl_json(['-H', 'Content-Type: application/json', '-X', 'PATCH', '-d', '@-',
+                              f"{api_url}/components/{registered['part_id']}"],
+                             json.dumps({"part_id": registered["part_id"], "specifications": specifications}).encode())
+        if response and response.get("status") == "OK":
+            registered["specifications"] = specifications
+            print(f"Updated {femb_id} ({registered['part_id']})")
+            return "updated"
+        print(f"Failed to update {registered['part_id']} for {source or femb_id}")
+        return None
+
+    # First CURL command to send JSON data (piped, so packed boards need no extraction)
+    response = curl_json(['-H', 'Content-Type: application/json', '-X', 'POST', '-d', '@-',
+                          f"{api_url}/component-types/{part_type_id}/components"], record)
+
+    # Parse the output to get the part_id
+    part_id = response.get("part_id") if response else None
+
+    if part_id:
+        hwdb_components[femb_id] = {"part_id": part_id, "specifications": specifications}
+        failed = upload_images(part_id, front_image, back_image)
+        if failed:
+            # Registered, so never created again, but not done until its pictures are in
+            hwdb_components[femb_id]["pending_images"] = failed
+            print(f"Created {femb_id} ({part_id}), pictures not uploaded: {', '.join(failed)}")
+            return None
+        print(f"Created {femb_id} ({part_id})")
+        return "created"
+    print(f"Failed to retrieve part_id for {source or femb_id}")
+    return None
+
+
+def upload_all_boards(base_dir, refresh=False):
+
+    cache_path = os.path.join(base_dir, hwdb_cache_file)
+    hwdb_components, fetched = load_hwdb_components(cache_path, refresh)
+    if hwdb_components is None:
+        # Without the list, every board would be created again
+        print("Error: could not fetch the FEMB components from the HWDB, nothing uploaded")
+        return
+    counts = {"created": 0, "updated": 0, "unchanged": 0, "failed": 0}
+
+    # Iterate over each board (directory or packed board) in the base directory
+    for dir_name in board_archive.find_boards(base_dir):
+        dir_path = os.path.join(base_dir, dir_name)
 
-    # Only proceed if it's a directory
-    if os.path.isdir(dir_path):
         json_file = os.path.join(dir_path, f"{dir_name}.JSON")
         front_image = os.path.join(dir_path, "FEMB_FRONT_reduced.png")
         back_image = os.path.join(dir_path, "FEMB_BACK_reduced.png")
 
         # Ensure JSON file and both images exist
-        if os.path.exists(json_file) and os.path.exists(front_image) and os.path.exists(back_image):
-            # First CURL command to send JSON data
-            result = subprocess.run(
-                ['CURL', '-H', 'Content-Type: application/json', '-X', 'POST', '-d', f'@{json_file}', post_url],
-                capture_output=True, text=True
-            )
-
-            # Parse the output to get the part_id
-            response = json.loads(result.stdout)
-            part_id = response.get("part_id")
-
-            if part_id:
-                # URLs for uploading images with the obtained part_id
-                image_url = image_url_template.format(part_id)
-
-                # CURL command for the front image
-                subprocess.run(
-                    ['CURL', '-H', 'comments=Front of the FEMB', '-F', f'image=@{front_image}', image_url]
-                )
-
-                # CURL command for the back image
-                subprocess.run(
-                    ['CURL', '-H', 'comments=Back of the FEMB', '-F', f'image=@{back_image}', image_url]
-                )
-            else:
-                print(f"Failed to retrieve part_id for {json_file}")
-        else:
+        if not (board_archive.file_exists(json_file) and board_archive.file_exists(front_image) and board_archive.file_exists(back_image)):
             print(f"Required files missing in {dir_path}")
+            continue
+
+        outcome = upload_board(board_archive.read_file(json_file), front_image, back_image, hwdb_components, json_file)
+        counts[outcome or "failed"] += 1
+
+    # Keep the cache in step with what was just sent (its age stays the one of the fetched list),
+    # including the boards created whose pictures are still pending
+    if counts["created"] or counts["updated"] or counts["failed"]:
+        save_hwdb_components(cache_path, hwdb_components, fetched)
+
+    print(f"{counts['created']} FEMBs created, {counts['updated']} updated, {counts['unchanged']} already up to date in the HWDB"
+          + (f", {counts['failed']} failed" if counts["failed"] else ""))
+
+
+if __name__ == "__main__":
+    upload_all_boards(base_dir)
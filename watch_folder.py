@@ -0,0 +1,145 @@
+# This program watches the QC camera output directory and reads each board
+# as soon as both its FEMB_FRONT_* and FEMB_BACK_* pictures are complete.
+
+# It runs the same pipeline as crop_chips_FEMB.py, but stays alive, so the
+# barcode decoders and the model server connection are kept warm between boards.
+# With stream_to_hwdb = True, each board is also in the HWDB seconds after its
+# pictures are taken (hwdb_stream.py).
+
+# Uses inotify (through the watchdog package) when it is installed, and falls
+# back to polling the directory otherwise.
+
+import os
+import time
+import threading
+
+import crop_chips_FEMB
+import hwdb_stream
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+# Every PNG file ends with this chunk, so a file without it is still being written
+PNG_END = b'IEND\xaeB`\x82'
+
+
+############################################################################################
+
+class WakeUpHandler(FileSystemEventHandler):
+
+    # Any change in the directory wakes up the scanner before the next poll
+
+    def __init__(self, wake_up):
+        self.wake_up = wake_up
+
+    def on_any_event(self, event):
+        self.wake_up.set()
+
+############################################################################################
+
+def is_image_complete(path, last_sizes):
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+
+    # Size must be unchanged since the previous scan ...
+    previous_size = last_sizes.get(path)
+    last_sizes[path] = size
+    if size == 0 or size != previous_size:
+        return False
+
+    # ... and a PNG must already have its final chunk
+    if path.lower().endswith('.png'):
+        with open(path, 'rb') as f:
+            f.seek(max(0, size - len(PNG_END)))
+            return f.read() == PNG_END
+
+    return True
+
+############################################################################################
+
+def find_complete_boards(watch_dir, last_sizes, seen_boards):
+
+    new_boards = []
+    for image_path_front, image_path_back in crop_chips_FEMB.find_board_pairs(watch_dir, quiet=True):
+        if image_path_front in seen_boards:
+            continue
+        front_complete = is_image_complete(image_path_front, last_sizes)
+        back_complete = is_image_complete(image_path_back, last_sizes)
+        if front_complete and back_complete:
+            new_boards.append((image_path_front, image_path_back))
+
+    return new_boards
+
+############################################################################################
+
+def watch_folder(watch_dir):
+
+    wake_up = threading.Event()
+    last_sizes = {}
+    seen_boards = set()
+
+    if not process_existing:
+        # Only boards that arrive from now on
+        for image_path_front, _ in crop_chips_FEMB.find_board_pairs(watch_dir, quiet=True):
+            seen_boards.add(image_path_front)
+
+    # Model loaded once now and kept resident, not when the first board arrives
+    crop_chips_FEMB.start_warm_up()
+
+    # Each board uploaded to the HWDB once read, and the uploads left by the last run retried
+    if stream_to_hwdb:
+        crop_chips_FEMB.stream_to_hwdb = True
+        hwdb_stream.start_uploader()
+
+    observer = None
+    if Observer is not None:
+        observer = Observer()
+        observer.schedule(WakeUpHandler(wake_up), watch_dir, recursive=False)
+        observer.start()
+        print(f"Watching {watch_dir} (inotify)")
+    else:
+        print(f"Watching {watch_dir} (polling every {poll_interval} s)")
+
+    try:
+        while True:
+            wake_up.wait(poll_interval)
+            wake_up.clear()
+
+            for image_path_front, image_path_back in find_complete_boards(watch_dir, last_sizes, seen_boards):
+                seen_boards.add(image_path_front)
+
+                print(f"\n\nNew board: {os.path.basename(image_path_front)} / {os.path.basename(image_path_back)}")
+                start_time = time.time()
+                try:
+                    crop_chips_FEMB.main_process(image_path_front, image_path_back)
+                except Exception as e:
+                    print(f"Error processing {image_path_front}: {e}")
+                    continue
+                print(f"Board done in {time.time() - start_time:.1f} s")
+
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+# Configuration:
+
+watch_dir = 'images'      # QC camera output directory
+poll_interval = 2.0       # seconds between scans (files must keep their size for one scan)
+process_existing = False  # also read the boards already in watch_dir at startup
+stream_to_hwdb = False    # upload every board that passes validation right away (see hwdb_stream.py)
+
+
+if __name__ == "__main__":
+    watch_folder(watch_dir)